@@ -6,25 +6,41 @@ We are using asyncio module and aiomysql dependency for executing defined databa
 For this project we used MySQL database.
 """
 import asyncio
+import time
 import aiomysql
 import constants
+from contextlib import asynccontextmanager
 from datetime import datetime
 from entities.record import Record
+from entities.registerattempt import RegisterAttempt
+from blacklistrules import BlacklistRule, ANY_DOMAIN
+import querybuilder
+import metrics
+import querystats
+from querystats import TracedCursor
+from querybuilder import Where
+from util import likeEscape
 
 class AsyncDb:
     """
     Main AsyncDb class
     After an instance of this class has been constructed, before calling any coroutines, it is important
-    to call initConnection() only once, which is responsible for obtaining the connection reference with the database.
+    to call initConnection() or initPool() only once, which is responsible for obtaining the connection
+    (or the connection pool) reference with the database.
     After calling any of the coroutines, it is important to call commit() or rollback(), depending whether we want
     to perform the transaction or not.
+    In pooled mode the coroutines must be called on the instance yielded by transaction(), which is bound
+    to a connection borrowed from the pool for the duration of one transaction.
     """
-    def __init__(self, loop):
+    def __init__(self, loop, connection: aiomysql.Connection = None):
         self.loop = loop
-        self.connection: aiomysql.Connection = None
+        self.connection: aiomysql.Connection = connection
+        self.pool: aiomysql.Pool = None
+        #borrowed connections belong to the pool, they are released by transaction(), never closed here
+        self.borrowed = connection is not None
     
     def __del__(self):
-        if self.connection is not None:
+        if self.connection is not None and not self.borrowed:
             self.connection.close()
 
     async def initConnection(self):
@@ -34,9 +50,103 @@ class AsyncDb:
             user=constants.USER,
             password=constants.PASS,
             db=constants.DB_NAME,
+            connect_timeout=constants.DB_CONNECT_TIMEOUT,
             loop=self.loop
             )
 
+    async def initPool(self, minsize: int = constants.DB_POOL_MINSIZE, maxsize: int = constants.DB_POOL_MAXSIZE):
+        """
+        Creates the connection pool. maxsize limits how many transactions can run at once,
+        any further transaction() waits until a connection is released back to the pool.
+        """
+        self.pool = await aiomysql.create_pool(
+            minsize=minsize,
+            maxsize=maxsize,
+            host=constants.HOST,
+            port=constants.PORT,
+            user=constants.USER,
+            password=constants.PASS,
+            db=constants.DB_NAME,
+            connect_timeout=constants.DB_CONNECT_TIMEOUT,
+            loop=self.loop
+            )
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+        if self.connection is not None and not self.borrowed:
+            self.connection.close()
+            self.connection = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Yields an AsyncDb instance for running one transaction.
+        In pooled mode the yielded instance owns a connection borrowed from the pool,
+        otherwise it is this instance with its single shared connection.
+        The transaction is committed when the block exits normally and rolled back on exception.
+        Calling commit() or rollback() inside the block is allowed, a later commit/rollback
+        of an already finished transaction does nothing.
+        """
+        if self.pool is None:
+            try:
+                yield self
+            except BaseException:
+                await self.rollback()
+                raise
+            await self.commit()
+            return
+
+        async with self.pool.acquire() as connection:
+            db = AsyncDb(self.loop, connection)
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            await db.commit()
+
+    async def ping(self):
+        """
+        Raises if the database can't be reached
+        """
+        async with self.transaction() as db:
+            async with db.cursor() as cursor:
+                await cursor.execute("SELECT 1")
+
+    @asynccontextmanager
+    async def cursor(self, *cursorClasses):
+        """
+        Cursor of the connection whose queries are timed and recorded by querystats
+        """
+        async with self.connection.cursor(*cursorClasses) as cursor:
+            yield TracedCursor(cursor)
+
+    async def streamRows(self, query: str, params=None):
+        """
+        Async generator of the query's rows, read through a server-side cursor DB_STREAM_BATCH rows at a time,
+        so the result set is never held in memory. No other query can run on the connection
+        until the generator is exhausted.
+        The query is recorded into querystats once the stream is over, with the rows counted as they are fetched
+        and the time of the whole stream (a TracedCursor would only time the first packet).
+        """
+        start = time.perf_counter()
+        cnt = 0
+        try:
+            async with self.connection.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(query, params)
+                while True:
+                    rows = await cursor.fetchmany(constants.DB_STREAM_BATCH)
+                    if len(rows) == 0:
+                        break
+                    cnt += len(rows)
+                    for row in rows:
+                        yield row
+        finally:
+            querystats.STATS.record(query, params, time.perf_counter() - start, cnt, 0)
+
     async def commit(self):
         await self.connection.commit()
 
@@ -47,223 +157,227 @@ class AsyncDb:
     #util
     async def createDB(self):
         query = "CREATE DATABASE " + constants.DB_NAME
-        async with self.connection.cursor() as cursor:
+        async with self.cursor() as cursor:
             await cursor.execute(query)
     
     #util
+    #Creates the table with the latest schema, keep in sync with migrations.py
     async def rebuildTable(self):
         queryDrop = "DROP TABLE IF EXISTS {}".format(constants.TABLE_NAME)
-        queryCreate = '''CREATE TABLE {table_name} (
+        queryCreate = '''CREATE TABLE {} (
+            Guildid bigint unsigned NOT NULL,
             Tokenid int NOT NULL AUTO_INCREMENT,
             Discordid varchar(127) NOT NULL,
             Email varchar(127) NOT NULL,
-            Token varchar(64) NOT NULL,
+            Token char(43) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
             Time datetime NOT NULL,
-            Type enum({vars}),
+            Type varchar(127),
             Status enum('pending', 'registered'),
-            PRIMARY KEY (Tokenid)
-        )'''.format(table_name=constants.TABLE_NAME, vars=", ".join(["%s" for x in range(len(constants.REGISTERED_ROLE_NAMES))]))
-        async with self.connection.cursor() as cursor:
+            PRIMARY KEY (Tokenid),
+            UNIQUE INDEX Guild_Discordid (Guildid, Discordid),
+            UNIQUE INDEX Guild_Email (Guildid, Email),
+            INDEX Token (Token),
+            INDEX Status_Time (Status, Time)
+        )'''.format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
             await cursor.execute(queryDrop)
-            await cursor.execute(queryCreate, tuple(constants.REGISTERED_ROLE_NAMES))
+            await cursor.execute(queryCreate)
 
     async def insertRecord(self, record: Record):
-        query = "INSERT INTO {} (Discordid, Email, Token, Time, Type, Status) VALUES (%s, %s, %s, now(), %s, 'pending')".format(constants.TABLE_NAME)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, (record.discordid, record.email, record.token, record._type))
-
-    async def getRecords(self, record: Record):
-        params = {}
-        query = "SELECT Discordid, Email, Token, Time, Type, Status FROM {} WHERE "
-        tmp = []
-        if record.discordid:
-            tmp.append("Discordid=%(discordid)s")
-            params.update(discordid=record.discordid)
-        if record.email:
-            tmp.append("Email=%(email)s")
-            params.update(email=record.email)
-        if record.token:
-            tmp.append("Token=%(token)s")
-            params.update(token=record.token)
-        if record.time:
-            tmp.append("Time=%(time)s")
-            params.update(time=str(record.time))
-        if record._type:
-            tmp.append("Type=%(_type)s")
-            params.update(_type=record._type)
-        if record.status:
-            tmp.append("Status=%(status)s")
-            params.update(status=record.status)
-        query += " AND ".join(tmp)
-        async with self.connection.cursor() as cursor:
+        query = "INSERT INTO {} (Guildid, Discordid, Email, Token, Time, Type, Status) VALUES (%s, %s, %s, %s, now(), %s, 'pending')".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (record.guildid, record.discordid, record.email, record.token, record._type))
+
+    async def registerAttempt(self, record: Record) -> RegisterAttempt:
+        """
+        Combined register operation, meant to be called inside one transaction.
+        Fetches (and locks) the records of the record's server sharing the discord id or the email
+        with the given record in a single query. If none of them is registered, the pending ones are evicted and the given
+        record (with its token already set) is inserted as pending.
+        """
+        query = "SELECT Tokenid, Discordid, Email, Status FROM {} WHERE Guildid=%(guildid)s AND (Discordid=%(discordid)s OR Email=%(email)s) FOR UPDATE".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, {"guildid": record.guildid, "discordid": record.discordid, "email": record.email})
+            rows = await cursor.fetchall()
+
+        attempt = RegisterAttempt()
+        tokenids = []
+        for tokenid, discordid, email, status in rows:
+            tokenids.append(tokenid)
+            #a registered record wins over a pending one if there is more than one match
+            if discordid == str(record.discordid) and attempt.senderStatus != "registered":
+                attempt.senderStatus = status
+            if email.lower() == record.email.lower() and attempt.emailStatus != "registered":
+                attempt.emailStatus = status
+
+        if "registered" in (attempt.senderStatus, attempt.emailStatus):
+            return attempt
+
+        async with self.cursor() as cursor:
+            if len(tokenids) > 0:
+                queryDelete = "DELETE FROM {} WHERE Tokenid IN ({})".format(constants.TABLE_NAME, ", ".join(["%s" for x in tokenids]))
+                await cursor.execute(queryDelete, tuple(tokenids))
+            queryInsert = "INSERT INTO {} (Guildid, Discordid, Email, Token, Time, Type, Status) VALUES (%s, %s, %s, %s, now(), %s, 'pending')".format(constants.TABLE_NAME)
+            await cursor.execute(queryInsert, (record.guildid, record.discordid, record.email, record.token, record._type))
+        attempt.inserted = True
+        return attempt
+
+    async def validateToken(self, record: Record, ttl: int = constants.PENDING_TOKEN_TTL) -> str:
+        """
+        Fast path for validation, locks the pending record of the discord id in the record's server
+        matching the token and not older than ttl seconds, and marks it registered by its primary key.
+        Returns the role type of the validated record, or None if nothing was updated.
+        """
+        querySelect = "SELECT Tokenid, Type FROM {} WHERE Guildid=%s AND Discordid=%s AND Token=%s AND Status='pending' AND Time > now() - INTERVAL %s SECOND FOR UPDATE".format(constants.TABLE_NAME)
+        queryUpdate = "UPDATE {} SET Status='registered' WHERE Tokenid=%s".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(querySelect, (record.guildid, record.discordid, record.token, ttl))
+            row = await cursor.fetchone()
+            if row is None:
+                return None
+            await cursor.execute(queryUpdate, (row[0],))
+            rowcnt = cursor.rowcount
+        if rowcnt < 1:
+            return None
+        return row[1]
+
+    async def deregisterRecord(self, record: Record) -> str:
+        """
+        Fast path for deregistration, locks the registered record of the discord id in the record's server and deletes it
+        with a DELETE conditioned on Status, in one transaction.
+        Returns the role type of the deleted record, or None if nothing was deleted.
+        """
+        querySelect = "SELECT Type FROM {} WHERE Guildid=%s AND Discordid=%s AND Status='registered' LIMIT 1 FOR UPDATE".format(constants.TABLE_NAME)
+        queryDelete = "DELETE FROM {} WHERE Guildid=%s AND Discordid=%s AND Status='registered'".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(querySelect, (record.guildid, record.discordid))
+            row = await cursor.fetchone()
+            if row is None:
+                return None
+            await cursor.execute(queryDelete, (record.guildid, record.discordid))
+            rowcnt = cursor.rowcount
+        if rowcnt < 1:
+            return None
+        return row[0]
+
+    async def isExpired(self, record: Record, ttl: int = constants.PENDING_TOKEN_TTL) -> bool:
+        query = "SELECT EXISTS(SELECT 1 FROM {} WHERE Guildid=%s AND Discordid=%s AND Status='pending' AND Time <= now() - INTERVAL %s SECOND)".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (record.guildid, record.discordid, ttl))
+            row = await cursor.fetchone()
+        return row[0] == 1
+
+    async def deleteExpired(self, ttl: int, limit: int) -> int:
+        """
+        Deletes up to limit pending records older than ttl seconds, oldest first
+        """
+        query = "DELETE FROM {} WHERE Status='pending' AND Time <= now() - INTERVAL %s SECOND ORDER BY Time LIMIT %s".format(constants.TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (ttl, limit))
+            rowcnt = cursor.rowcount
+        return rowcnt
+
+    async def getRecords(self, predicate: Where):
+        query, params = querybuilder.build("select", predicate)
+        async with self.cursor() as cursor:
             await cursor.execute(query, params)
-        return cursor.fetchall().result()
-
-
-    async def setStatus(self, record: Record, status: str):
-        params = {"status": status}
-        query = "UPDATE {} SET Status=%(status)s WHERE ".format(constants.TABLE_NAME)
-        tmp = []
-        if record.discordid:
-            tmp.append("Discordid=%(discordid)s")
-            params.update(discordid=record.discordid)
-        if record.email:
-            tmp.append("Email=%(email)s")
-            params.update(email=record.email)
-        if record.token:
-            tmp.append("Token=%(token)s")
-            params.update(token=record.token)
-        if record.time:
-            tmp.append("Time=%(time)s")
-            params.update(time=str(record.time))
-        if record._type:
-            tmp.append("Type=%(_type)s")
-            params.update(_type=record._type)
-        if record.status:
-            tmp.append("Status=%(status)s")
-            params.update(status=record.status)
-        query += " AND ".join(tmp)
-
-        async with self.connection.cursor() as cursor:
+            rows = await cursor.fetchall()
+        return rows
+
+    async def streamRecords(self, guildid: int, status: str = None, _type: str = None, since: datetime = None, until: datetime = None,
+        domain: str = None, limit: int = None, offset: int = 0):
+        """
+        Async generator of the server's registration records matching the filters, oldest first, streamed
+        (see streamRows()). since is inclusive, until exclusive, domain keeps the emails at that domain.
+        The records carry no token.
+        """
+        query = "SELECT Discordid, Email, Time, Type, Status FROM {} WHERE Guildid=%s".format(constants.TABLE_NAME)
+        params = [guildid]
+        if status is not None:
+            query += " AND Status=%s"
+            params.append(status)
+        if _type is not None:
+            query += " AND Type=%s"
+            params.append(_type)
+        if since is not None:
+            query += " AND Time>=%s"
+            params.append(since)
+        if until is not None:
+            query += " AND Time<%s"
+            params.append(until)
+        if domain is not None:
+            query += " AND Email LIKE %s"
+            params.append("%@" + likeEscape(domain))
+        query += " ORDER BY Time ASC, Tokenid ASC"
+        if limit is not None:
+            query += " LIMIT %s OFFSET %s"
+            params.extend((limit, offset))
+        async for discordid, email, rowTime, _type, status in self.streamRows(query, params):
+            yield Record(discordid=discordid, email=email, time=rowTime, _type=_type, status=status, guildid=guildid)
+
+    async def setStatus(self, predicate: Where, status: str):
+        query, params = querybuilder.build("setStatus", predicate, newStatus=status)
+        async with self.cursor() as cursor:
             await cursor.execute(query, params)
             rowcnt = cursor.rowcount
         return rowcnt
 
-    async def getStatus(self, record: Record) -> str:
-        params = {}
-        query = "SELECT Status FROM {} WHERE ".format(constants.TABLE_NAME)
-        tmp = []
-        if record.discordid:
-            tmp.append("Discordid=%(discordid)s")
-            params.update(discordid=record.discordid)
-        if record.email:
-            tmp.append("Email=%(email)s")
-            params.update(email=record.email)
-        if record.token:
-            tmp.append("Token=%(token)s")
-            params.update(token=record.token)
-        if record.time:
-            tmp.append("Time=%(time)s")
-            params.update(time=str(record.time))
-        if record._type:
-            tmp.append("Type=%(_type)s")
-            params.update(_type=record._type)
-        if record.status:
-            tmp.append("Status=%(status)s")
-            params.update(status=record.status)
-        query += " AND ".join(tmp)
-
-
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, params)
-            rows = cursor.fetchall()
+    async def getStatus(self, predicate: Where) -> str:
+        return await self.probeColumn("Status", predicate)
 
-        rows = rows.result()
-        if len(rows) != 1:
-            return None
-        for row in rows:
-            return row[0]
-
-    async def setRegistered(self, record: Record):
-        return await self.setStatus(record, "registered")
-
-    async def setPending(self, record: Record):
-        return await self.setStatus(record, "pending")
-
-    async def isRegistered(self, record: Record) -> bool:
-        return (await self.getStatus(record)) == "registered"
-
-    async def isPending(self, record: Record) -> bool:
-        return (await self.getStatus(record)) == "pending"
-
-    async def deleteRecord(self, record: Record):
-        params = {}
-        query = "DELETE FROM {} WHERE ".format(constants.TABLE_NAME)
-        tmp = []
-        if record.discordid:
-            tmp.append("Discordid=%(discordid)s")
-            params.update(discordid=record.discordid)
-        if record.email:
-            tmp.append("Email=%(email)s")
-            params.update(email=record.email)
-        if record.token:
-            tmp.append("Token=%(token)s")
-            params.update(token=record.token)
-        if record.time:
-            tmp.append("Time=%(time)s")
-            params.update(time=str(record.time))
-        if record._type:
-            tmp.append("Type=%(_type)s")
-            params.update(_type=record._type)
-        if record.status:
-            tmp.append("Status=%(status)s")
-            params.update(status=record.status)
-        query += " AND ".join(tmp)
-
-        async with self.connection.cursor() as cursor:
+    async def setRegistered(self, predicate: Where):
+        return await self.setStatus(predicate, "registered")
+
+    async def setPending(self, predicate: Where):
+        return await self.setStatus(predicate, "pending")
+
+    async def isRegistered(self, predicate: Where) -> bool:
+        return (await self.getStatus(predicate)) == "registered"
+
+    async def isPending(self, predicate: Where) -> bool:
+        return (await self.getStatus(predicate)) == "pending"
+
+    async def deleteRecord(self, predicate: Where):
+        query, params = querybuilder.build("delete", predicate)
+        async with self.cursor() as cursor:
             await cursor.execute(query, params)
             rowcnt = cursor.rowcount
         return rowcnt
         
-    async def exists(self, record: Record) -> bool:
-        params = {}
-        query = "SELECT * FROM {} WHERE ".format(constants.TABLE_NAME)
-        tmp = []
-        if record.discordid:
-            tmp.append("Discordid=%(discordid)s")
-            params.update(discordid=record.discordid)
-        if record.email:
-            tmp.append("Email=%(email)s")
-            params.update(email=record.email)
-        if record.token:
-            tmp.append("Token=%(token)s")
-            params.update(token=record.token)
-        if record.time:
-            tmp.append("Time=%(time)s")
-            params.update(time=str(record.time))
-        if record._type:
-            tmp.append("Type=%(_type)s")
-            params.update(_type=record._type)
-        if record.status:
-            tmp.append("Status=%(status)s")
-            params.update(status=record.status)
-        query += " AND ".join(tmp)
-
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, params)
-            rows = cursor.fetchall()
+    async def exists(self, predicate: Where) -> bool:
+        return await self.probe(predicate)
 
-        if len(rows.result()) < 1:
-            return False
-        return True
+    #probes, the server only sends back a yes/no answer or a single column of at most two rows
+    async def probe(self, predicate: Where) -> bool:
+        query, params = querybuilder.build("exists", predicate)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            row = await cursor.fetchone()
+        return row[0] == 1
+
+    async def probeColumn(self, column: str, predicate: Where):
+        """
+        Returns the value of the column if exactly one record matches the predicate, otherwise None
+        """
+        query, params = querybuilder.build("probe", predicate, column=column)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            rows = await cursor.fetchall()
+        if len(rows) != 1:
+            return None
+        return rows[0][0]
 
     async def getToken(self, record: Record):
-        query = "SELECT Token FROM {} WHERE Discordid=%s".format(constants.TABLE_NAME)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, record.discordid)
-            rows = cursor.fetchall()
-        rows = rows.result()
-        if len(rows) != 1:
-            return
-        for row in rows:
-            return row[0]
+        return await self.probeColumn("Token", Where(guildid=record.guildid, discordid=record.discordid))
 
     async def getRoleForUser(self, record: Record):
-        query = "SELECT Type FROM {} WHERE Discordid=%s".format(constants.TABLE_NAME)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, record.discordid)
-            rows = cursor.fetchall()
-        rows = rows.result()
-        if len(rows) != 1:
-            return
-        for row in rows:
-            return row[0]
+        return await self.probeColumn("Type", Where(guildid=record.guildid, discordid=record.discordid))
 
     async def userNameExists(self, record: Record) -> bool:
-        return await self.exists(Record(discordid=record.discordid))
+        return await self.exists(Where(guildid=record.guildid, discordid=record.discordid))
 
     async def emailExists(self, record: Record) -> bool:
-        return await self.exists(Record(email=record.email))
+        return await self.exists(Where(guildid=record.guildid, email=record.email))
     
 
     #blacklist
@@ -271,46 +385,225 @@ class AsyncDb:
     async def rebuildBlacklistTable(self):
         queryDrop = "DROP TABLE IF EXISTS {}".format(constants.BLACKLIST_TABLE_NAME)
         queryBuild = '''CREATE TABLE {} (
+            Guildid bigint unsigned NOT NULL,
             Email varchar(255) NOT NULL,
-            PRIMARY KEY (Email)
+            PRIMARY KEY (Guildid, Email)
         )'''.format(constants.BLACKLIST_TABLE_NAME)
-        async with self.connection.cursor() as cursor:
+        async with self.cursor() as cursor:
             await cursor.execute(queryDrop)
             await cursor.execute(queryBuild)
 
-    async def insertIntoBlacklist(self, *emails: str):
+    async def insertIntoBlacklist(self, guildid: int, *emails: str):
         data = []
         for email in emails:
-            data.append((email,))
-        query = "INSERT INTO {} (Email) VALUES (%s)".format(constants.BLACKLIST_TABLE_NAME)
-        async with self.connection.cursor() as cursor:
+            data.append((guildid, email))
+        query = "INSERT INTO {} (Guildid, Email) VALUES (%s, %s)".format(constants.BLACKLIST_TABLE_NAME)
+        async with self.cursor() as cursor:
             await cursor.executemany(query, data)
 
-    async def deleteFromBlacklist(self, *emails: str) -> int:
+    async def insertIgnoreBlacklist(self, guildid: int, emails: [str]) -> int:
+        """
+        Inserts the emails with one multi-row INSERT IGNORE, skipping the ones already in the blacklist.
+        Returns the number of inserted emails.
+        """
+        if len(emails) == 0:
+            return 0
+        query = "INSERT IGNORE INTO {} (Guildid, Email) VALUES {}".format(constants.BLACKLIST_TABLE_NAME, ", ".join(["(%s, %s)"] * len(emails)))
+        params = []
+        for email in emails:
+            params.extend((guildid, email))
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            rowcnt = cursor.rowcount
+        return rowcnt
+
+    async def deleteFromBlacklist(self, guildid: int, *emails: str) -> int:
         data = []
         for email in emails:
-            data.append((email,))
-        query = "DELETE FROM {} WHERE Email=%s".format(constants.BLACKLIST_TABLE_NAME)
-        async with self.connection.cursor() as cursor:
+            data.append((guildid, email))
+        query = "DELETE FROM {} WHERE Guildid=%s AND Email=%s".format(constants.BLACKLIST_TABLE_NAME)
+        async with self.cursor() as cursor:
             await cursor.executemany(query, data)
             rowcnt = cursor.rowcount
         return rowcnt
 
-    async def isInBlacklist(self, email: str) -> bool:
-        query = "SELECT * FROM {} WHERE Email=%s".format(constants.BLACKLIST_TABLE_NAME)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query, (email,))
-            rows = cursor.fetchall()
-        if len(rows.result()) < 1:
-            return False
-        return True
-
-    async def getBlacklist(self) -> [(str, )]:
-        query = "SELECT Email FROM {} ORDER BY Email ASC".format(constants.BLACKLIST_TABLE_NAME)
-        async with self.connection.cursor() as cursor:
-            await cursor.execute(query)
-            rows = cursor.fetchall()
-        return rows.result()
+    async def isInBlacklist(self, guildid: int, email: str) -> bool:
+        query = "SELECT EXISTS(SELECT 1 FROM {} WHERE Guildid=%s AND Email=%s)".format(constants.BLACKLIST_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (guildid, email))
+            row = await cursor.fetchone()
+        return row[0] == 1
+
+    async def getBlacklist(self, guildid: int = None) -> [(int, str)]:
+        """
+        Returns the (Guildid, Email) rows of the server, or of all the servers if guildid is None
+        """
+        query = "SELECT Guildid, Email FROM {}".format(constants.BLACKLIST_TABLE_NAME)
+        params = ()
+        if guildid is not None:
+            query += " WHERE Guildid=%s"
+            params = (guildid,)
+        query += " ORDER BY Guildid ASC, Email ASC"
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            rows = await cursor.fetchall()
+        return rows
+
+    def streamBlacklist(self, guildid: int, prefix: str = None, domain: str = None):
+        """
+        Async generator of the server's blacklisted emails in order, streamed (see streamRows()).
+        prefix keeps the emails starting with it (a range scan of the primary key),
+        domain the emails at that domain.
+        """
+        query = "SELECT Email FROM {} WHERE Guildid=%s".format(constants.BLACKLIST_TABLE_NAME)
+        params = [guildid]
+        if prefix is not None:
+            query += " AND Email LIKE %s"
+            params.append(likeEscape(prefix) + "%")
+        if domain is not None:
+            query += " AND Email LIKE %s"
+            params.append("%@" + likeEscape(domain))
+        query += " ORDER BY Email ASC"
+        return self.streamRows(query, params)
+
+    #blacklist rules
+    #util
+    async def rebuildBlacklistRuleTable(self):
+        queryDrop = "DROP TABLE IF EXISTS {}".format(constants.BLACKLIST_RULE_TABLE_NAME)
+        queryBuild = '''CREATE TABLE {} (
+            Guildid bigint unsigned NOT NULL,
+            Rule varchar(255) NOT NULL,
+            Kind enum('domain', 'subdomain', 'localpart') NOT NULL,
+            Domain varchar(255) NOT NULL,
+            Pattern varchar(255),
+            PRIMARY KEY (Guildid, Rule),
+            INDEX Guild_Domain (Guildid, Domain)
+        )'''.format(constants.BLACKLIST_RULE_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(queryDrop)
+            await cursor.execute(queryBuild)
+
+    async def insertBlacklistRules(self, guildid: int, *rules: BlacklistRule):
+        data = []
+        for rule in rules:
+            data.append((guildid, rule.rule, rule.kind, rule.domain, rule.pattern))
+        query = "INSERT INTO {} (Guildid, Rule, Kind, Domain, Pattern) VALUES (%s, %s, %s, %s, %s)".format(constants.BLACKLIST_RULE_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.executemany(query, data)
+
+    async def insertIgnoreBlacklistRules(self, guildid: int, rules: [BlacklistRule]) -> int:
+        """
+        Inserts the rules with one multi-row INSERT IGNORE, skipping the ones already in the blacklist.
+        Returns the number of inserted rules.
+        """
+        if len(rules) == 0:
+            return 0
+        query = "INSERT IGNORE INTO {} (Guildid, Rule, Kind, Domain, Pattern) VALUES {}".format(
+            constants.BLACKLIST_RULE_TABLE_NAME, ", ".join(["(%s, %s, %s, %s, %s)"] * len(rules)))
+        params = []
+        for rule in rules:
+            params.extend((guildid, rule.rule, rule.kind, rule.domain, rule.pattern))
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            rowcnt = cursor.rowcount
+        return rowcnt
+
+    async def deleteBlacklistRules(self, guildid: int, *rules: BlacklistRule) -> int:
+        data = []
+        for rule in rules:
+            data.append((guildid, rule.rule))
+        query = "DELETE FROM {} WHERE Guildid=%s AND Rule=%s".format(constants.BLACKLIST_RULE_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.executemany(query, data)
+            rowcnt = cursor.rowcount
+        return rowcnt
+
+    async def getBlacklistRules(self, guildid: int = None, domains: [str] = ()) -> [(int, BlacklistRule)]:
+        """
+        Returns the (Guildid, rule) pairs of the server, or of all the servers if guildid is None,
+        if domains are given, only the rules attached to them
+        """
+        query = "SELECT Guildid, Rule, Kind, Domain, Pattern FROM {}".format(constants.BLACKLIST_RULE_TABLE_NAME)
+        conditions = []
+        params = []
+        if guildid is not None:
+            conditions.append("Guildid=%s")
+            params.append(guildid)
+        if len(domains) > 0:
+            conditions.append("Domain IN ({})".format(", ".join(["%s" for x in domains])))
+            params.extend(domains)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY Guildid ASC, Rule ASC"
+        async with self.cursor() as cursor:
+            await cursor.execute(query, params)
+            rows = await cursor.fetchall()
+        return [(row[0], BlacklistRule(*row[1:])) for row in rows]
+
+    def streamBlacklistRules(self, guildid: int, prefix: str = None, domain: str = None):
+        """
+        Async generator of the server's blacklist rules in order, streamed (see streamRows()).
+        prefix keeps the rules starting with it, domain the rules attached to that domain.
+        """
+        query = "SELECT Rule FROM {} WHERE Guildid=%s".format(constants.BLACKLIST_RULE_TABLE_NAME)
+        params = [guildid]
+        if prefix is not None:
+            query += " AND Rule LIKE %s"
+            params.append(likeEscape(prefix) + "%")
+        if domain is not None:
+            query += " AND Domain=%s"
+            params.append(domain)
+        query += " ORDER BY Rule ASC"
+        return self.streamRows(query, params)
+
+    async def getBlacklistRulesFor(self, guildid: int, email: str) -> [BlacklistRule]:
+        """
+        Returns the rules of the server which can match the email address, the rules of every suffix
+        of its domain and the rules for any domain
+        """
+        domain = email.rpartition("@")[2].lower()
+        parts = domain.split(".")
+        domains = [".".join(parts[i:]) for i in range(len(parts))]
+        domains.append(ANY_DOMAIN)
+        return [rule for guildid, rule in await self.getBlacklistRules(guildid, domains)]
+
+    #outbox
+    async def enqueueEmail(self, recipient: str, token: str):
+        query = "INSERT INTO {} (Recipient, Token, Status, Attempts, NextAttempt, Created) VALUES (%s, %s, 'queued', 0, now(), now())".format(constants.OUTBOX_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (recipient, token))
+
+    async def claimOutbox(self, limit: int, lease: int) -> [(int, str, str, int)]:
+        """
+        Claims up to limit due emails by moving their NextAttempt lease seconds ahead and counting the attempt.
+        Rows locked by another worker's claim are skipped. Returns (Outboxid, Recipient, Token, Attempts) rows.
+        """
+        querySelect = "SELECT Outboxid, Recipient, Token, Attempts FROM {} WHERE Status='queued' AND NextAttempt<=now() ORDER BY NextAttempt LIMIT %s FOR UPDATE SKIP LOCKED".format(constants.OUTBOX_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(querySelect, (limit,))
+            rows = await cursor.fetchall()
+            if len(rows) == 0:
+                return []
+            queryClaim = "UPDATE {} SET NextAttempt=now() + INTERVAL %s SECOND, Attempts=Attempts+1 WHERE Outboxid IN ({})".format(constants.OUTBOX_TABLE_NAME, ", ".join(["%s" for x in rows]))
+            await cursor.execute(queryClaim, (lease,) + tuple(row[0] for row in rows))
+        return [(outboxid, recipient, token, attempts + 1) for outboxid, recipient, token, attempts in rows]
+
+    async def deleteOutbox(self, outboxid: int):
+        query = "DELETE FROM {} WHERE Outboxid=%s".format(constants.OUTBOX_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (outboxid,))
+
+    async def retryOutbox(self, outboxid: int, delay: int, error: str):
+        query = "UPDATE {} SET NextAttempt=now() + INTERVAL %s SECOND, LastError=%s WHERE Outboxid=%s".format(constants.OUTBOX_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (delay, error, outboxid))
+
+    async def deadLetterOutbox(self, outboxid: int, error: str):
+        query = "UPDATE {} SET Status='dead', LastError=%s WHERE Outboxid=%s".format(constants.OUTBOX_TABLE_NAME)
+        async with self.cursor() as cursor:
+            await cursor.execute(query, (error, outboxid))
+
+metrics.instrument(AsyncDb, metrics.DB_LATENCY)
 
 
 #Driver test
@@ -321,6 +614,7 @@ async def run(loop):
     #await db.createDB()
     #wait db.rebuildTable()
     #await db.rebuildBlacklistTable()
+    #await db.rebuildBlacklistRuleTable()
     #await db.commit()
 
 if __name__ == "__main__":
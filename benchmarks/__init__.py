@@ -0,0 +1,6 @@
+"""
+Offline benchmarks of the bot, run without MySQL, an SMTP server or Discord.
+memorydb.py is an in-memory implementation of the AsyncDb interface, fakesmtp.py a local SMTP server
+which accepts every message and fakediscord.py the contexts, members and roles the cogs work with.
+registration.py drives simulated users through BaseCog, run it with python -m benchmarks.registration --help
+"""
@@ -0,0 +1,83 @@
+"""
+Stand-ins for the discord.py objects the DM cogs use: the command context with its DM channel,
+the guild members with their roles, and a bot holding the controller and the guild index.
+The commands are benchmarked by calling their callbacks directly (e.g. BaseCog.register.callback),
+so the contexts only need the attributes the command bodies read.
+latency delays the role API calls, standing in for the round trip to Discord.
+"""
+import asyncio
+from botcontroller import BotController
+from guildindex import GuildIndex
+import guildconfig
+
+
+class FakeRole:
+    def __init__(self, roleId: int, name: str):
+        self.id = roleId
+        self.name = name
+
+
+class FakeGuild:
+    def __init__(self, guildId: int, name: str, roles: [FakeRole]):
+        self.id = guildId
+        self.name = name
+        self.roles = roles
+        self.members = []
+
+
+class FakeMember:
+    def __init__(self, memberId: int, latency: float = 0):
+        self.id = memberId
+        self.latency = latency
+        self.roles = []
+        self.guild: FakeGuild = None
+
+    async def add_roles(self, *roles: FakeRole):
+        await asyncio.sleep(self.latency)
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles: FakeRole):
+        await asyncio.sleep(self.latency)
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content: str = None, **kwargs):
+        self.messages.append(content)
+
+    @property
+    def lastMessage(self) -> str:
+        return self.messages[-1] if len(self.messages) > 0 else None
+
+
+class FakeContext:
+    def __init__(self, author: FakeMember):
+        self.author = author
+        self.channel = FakeChannel()
+
+    async def send(self, content: str = None, **kwargs):
+        await self.channel.send(content, **kwargs)
+
+
+class FakeBot:
+    """
+    Holds what the cogs read from the bot: the controller and an index of the members and roles
+    of one guild, the first served one (see guildconfig.py)
+    """
+    def __init__(self, controller: BotController):
+        self.controller = controller
+        guildId = guildconfig.guildIds()[0]
+        roles = [FakeRole(i + 1, name) for i, name in enumerate(guildconfig.registeredRoles(guildId))]
+        self.guild = FakeGuild(guildId, "benchmark", roles)
+        self.guildIndex = GuildIndex(self, [guildId])
+        self.guildIndex.build(self.guild)
+
+    def get_guild(self, guildId: int) -> FakeGuild:
+        return self.guild if guildId == self.guild.id else None
+
+    def addMember(self, member: FakeMember):
+        member.guild = self.guild
+        self.guildIndex.memberUpdated(member)
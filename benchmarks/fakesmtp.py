@@ -0,0 +1,119 @@
+"""
+Local SMTP server accepting every message, for benchmarking the email path without a mail provider.
+It speaks the plain-text subset of SMTP which aiosmtplib uses (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT,
+DATA, NOOP, RSET, QUIT), accepts any credentials and keeps the received messages in inbox.
+Point SMTP_HOST/SMTP_PORT at it with SMTP_USE_TLS set to False. latency delays the reply to DATA,
+standing in for the provider's processing time.
+"""
+import asyncio
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+
+class FakeSmtpServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.server: asyncio.AbstractServer = None
+        #recipient -> last message received for it
+        self.inbox = {}
+        self.received = 0
+        self.receivedEvent = asyncio.Event()
+        self.sessions = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        #port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def waitFor(self, count: int, timeout: float):
+        """
+        Waits until count messages have been received in total
+        """
+        async def wait():
+            while self.received < count:
+                self.receivedEvent.clear()
+                await self.receivedEvent.wait()
+        await asyncio.wait_for(wait(), timeout)
+
+    def deliver(self, recipients: [str], data: bytes):
+        message: EmailMessage = message_from_bytes(data, policy=policy.default)
+        for recipient in recipients:
+            self.inbox[recipient] = message
+        self.received += 1
+        self.receivedEvent.set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.sessions += 1
+        def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+        recipients = []
+        try:
+            reply("220 localhost fake ESMTP")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                command, _, argument = line.decode("latin-1").rstrip("\r\n").partition(" ")
+                command = command.upper()
+                if command == "EHLO":
+                    reply("250-localhost")
+                    reply("250-AUTH PLAIN LOGIN")
+                    reply("250 8BITMIME")
+                elif command == "HELO":
+                    reply("250 localhost")
+                elif command == "AUTH":
+                    mechanism, _, initial = argument.partition(" ")
+                    if mechanism.upper() == "LOGIN":
+                        #username (unless sent with the command), then password
+                        for prompt in ([] if initial else ["334 VXNlcm5hbWU6"]) + ["334 UGFzc3dvcmQ6"]:
+                            reply(prompt)
+                            await writer.drain()
+                            await reader.readline()
+                    elif not initial:
+                        reply("334 ")
+                        await writer.drain()
+                        await reader.readline()
+                    reply("235 2.7.0 Authentication successful")
+                elif command == "MAIL":
+                    recipients = []
+                    reply("250 OK")
+                elif command == "RCPT":
+                    recipients.append(argument.partition(":")[2].strip().strip("<>"))
+                    reply("250 OK")
+                elif command == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    lines = []
+                    while True:
+                        dataLine = await reader.readline()
+                        if dataLine in (b".\r\n", b".\n", b""):
+                            break
+                        #dot-stuffing
+                        lines.append(dataLine[1:] if dataLine.startswith(b".") else dataLine)
+                    if self.latency > 0:
+                        await asyncio.sleep(self.latency)
+                    self.deliver(recipients, b"".join(lines))
+                    recipients = []
+                    reply("250 OK queued")
+                elif command in ("NOOP", "RSET"):
+                    reply("250 OK")
+                elif command == "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    reply("502 Command not implemented")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
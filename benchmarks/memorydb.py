@@ -0,0 +1,440 @@
+"""
+In-memory implementation of the AsyncDb interface, for benchmarking the controller and the cogs
+without a MySQL server.
+Every MemoryDb shares one MemoryTables instance, transaction() yields an instance which records
+an undo log of its changes, so rollback() restores the tables like a MySQL transaction would.
+Row locks are not modeled, the controller's keyed locks already serialize the commands of one user.
+Every query sleeps for latency seconds (0 just yields to the event loop) to stand in for the round trip,
+and at most poolSize transactions run at once, like with the aiomysql pool.
+The streaming queries (streamBlacklist, streamRecords...) take a round trip per DB_STREAM_BATCH rows,
+like the fetchmany() calls of AsyncDb.streamRows().
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pymysql.err import IntegrityError
+import constants
+from entities.record import Record
+from entities.registerattempt import RegisterAttempt
+from blacklistrules import BlacklistRule, ANY_DOMAIN
+from querybuilder import Where, COLUMNS
+
+#token table column -> Row attribute
+FIELDS = {column: field for field, column in COLUMNS.items()}
+
+
+class Row:
+    __slots__ = ("tokenid", "guildid", "discordid", "email", "token", "time", "_type", "status")
+
+    def __init__(self, tokenid: int, guildid: int, discordid: str, email: str, token: str, time: datetime, _type: str, status: str):
+        self.tokenid = tokenid
+        self.guildid = guildid
+        self.discordid = discordid
+        self.email = email
+        self.token = token
+        self.time = time
+        self._type = _type
+        self.status = status
+
+    def matches(self, predicate: Where) -> bool:
+        for field in predicate.fields:
+            value = predicate.params[field]
+            if field == "discordid":
+                if self.discordid != str(value):
+                    return False
+            elif field == "email":
+                #case-insensitive collation
+                if self.email.lower() != value.lower():
+                    return False
+            elif field == "time":
+                if str(self.time) != value:
+                    return False
+            elif getattr(self, field) != value:
+                return False
+        return True
+
+    def values(self) -> tuple:
+        return (self.discordid, self.email, self.token, self.time, self._type, self.status, self.guildid)
+
+
+class OutboxRow:
+    __slots__ = ("outboxid", "recipient", "token", "status", "attempts", "nextAttempt", "lastError")
+
+    def __init__(self, outboxid: int, recipient: str, token: str):
+        self.outboxid = outboxid
+        self.recipient = recipient
+        self.token = token
+        self.status = "queued"
+        self.attempts = 0
+        self.nextAttempt = datetime.now()
+        self.lastError: str = None
+
+
+class MemoryTables:
+    def __init__(self, poolSize: int = constants.DB_POOL_MAXSIZE):
+        self.rows = {}
+        #(guild id, discord id) -> tokenids, (guild id, lowercased email) -> tokenids
+        self.byDiscordid = {}
+        self.byEmail = {}
+        self.nextTokenid = 1
+        #(guild id, lowercased email) -> email
+        self.blacklist = {}
+        #(guild id, rule) -> BlacklistRule
+        self.rules = {}
+        self.outbox = {}
+        self.nextOutboxid = 1
+        self.connections = asyncio.Semaphore(poolSize)
+
+    def addRow(self, row: Row):
+        self.rows[row.tokenid] = row
+        self.byDiscordid.setdefault((row.guildid, row.discordid), set()).add(row.tokenid)
+        self.byEmail.setdefault((row.guildid, row.email.lower()), set()).add(row.tokenid)
+
+    def removeRow(self, row: Row):
+        del self.rows[row.tokenid]
+        for index, key in ((self.byDiscordid, (row.guildid, row.discordid)), (self.byEmail, (row.guildid, row.email.lower()))):
+            tokenids = index[key]
+            tokenids.discard(row.tokenid)
+            if len(tokenids) == 0:
+                del index[key]
+
+    def rowsOf(self, index: dict, key: tuple) -> [Row]:
+        return [self.rows[tokenid] for tokenid in index.get(key, ())]
+
+    def select(self, predicate: Where) -> [Row]:
+        #use the (Guildid, Discordid) or (Guildid, Email) index if the predicate has one of them
+        guildid = predicate.params.get("guildid")
+        if guildid is not None and "discordid" in predicate.fields:
+            candidates = self.rowsOf(self.byDiscordid, (guildid, str(predicate.params["discordid"])))
+        elif guildid is not None and "email" in predicate.fields:
+            candidates = self.rowsOf(self.byEmail, (guildid, predicate.params["email"].lower()))
+        else:
+            candidates = list(self.rows.values())
+        return [row for row in candidates if row.matches(predicate)]
+
+
+class MemoryDb:
+    def __init__(self, tables: MemoryTables = None, latency: float = 0):
+        self.tables = tables if tables is not None else MemoryTables()
+        self.latency = latency
+        #undo callbacks of the running transaction, None outside of transaction()
+        self.undo: list = None
+
+    async def roundTrip(self):
+        await asyncio.sleep(self.latency)
+
+    def logUndo(self, callback):
+        if self.undo is not None:
+            self.undo.append(callback)
+
+    def insertRow(self, row: Row):
+        self.tables.addRow(row)
+        self.logUndo(lambda: self.tables.removeRow(row))
+
+    def deleteRow(self, row: Row):
+        self.tables.removeRow(row)
+        self.logUndo(lambda: self.tables.addRow(row))
+
+    def updateRow(self, row, field: str, value):
+        old = getattr(row, field)
+        setattr(row, field, value)
+        self.logUndo(lambda: setattr(row, field, old))
+
+    async def close(self):
+        pass
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.tables.connections:
+            db = MemoryDb(self.tables, self.latency)
+            db.undo = []
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            await db.commit()
+
+    async def ping(self):
+        await self.roundTrip()
+
+    async def commit(self):
+        await self.roundTrip()
+        if self.undo is not None:
+            self.undo.clear()
+
+    async def rollback(self):
+        await self.roundTrip()
+        if self.undo is not None:
+            while len(self.undo) > 0:
+                self.undo.pop()()
+
+    #token table
+    async def insertRecord(self, record: Record):
+        await self.roundTrip()
+        self.insertRow(self.newRow(record))
+
+    def newRow(self, record: Record) -> Row:
+        row = Row(self.tables.nextTokenid, record.guildid, str(record.discordid), record.email, record.token, datetime.now(), record._type, "pending")
+        self.tables.nextTokenid += 1
+        return row
+
+    async def registerAttempt(self, record: Record) -> RegisterAttempt:
+        await self.roundTrip()
+        rows = {row.tokenid: row for row in self.tables.rowsOf(self.tables.byDiscordid, (record.guildid, str(record.discordid)))}
+        rows.update((row.tokenid, row) for row in self.tables.rowsOf(self.tables.byEmail, (record.guildid, record.email.lower())))
+
+        attempt = RegisterAttempt()
+        for row in rows.values():
+            if row.discordid == str(record.discordid) and attempt.senderStatus != "registered":
+                attempt.senderStatus = row.status
+            if row.email.lower() == record.email.lower() and attempt.emailStatus != "registered":
+                attempt.emailStatus = row.status
+
+        if "registered" in (attempt.senderStatus, attempt.emailStatus):
+            return attempt
+
+        await self.roundTrip()
+        for row in rows.values():
+            self.deleteRow(row)
+        self.insertRow(self.newRow(record))
+        attempt.inserted = True
+        return attempt
+
+    async def validateToken(self, record: Record, ttl: int = constants.PENDING_TOKEN_TTL) -> str:
+        await self.roundTrip()
+        oldest = datetime.now() - timedelta(seconds=ttl)
+        for row in self.tables.select(Where(guildid=record.guildid, discordid=record.discordid, token=record.token, status="pending")):
+            if row.time > oldest:
+                self.updateRow(row, "status", "registered")
+                return row._type
+        return None
+
+    async def deregisterRecord(self, record: Record) -> str:
+        await self.roundTrip()
+        rows = self.tables.select(Where(guildid=record.guildid, discordid=record.discordid, status="registered"))
+        if len(rows) == 0:
+            return None
+        await self.roundTrip()
+        for row in rows:
+            self.deleteRow(row)
+        return rows[0]._type
+
+    async def isExpired(self, record: Record, ttl: int = constants.PENDING_TOKEN_TTL) -> bool:
+        await self.roundTrip()
+        oldest = datetime.now() - timedelta(seconds=ttl)
+        return any(row.time <= oldest for row in self.tables.select(Where(guildid=record.guildid, discordid=record.discordid, status="pending")))
+
+    async def deleteExpired(self, ttl: int, limit: int) -> int:
+        await self.roundTrip()
+        oldest = datetime.now() - timedelta(seconds=ttl)
+        expired = sorted((row for row in self.tables.rows.values() if row.status == "pending" and row.time <= oldest), key=lambda row: row.time)
+        for row in expired[:limit]:
+            self.deleteRow(row)
+        return len(expired[:limit])
+
+    async def streamRows(self, rows: list):
+        for i in range(0, len(rows), constants.DB_STREAM_BATCH):
+            await self.roundTrip()
+            for row in rows[i:i + constants.DB_STREAM_BATCH]:
+                yield row
+
+    async def streamRecords(self, guildid: int, status: str = None, _type: str = None, since: datetime = None, until: datetime = None,
+        domain: str = None, limit: int = None, offset: int = 0):
+        rows = sorted((row for row in self.tables.rows.values() if row.guildid == guildid
+            and (status is None or row.status == status)
+            and (_type is None or row._type == _type)
+            and (since is None or row.time >= since)
+            and (until is None or row.time < until)
+            and (domain is None or row.email.lower().endswith("@" + domain.lower()))
+            ), key=lambda row: (row.time, row.tokenid))
+        rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+        async for row in self.streamRows(rows):
+            yield Record(discordid=row.discordid, email=row.email, time=row.time, _type=row._type, status=row.status, guildid=guildid)
+
+    async def getRecords(self, predicate: Where):
+        await self.roundTrip()
+        return [row.values() for row in self.tables.select(Where.of(predicate))]
+
+    async def setStatus(self, predicate: Where, status: str):
+        await self.roundTrip()
+        rows = self.tables.select(Where.of(predicate))
+        for row in rows:
+            self.updateRow(row, "status", status)
+        return len(rows)
+
+    async def getStatus(self, predicate: Where) -> str:
+        return await self.probeColumn("Status", predicate)
+
+    async def setRegistered(self, predicate: Where):
+        return await self.setStatus(predicate, "registered")
+
+    async def setPending(self, predicate: Where):
+        return await self.setStatus(predicate, "pending")
+
+    async def isRegistered(self, predicate: Where) -> bool:
+        return (await self.getStatus(predicate)) == "registered"
+
+    async def isPending(self, predicate: Where) -> bool:
+        return (await self.getStatus(predicate)) == "pending"
+
+    async def deleteRecord(self, predicate: Where):
+        await self.roundTrip()
+        rows = self.tables.select(Where.of(predicate))
+        for row in rows:
+            self.deleteRow(row)
+        return len(rows)
+
+    async def exists(self, predicate: Where) -> bool:
+        await self.roundTrip()
+        return len(self.tables.select(Where.of(predicate))) > 0
+
+    async def probeColumn(self, column: str, predicate: Where):
+        await self.roundTrip()
+        rows = self.tables.select(Where.of(predicate))
+        if len(rows) != 1:
+            return None
+        return getattr(rows[0], FIELDS[column])
+
+    async def getToken(self, record: Record):
+        return await self.probeColumn("Token", Where(guildid=record.guildid, discordid=record.discordid))
+
+    async def getRoleForUser(self, record: Record):
+        return await self.probeColumn("Type", Where(guildid=record.guildid, discordid=record.discordid))
+
+    async def userNameExists(self, record: Record) -> bool:
+        return await self.exists(Where(guildid=record.guildid, discordid=record.discordid))
+
+    async def emailExists(self, record: Record) -> bool:
+        return await self.exists(Where(guildid=record.guildid, email=record.email))
+
+    #blacklist
+    def addToBlacklist(self, guildid: int, email: str) -> bool:
+        key = (guildid, email.lower())
+        if key in self.tables.blacklist:
+            return False
+        self.tables.blacklist[key] = email
+        self.logUndo(lambda: self.tables.blacklist.pop(key, None))
+        return True
+
+    async def insertIntoBlacklist(self, guildid: int, *emails: str):
+        await self.roundTrip()
+        for email in emails:
+            if not self.addToBlacklist(guildid, email):
+                raise IntegrityError(1062, "Duplicate entry '{}-{}' for key 'PRIMARY'".format(guildid, email))
+
+    async def insertIgnoreBlacklist(self, guildid: int, emails: [str]) -> int:
+        await self.roundTrip()
+        return sum(1 for email in emails if self.addToBlacklist(guildid, email))
+
+    async def deleteFromBlacklist(self, guildid: int, *emails: str) -> int:
+        await self.roundTrip()
+        cnt = 0
+        for email in emails:
+            key = (guildid, email.lower())
+            old = self.tables.blacklist.pop(key, None)
+            if old is not None:
+                cnt += 1
+                self.logUndo(lambda key=key, old=old: self.tables.blacklist.__setitem__(key, old))
+        return cnt
+
+    async def isInBlacklist(self, guildid: int, email: str) -> bool:
+        await self.roundTrip()
+        return (guildid, email.lower()) in self.tables.blacklist
+
+    async def getBlacklist(self, guildid: int = None) -> [(int, str)]:
+        await self.roundTrip()
+        return sorted((g, email) for (g, key), email in self.tables.blacklist.items() if guildid is None or g == guildid)
+
+    def streamBlacklist(self, guildid: int, prefix: str = None, domain: str = None):
+        emails = sorted((key, email) for (g, key), email in self.tables.blacklist.items() if g == guildid
+            and (prefix is None or key.startswith(prefix.lower()))
+            and (domain is None or key.endswith("@" + domain.lower())))
+        return self.streamRows([(email,) for key, email in emails])
+
+    #blacklist rules
+    def addBlacklistRule(self, guildid: int, rule: BlacklistRule) -> bool:
+        key = (guildid, rule.rule)
+        if key in self.tables.rules:
+            return False
+        self.tables.rules[key] = rule
+        self.logUndo(lambda: self.tables.rules.pop(key, None))
+        return True
+
+    async def insertBlacklistRules(self, guildid: int, *rules: BlacklistRule):
+        await self.roundTrip()
+        for rule in rules:
+            if not self.addBlacklistRule(guildid, rule):
+                raise IntegrityError(1062, "Duplicate entry '{}-{}' for key 'PRIMARY'".format(guildid, rule.rule))
+
+    async def insertIgnoreBlacklistRules(self, guildid: int, rules: [BlacklistRule]) -> int:
+        await self.roundTrip()
+        return sum(1 for rule in rules if self.addBlacklistRule(guildid, rule))
+
+    async def deleteBlacklistRules(self, guildid: int, *rules: BlacklistRule) -> int:
+        await self.roundTrip()
+        cnt = 0
+        for rule in rules:
+            key = (guildid, rule.rule)
+            old = self.tables.rules.pop(key, None)
+            if old is not None:
+                cnt += 1
+                self.logUndo(lambda key=key, old=old: self.tables.rules.__setitem__(key, old))
+        return cnt
+
+    async def getBlacklistRules(self, guildid: int = None, domains: [str] = ()) -> [(int, BlacklistRule)]:
+        await self.roundTrip()
+        rules = [(g, rule) for (g, key), rule in self.tables.rules.items() if guildid is None or g == guildid]
+        if len(domains) > 0:
+            rules = [(g, rule) for g, rule in rules if rule.domain in domains]
+        return sorted(rules, key=lambda item: (item[0], item[1].rule))
+
+    def streamBlacklistRules(self, guildid: int, prefix: str = None, domain: str = None):
+        rules = sorted(rule.rule for (g, key), rule in self.tables.rules.items() if g == guildid
+            and (prefix is None or rule.rule.startswith(prefix.lower()))
+            and (domain is None or rule.domain == domain))
+        return self.streamRows([(rule,) for rule in rules])
+
+    async def getBlacklistRulesFor(self, guildid: int, email: str) -> [BlacklistRule]:
+        domain = email.rpartition("@")[2].lower()
+        parts = domain.split(".")
+        domains = [".".join(parts[i:]) for i in range(len(parts))]
+        domains.append(ANY_DOMAIN)
+        return [rule for g, rule in await self.getBlacklistRules(guildid, domains)]
+
+    #outbox
+    async def enqueueEmail(self, recipient: str, token: str):
+        await self.roundTrip()
+        row = OutboxRow(self.tables.nextOutboxid, recipient, token)
+        self.tables.nextOutboxid += 1
+        self.tables.outbox[row.outboxid] = row
+        self.logUndo(lambda: self.tables.outbox.pop(row.outboxid, None))
+
+    async def claimOutbox(self, limit: int, lease: int) -> [(int, str, str, int)]:
+        await self.roundTrip()
+        now = datetime.now()
+        due = sorted((row for row in self.tables.outbox.values() if row.status == "queued" and row.nextAttempt <= now), key=lambda row: row.nextAttempt)[:limit]
+        for row in due:
+            self.updateRow(row, "nextAttempt", now + timedelta(seconds=lease))
+            self.updateRow(row, "attempts", row.attempts + 1)
+        return [(row.outboxid, row.recipient, row.token, row.attempts) for row in due]
+
+    async def deleteOutbox(self, outboxid: int):
+        await self.roundTrip()
+        row = self.tables.outbox.pop(outboxid, None)
+        if row is not None:
+            self.logUndo(lambda: self.tables.outbox.__setitem__(row.outboxid, row))
+
+    async def retryOutbox(self, outboxid: int, delay: int, error: str):
+        await self.roundTrip()
+        row = self.tables.outbox.get(outboxid)
+        if row is not None:
+            self.updateRow(row, "nextAttempt", datetime.now() + timedelta(seconds=delay))
+            self.updateRow(row, "lastError", error)
+
+    async def deadLetterOutbox(self, outboxid: int, error: str):
+        await self.roundTrip()
+        row = self.tables.outbox.get(outboxid)
+        if row is not None:
+            self.updateRow(row, "status", "dead")
+            self.updateRow(row, "lastError", error)
@@ -0,0 +1,260 @@
+"""
+Benchmark of the register -> validate -> deregister flow.
+Every simulated user is a guild member who DMs the three commands to BaseCog, the commands run against
+the real BotController, circuit breakers, keyed locks, admission gate and blacklist cache, with MemoryDb
+in place of MySQL, FakeSmtpServer in place of the mail provider and fake members in place of Discord.
+The phases run one after the other (all the users register, then validate with the token from the email
+they received, then deregister), each with up to --concurrency users at once.
+The result is printed (or written to --output) as JSON, with ops/sec and p50/p99 latency per command,
+so runs of different versions can be compared.
+
+Usage (from the project root):
+python -m benchmarks.registration --users 5000 --concurrency 1000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import re
+import sys
+import time
+import constants
+import emailhandler
+import guildconfig
+import botcontroller
+from botcontroller import BotController, dbBreaker, emailBreaker
+from blacklistcache import BlacklistCache
+from outbox import Outbox
+from ratelimit import AdmissionGate, RateLimiter
+from cogs.dm.base import BaseCog
+from benchmarks.memorydb import MemoryDb, MemoryTables
+from benchmarks.fakesmtp import FakeSmtpServer
+from benchmarks.fakediscord import FakeBot, FakeContext, FakeMember
+
+#reply of each command when it succeeded
+SUCCESS = {
+    "register": "Email sent!",
+    "validate": "Your account has been successfully validated.",
+    "deregister": "Successfully deregistered.",
+}
+#tokengenerator.getToken() output
+TOKEN = re.compile(r"[A-Za-z0-9_-]{43}")
+#first discord id of the simulated users
+FIRST_ID = 10 ** 17
+#the simulated addresses, user<i>@domain<j>.example, spread over --domains domains
+EMAIL = "user{}@domain{}.example"
+#allowed address pattern during the benchmark, the configured EMAIL_REGEX would reject the simulated addresses
+EMAIL_REGEX = r"^user[0-9]+@domain[0-9]+\.example$"
+
+
+class SimulatedUser:
+    def __init__(self, member: FakeMember, email: str, _type: str):
+        self.member = member
+        self.email = email
+        self._type = _type
+        self.token: str = None
+
+
+class CommandStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.ok = 0
+        self.failed = 0
+        self.seconds = 0.0
+        #users whose command succeeded, they go on to the next phase
+        self.succeeded = []
+
+    @staticmethod
+    def percentile(ordered: [float], q: float) -> float:
+        #nearest rank
+        if len(ordered) == 0:
+            return None
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+    def result(self) -> dict:
+        ordered = sorted(self.latencies)
+        ms = lambda value: None if value is None else round(1000 * value, 3)
+        return {
+            "count": len(ordered),
+            "ok": self.ok,
+            "failed": self.failed,
+            "seconds": round(self.seconds, 3),
+            "opsPerSec": round(len(ordered) / self.seconds, 1) if self.seconds > 0 else None,
+            "meanMs": ms(sum(ordered) / len(ordered)) if len(ordered) > 0 else None,
+            "p50Ms": ms(self.percentile(ordered, 0.5)),
+            "p99Ms": ms(self.percentile(ordered, 0.99)),
+            "maxMs": ms(ordered[-1]) if len(ordered) > 0 else None,
+        }
+
+
+async def runPhase(name: str, users: [SimulatedUser], concurrency: int, command) -> CommandStats:
+    """
+    Runs command(ctx, user) for every user, at most concurrency at once.
+    A command succeeded if its last reply is the command's SUCCESS message.
+    """
+    stats = CommandStats(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user: SimulatedUser) -> bool:
+        async with semaphore:
+            ctx = FakeContext(user.member)
+            start = time.perf_counter()
+            try:
+                await command(ctx, user)
+            finally:
+                stats.latencies.append(time.perf_counter() - start)
+            if ctx.channel.lastMessage == SUCCESS[name]:
+                stats.ok += 1
+                return True
+            stats.failed += 1
+            return False
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(user) for user in users))
+    stats.seconds = time.perf_counter() - start
+    stats.succeeded = [user for user, ok in zip(users, results) if ok]
+    return stats
+
+
+def tokenFromEmail(smtp: FakeSmtpServer, email: str) -> str:
+    message = smtp.inbox.get(email)
+    if message is None:
+        return None
+    match = TOKEN.search(message.get_content())
+    return match.group(0) if match is not None else None
+
+
+async def run(args) -> dict:
+    smtp = FakeSmtpServer(latency=args.smtpLatency)
+    await smtp.start()
+    constants.SMTP_HOST = smtp.host
+    constants.SMTP_PORT = smtp.port
+    constants.SMTP_USE_TLS = False
+    constants.SMTP_USER = "bench"
+    constants.SMTP_PASS = "bench"
+    constants.SMTP_SENT_FROM = "bench@localhost"
+    if args.smtpPool:
+        emailhandler.initPool(size=args.smtpPoolSize)
+    #botcontroller imports EMAIL_REGEX by name, patching constants wouldn't reach it
+    botcontroller.EMAIL_REGEX = EMAIL_REGEX
+
+    db = MemoryDb(MemoryTables(poolSize=args.dbPoolSize), latency=args.dbLatency)
+    #blacklisted addresses on other domains, so the cache lookups aren't answered by an empty set
+    async with db.transaction() as tx:
+        await tx.insertIntoBlacklist(guildconfig.guildIds()[0], *("blocked{}@blocked.example".format(i) for i in range(args.blacklist)))
+    blacklistCache = BlacklistCache(db)
+    await blacklistCache.load()
+    breakers = (dbBreaker(db), emailBreaker())
+    outbox = None
+    if args.outbox:
+        outbox = Outbox(db, workers=args.outboxWorkers, providerRate=args.providerRate, breaker=breakers[1])
+        outbox.start()
+    controller = BotController(db, blacklistCache, outbox, *breakers)
+
+    bot = FakeBot(controller)
+    cog = BaseCog(bot)
+    if not args.rateLimits:
+        unlimited = (10 ** 9, 1)
+        cog.admission.users = RateLimiter(unlimited)
+        cog.admission.domains = RateLimiter(unlimited)
+        cog.admission.globalLimit = RateLimiter(unlimited)
+    cog.admission.gate = AdmissionGate(args.gateConcurrency, queue=args.users)
+
+    users = []
+    for i in range(args.users):
+        member = FakeMember(FIRST_ID + i, latency=args.discordLatency)
+        bot.addMember(member)
+        email = EMAIL.format(i, i % args.domains)
+        roles = guildconfig.registeredRoles(bot.guild.id)
+        users.append(SimulatedUser(member, email, roles[i % len(roles)]))
+
+    commands = {}
+    delivery = None
+    try:
+        registered = await runPhase("register", users, args.concurrency,
+            lambda ctx, user: cog.register.callback(cog, ctx, user._type, user.email))
+        commands["register"] = registered
+
+        if outbox is not None:
+            start = time.perf_counter()
+            try:
+                await smtp.waitFor(registered.ok, args.deliveryTimeout)
+            except asyncio.TimeoutError:
+                pass
+            delivery = {"delivered": smtp.received, "seconds": round(time.perf_counter() - start, 3)}
+
+        for user in registered.succeeded:
+            user.token = tokenFromEmail(smtp, user.email)
+        validated = await runPhase("validate", [user for user in registered.succeeded if user.token is not None], args.concurrency,
+            lambda ctx, user: cog.validate.callback(cog, ctx, user.token))
+        commands["validate"] = validated
+
+        commands["deregister"] = await runPhase("deregister", validated.succeeded, args.concurrency,
+            lambda ctx, user: cog.deregister.callback(cog, ctx))
+    finally:
+        if outbox is not None:
+            outbox.stop()
+        for breaker in breakers:
+            breaker.stop()
+        await emailhandler.closePool()
+        await smtp.stop()
+
+    result = {
+        "benchmark": "registration",
+        "label": args.label,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("label", "output")},
+        "commands": {name: stats.result() for name, stats in commands.items()},
+        "smtp": {"messages": smtp.received, "sessions": smtp.sessions},
+    }
+    if delivery is not None:
+        result["delivery"] = delivery
+    return result
+
+
+def parseArgs(argv: [str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark of the register -> validate -> deregister flow through BaseCog.")
+    parser.add_argument("--users", type=int, default=2000, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=500, help="users running a command at once")
+    parser.add_argument("--domains", type=int, default=20, help="email domains the users are spread over")
+    parser.add_argument("--blacklist", type=int, default=1000, help="blacklisted addresses loaded into the cache")
+    parser.add_argument("--db-latency", dest="dbLatency", type=float, default=0.0005, help="seconds per simulated database round trip")
+    parser.add_argument("--db-pool-size", dest="dbPoolSize", type=int, default=constants.DB_POOL_MAXSIZE, help="transactions running at once")
+    parser.add_argument("--smtp-latency", dest="smtpLatency", type=float, default=0.0, help="seconds the fake SMTP server takes per message")
+    parser.add_argument("--no-smtp-pool", dest="smtpPool", action="store_false", help="connect to the SMTP server for every email")
+    parser.add_argument("--smtp-pool-size", dest="smtpPoolSize", type=int, default=constants.SMTP_POOL_SIZE)
+    parser.add_argument("--outbox", action="store_true", help="queue the emails in the outbox instead of sending them inside register")
+    parser.add_argument("--outbox-workers", dest="outboxWorkers", type=int, default=constants.OUTBOX_WORKERS)
+    parser.add_argument("--provider-rate", dest="providerRate", type=float, default=1000.0, help="outbox emails per second per domain")
+    parser.add_argument("--delivery-timeout", dest="deliveryTimeout", type=float, default=300.0, help="seconds to wait for the outbox to deliver")
+    parser.add_argument("--discord-latency", dest="discordLatency", type=float, default=0.0, help="seconds per simulated role API call")
+    parser.add_argument("--gate-concurrency", dest="gateConcurrency", type=int, default=constants.ADMISSION_CONCURRENCY, help="commands admitted into the controller at once")
+    parser.add_argument("--rate-limits", dest="rateLimits", action="store_true", help="keep the configured per-user, per-domain and global rate limits")
+    parser.add_argument("--label", default=None, help="free-form label stored in the result, e.g. the version")
+    parser.add_argument("--output", default=None, help="write the JSON result to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv: [str] = None) -> int:
+    """
+    Returns the exit status, 1 if a command never succeeded, so a broken run doesn't pass
+    for a benchmark of failures
+    """
+    args = parseArgs(argv)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    failed = [name for name in SUCCESS if result["commands"].get(name, {}).get("ok", 0) == 0]
+    if args.users > 0 and len(failed) > 0:
+        print("No successful {} command, the timings are of failures only.".format("/".join(failed)), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+In-memory copy of the blacklist and blacklist rule tables, so the blacklist check of every register attempt
+doesn't need a database round trip. Every server has its own set of emails and its own RuleTrie
+of rules (see blacklistrules.py).
+The cache is loaded at startup, the controller applies its blacklist changes write-through,
+and a background task periodically reloads the table to pick up edits made outside the bot.
+"""
+import asyncio
+import constants
+from asyncdb import AsyncDb
+from blacklistrules import BlacklistRule, RuleTrie
+from log import getLogger
+
+
+class GuildBlacklist:
+    __slots__ = ("emails", "rules")
+
+    def __init__(self):
+        self.emails = set()
+        self.rules = RuleTrie()
+
+
+class BlacklistCache:
+    def __init__(self, db: AsyncDb, interval: int = constants.BLACKLIST_RESYNC_INTERVAL):
+        self.db = db
+        self.interval = interval
+        #guild id -> GuildBlacklist
+        self.guilds = {}
+        #incremented on every write-through, tells a reload that the cache changed while it was running
+        self.changes = 0
+        self.task: asyncio.Task = None
+
+    @staticmethod
+    def normalize(email: str) -> str:
+        #blacklist_table.Email uses a case-insensitive collation
+        return email.lower()
+
+    async def load(self):
+        changes = self.changes
+        async with self.db.transaction() as db:
+            rows = await db.getBlacklist()
+            ruleRows = await db.getBlacklistRules()
+        if changes != self.changes:
+            #a write-through happened meanwhile, the loaded rows may be older than the cache
+            getLogger(__name__).debug("Blacklist changed during resync, keeping the current cache until the next one.")
+            return
+        guilds = {}
+        for guildid, email in rows:
+            guilds.setdefault(guildid, GuildBlacklist()).emails.add(self.normalize(email))
+        for guildid, rule in ruleRows:
+            guilds.setdefault(guildid, GuildBlacklist()).rules.add(rule)
+        self.guilds = guilds
+
+    def contains(self, guildid: int, email: str) -> bool:
+        blacklist = self.guilds.get(guildid)
+        if blacklist is None:
+            return False
+        return self.normalize(email) in blacklist.emails or blacklist.rules.match(email) is not None
+
+    def add(self, guildid: int, *emails: str, rules: [BlacklistRule] = ()):
+        self.changes += 1
+        blacklist = self.guilds.setdefault(guildid, GuildBlacklist())
+        blacklist.emails.update(self.normalize(e) for e in emails)
+        for rule in rules:
+            blacklist.rules.add(rule)
+
+    def remove(self, guildid: int, *emails: str, rules: [BlacklistRule] = ()):
+        self.changes += 1
+        blacklist = self.guilds.get(guildid)
+        if blacklist is None:
+            return
+        blacklist.emails.difference_update(self.normalize(e) for e in emails)
+        for rule in rules:
+            blacklist.rules.remove(rule)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.resync())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def resync(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.load()
+            except Exception as e:
+                getLogger(__name__).error("Blacklist resync failed: {}".format(e))
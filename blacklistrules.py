@@ -0,0 +1,156 @@
+"""
+Blacklist rules which match more than one exact email address, and the trie they are evaluated with.
+
+Rule syntax (as accepted by the blacklist add command):
+@example.com        domain rule, every address at example.com
+*.example.com       subdomain wildcard, every address at any subdomain of example.com (not example.com itself)
+john*@example.com   local-part pattern (fnmatch syntax, * and ?), addresses at example.com with a matching local part
+john*@*             local-part pattern for any domain
+
+The rules are stored in a trie keyed by the reversed domain labels (com -> example -> mail), so matching
+an address walks one node per label of its domain, no matter how many rules there are. Only the local-part
+patterns attached to the nodes on that path (and the ones for any domain) are evaluated.
+"""
+from fnmatch import fnmatchcase
+
+ANY_DOMAIN = "*"
+
+class BlacklistRule:
+    """
+    Container class used for the blacklist rule table entity
+    """
+    def __init__(self, rule: str, kind: str, domain: str, pattern: str = None):
+        self.rule = rule
+        self.kind = kind
+        self.domain = domain
+        self.pattern = pattern
+
+    def __str__(self):
+        return self.rule
+
+
+def isPattern(s: str) -> bool:
+    return "*" in s or "?" in s
+
+def parseRule(entry: str) -> BlacklistRule:
+    """
+    Returns the rule described by the entry, or None if the entry is a plain email address
+    """
+    rule = entry.strip().lower()
+    if rule.startswith("@"):
+        domain = rule[1:]
+        if domain == "" or isPattern(domain):
+            raise ValueError("Invalid blacklist rule {}".format(entry))
+        return BlacklistRule(rule, "domain", domain)
+    if rule.startswith("*."):
+        domain = rule[2:]
+        if domain == "" or isPattern(domain):
+            raise ValueError("Invalid blacklist rule {}".format(entry))
+        return BlacklistRule(rule, "subdomain", domain)
+    local, at, domain = rule.rpartition("@")
+    if at and (isPattern(local) or domain == ANY_DOMAIN):
+        if local == "" or domain == "" or (domain != ANY_DOMAIN and isPattern(domain)):
+            raise ValueError("Invalid blacklist rule {}".format(entry))
+        return BlacklistRule(rule, "localpart", domain, local)
+    if isPattern(domain):
+        #wildcards in the domain are only allowed as *.example.com, a plain address with them would never match
+        raise ValueError("Invalid blacklist rule {}".format(entry))
+    return None
+
+def labels(domain: str) -> [str]:
+    return domain.split(".")[::-1]
+
+
+class RuleNode:
+    __slots__ = ("children", "domain", "subdomains", "patterns")
+
+    def __init__(self):
+        self.children = {}
+        #rule strings, so removing one of several identical matchers leaves the others in place
+        self.domain = set()
+        self.subdomains = set()
+        #local part pattern -> rule strings
+        self.patterns = {}
+
+
+class RuleTrie:
+    def __init__(self):
+        self.root = RuleNode()
+        self.count = 0
+
+    def node(self, domain: str, create: bool = False) -> RuleNode:
+        node = self.root
+        if domain == ANY_DOMAIN:
+            return node
+        for label in labels(domain):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = RuleNode()
+            node = child
+        return node
+
+    def add(self, rule: BlacklistRule):
+        node = self.node(rule.domain, create=True)
+        if rule.kind == "domain":
+            target = node.domain
+        elif rule.kind == "subdomain":
+            target = node.subdomains
+        else:
+            target = node.patterns.setdefault(rule.pattern, set())
+        if rule.rule not in target:
+            target.add(rule.rule)
+            self.count += 1
+
+    def remove(self, rule: BlacklistRule):
+        #emptied nodes are left in place, they are dropped on the next full reload
+        node = self.node(rule.domain)
+        if node is None:
+            return
+        if rule.kind == "domain":
+            target = node.domain
+        elif rule.kind == "subdomain":
+            target = node.subdomains
+        else:
+            target = node.patterns.get(rule.pattern, set())
+        if rule.rule in target:
+            target.discard(rule.rule)
+            self.count -= 1
+            if rule.kind == "localpart" and len(target) == 0:
+                del node.patterns[rule.pattern]
+
+    def match(self, email: str) -> str:
+        """
+        Returns the first rule matching the email address, or None
+        """
+        local, at, domain = email.strip().lower().rpartition("@")
+        if not at:
+            return None
+        node = self.root
+        hit = self.matchPatterns(node, local)
+        if hit is not None:
+            return hit
+        path = labels(domain)
+        for i, label in enumerate(path):
+            node = node.children.get(label)
+            if node is None:
+                return None
+            last = i == len(path) - 1
+            if not last and node.subdomains:
+                return next(iter(node.subdomains))
+            if last:
+                if node.domain:
+                    return next(iter(node.domain))
+                return self.matchPatterns(node, local)
+        return None
+
+    @staticmethod
+    def matchPatterns(node: RuleNode, local: str) -> str:
+        for pattern, rules in node.patterns.items():
+            if fnmatchcase(local, pattern):
+                return next(iter(rules))
+        return None
+
+    def __len__(self):
+        return self.count
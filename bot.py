@@ -7,20 +7,89 @@ import discord
 from discord.ext import commands
 import constants
 import asyncio
+import os
+import time
 from asyncdb import AsyncDb
-from botcontroller import BotController
+import migrations
+import emailhandler
+from botcontroller import BotController, dbBreaker, emailBreaker
+from blacklistcache import BlacklistCache
+from guildindex import GuildIndex
+from outbox import Outbox
+from sweeper import ExpirySweeper
+from coordination import LockSession
+from log import getLogger
+import metrics
+import guildconfig
 import cogs.dm.base as base
 import cogs.dm.dev as dev
 
 
+def shardConfig() -> (int, [int]):
+    """
+    SHARD_COUNT and SHARD_IDS, overridden by the BOT_SHARD_COUNT and BOT_SHARD_IDS ("0,1") environment variables
+    """
+    shardCount = constants.SHARD_COUNT
+    shardIds = constants.SHARD_IDS
+    if os.environ.get("BOT_SHARD_COUNT"):
+        shardCount = int(os.environ["BOT_SHARD_COUNT"])
+    if os.environ.get("BOT_SHARD_IDS"):
+        shardIds = [int(x) for x in os.environ["BOT_SHARD_IDS"].split(",")]
+    return shardCount, shardIds
+
+def metricsPort() -> int:
+    """
+    METRICS_PORT, overridden by the BOT_METRICS_PORT environment variable, so shard processes
+    sharing a host each serve their metrics on their own port
+    """
+    if os.environ.get("BOT_METRICS_PORT"):
+        return int(os.environ["BOT_METRICS_PORT"])
+    return constants.METRICS_PORT
+
 async def run(loop):
     """
     Main coroutine that is being ran when the program starts
     """
     db = AsyncDb(loop)
-    await db.initConnection()
-    controller = BotController(db)
-    bot = Bot(command_prefix=constants.BOT_COMMAND_PREFIX, description=constants.BOT_DESC, controller=controller)
+    if constants.DB_POOLED:
+        await db.initPool()
+    else:
+        await db.initConnection()
+    lockSession = None
+    if constants.DB_LOCKS:
+        lockSession = LockSession(loop)
+        await lockSession.connect()
+        #processes starting together apply the migrations one at a time, the later ones find them applied
+        async with lockSession.acquire("migrations", timeout=constants.DB_MIGRATION_LOCK_TIMEOUT):
+            async with db.transaction() as conn:
+                await migrations.checkVersion(conn)
+    else:
+        async with db.transaction() as conn:
+            await migrations.checkVersion(conn)
+    if constants.SMTP_POOLED:
+        emailhandler.initPool()
+    blacklistCache = BlacklistCache(db)
+    await blacklistCache.load()
+    blacklistCache.start()
+    breakers = (dbBreaker(db), emailBreaker())
+    outbox = None
+    if constants.EMAIL_OUTBOX:
+        outbox = Outbox(db, breaker=breakers[1])
+        outbox.start()
+    controller = BotController(db, blacklistCache, outbox, *breakers, lockSession=lockSession)
+    sweeper = ExpirySweeper(db, lockSession=lockSession)
+    sweeper.start()
+    metricsServer = None
+    if constants.METRICS_ENABLED:
+        metricsServer = metrics.MetricsServer(constants.METRICS_HOST, metricsPort())
+        try:
+            await metricsServer.start()
+        except OSError as e:
+            #e.g. the port is taken by another process, the bot runs without the endpoint
+            getLogger(__name__).error("Metrics endpoint not started: {}".format(e))
+            metricsServer = None
+    shardCount, shardIds = shardConfig()
+    bot = Bot(command_prefix=constants.BOT_COMMAND_PREFIX, description=constants.BOT_DESC, controller=controller, shard_count=shardCount, shard_ids=shardIds)
 
     bot.add_cog(base.BaseCog(bot))
     bot.add_cog(dev.DevCog(bot))
@@ -28,22 +97,87 @@ async def run(loop):
         await bot.start(constants.TOKEN)
     except KeyboardInterrupt:
         await bot.logout()
+    finally:
+        blacklistCache.stop()
+        sweeper.stop()
+        if metricsServer is not None:
+            await metricsServer.stop()
+        for breaker in breakers:
+            breaker.stop()
+        if outbox is not None:
+            outbox.stop()
+        await emailhandler.closePool()
+        if lockSession is not None:
+            await lockSession.close()
+        await db.close()
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     """
-    Subclass of commands.Bot class which is modified so it can accept
+    Subclass of commands.AutoShardedBot class which is modified so it can accept
     our controller and store it inside the property variable.
     Later, after adding cogs to this bot class we can reference the controller inside the cog class.
+    The bot also keeps the member and role index of the served guilds (see guildindex.py) current.
     """
     def __init__(self, **kwargs):
         super().__init__(
             command_prefix = kwargs.pop("command_prefix"),
-            description = kwargs.pop("description")
+            description = kwargs.pop("description"),
+            shard_count = kwargs.pop("shard_count", None),
+            shard_ids = kwargs.pop("shard_ids", None)
         )
         self.controller = kwargs.pop("controller")
+        self.guildIndex = GuildIndex(self, guildconfig.guildIds())
 
     async def on_ready(self):
-        print(f"\nLogged in as: {self.user.name} - {self.user.id}\n")
+        for guild in self.guilds:
+            self.guildIndex.build(guild)
+        print(f"\nLogged in as: {self.user.name} - {self.user.id}, shards {self.shard_ids} of {self.shard_count}\n")
+
+    async def on_command(self, ctx):
+        ctx.startTime = time.perf_counter()
+
+    async def on_command_completion(self, ctx):
+        latency = time.perf_counter() - ctx.startTime
+        metrics.COMMAND_LATENCY.observe(latency, command=ctx.command.qualified_name, outcome="ok")
+        getLogger(__name__).debug("Command {} done in {:.3f}s".format(ctx.command.qualified_name, latency), extra={"command": ctx.command.qualified_name, "latency": round(latency, 4)})
+
+    async def on_command_error(self, ctx, error):
+        if ctx.command is not None and hasattr(ctx, "startTime"):
+            metrics.COMMAND_LATENCY.observe(time.perf_counter() - ctx.startTime, command=ctx.command.qualified_name, outcome="error")
+        await super().on_command_error(ctx, error)
+
+    async def on_guild_available(self, guild):
+        self.guildIndex.build(guild)
+
+    async def on_guild_join(self, guild):
+        self.guildIndex.build(guild)
+
+    async def on_guild_unavailable(self, guild):
+        self.guildIndex.remove(guild)
+
+    async def on_guild_remove(self, guild):
+        self.guildIndex.remove(guild)
+
+    async def on_guild_update(self, before, after):
+        self.guildIndex.rolesChanged(after)
+
+    async def on_member_join(self, member):
+        self.guildIndex.memberUpdated(member)
+
+    async def on_member_update(self, before, after):
+        self.guildIndex.memberUpdated(after)
+
+    async def on_member_remove(self, member):
+        self.guildIndex.memberRemoved(member)
+
+    async def on_guild_role_create(self, role):
+        self.guildIndex.rolesChanged(role.guild)
+
+    async def on_guild_role_update(self, before, after):
+        self.guildIndex.rolesChanged(after.guild)
+
+    async def on_guild_role_delete(self, role):
+        self.guildIndex.rolesChanged(role.guild)
 
 loop = asyncio.get_event_loop()
 loop.run_until_complete(run(loop))
\ No newline at end of file
@@ -5,11 +5,22 @@ The main part of the controller is the database instance property.
 """
 import emailhandler
 from entities.record import Record
+from entities.blacklistimport import BlacklistImport
 import asyncdb
+from blacklistcache import BlacklistCache
+from blacklistrules import BlacklistRule, RuleTrie, parseRule
+from outbox import Outbox
+from circuitbreaker import CircuitBreaker, CircuitOpenException
+from keylock import KeyedLock
+from coordination import LockSession, LockUnavailableException
+import constants
+from querybuilder import Where
 import aiosmtplib
 import tokengenerator
 import re
-from pymysql.err import IntegrityError
+import asyncio
+from contextlib import asynccontextmanager
+from pymysql.err import IntegrityError, InterfaceError, OperationalError
 from constants import EMAIL_REGEX
 from log import getLogger
 
@@ -33,176 +44,364 @@ class UsernameNonExistentException(Exception):
     
 class ValidationException(Exception):
     pass
+class TokenExpiredException(ValidationException):
+    pass
 class DeregisterException(Exception):
     pass
 class BlacklistException(Exception):
     pass
 class EmailException(Exception):
     pass
+class ServiceUnavailableException(Exception):
+    pass
+
+#Exception types counted as failures of the dependencies by the circuit breakers
+DB_FAILURES = (OperationalError, InterfaceError)
+SMTP_FAILURES = (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError)
+#MySQL client errors of an unreachable server or a lost connection: can't connect, server has gone away,
+#lost connection during query, lost connection at handshake. Row contention (deadlock 1213, lock wait timeout 1205)
+#and the timeouts of the Discord calls made inside a transaction don't tell anything about the server's health.
+DB_CONNECTION_ERRORS = (2003, 2006, 2013, 2055)
+
+def isDbOutage(error: Exception) -> bool:
+    if isinstance(error, InterfaceError):
+        #raised by pymysql for a closed connection
+        return True
+    return len(error.args) > 0 and error.args[0] in DB_CONNECTION_ERRORS
+
+def dbBreaker(db: asyncdb.AsyncDb) -> CircuitBreaker:
+    return CircuitBreaker("MySQL", db.ping, DB_FAILURES, constants.DB_FAILURE_THRESHOLD, constants.DB_RESET_TIMEOUT, isFailure=isDbOutage)
+
+#SMTP errors of an unreachable or misbehaving server. The refusals of a recipient (SMTPRecipientsRefused,
+#5xx replies) depend on the address the user typed, so they don't count.
+SMTP_OUTAGES = (
+    aiosmtplib.SMTPConnectError,
+    aiosmtplib.SMTPServerDisconnected,
+    aiosmtplib.SMTPTimeoutError,
+    aiosmtplib.SMTPAuthenticationError,
+    OSError,
+    asyncio.TimeoutError
+    )
+
+def isSmtpOutage(error: Exception) -> bool:
+    return isinstance(error, SMTP_OUTAGES)
+
+def emailBreaker() -> CircuitBreaker:
+    return CircuitBreaker("SMTP", emailhandler.ping, SMTP_FAILURES, constants.SMTP_FAILURE_THRESHOLD, constants.SMTP_RESET_TIMEOUT, isFailure=isSmtpOutage)
 
 class BotController:
-    def __init__(self, db: asyncdb.AsyncDb):
+    def __init__(self, db: asyncdb.AsyncDb, blacklistCache: BlacklistCache = None, outbox: Outbox = None, dbBreaker: CircuitBreaker = None, emailBreaker: CircuitBreaker = None, lockSession: LockSession = None):
         self.dbInstance = db
+        self.dbBreaker = dbBreaker
+        self.emailBreaker = emailBreaker
+        #serializes register/validate/deregister of the same discord id or email
+        self.locks = KeyedLock()
+        #if set, the same keys are also locked across the processes sharing the database
+        self.lockSession = lockSession
+        #if set, blacklist checks are answered from memory instead of the database
+        self.blacklistCache = blacklistCache
+        #if set, token emails are queued in the outbox instead of being sent inside the register transaction
+        self.outbox = outbox
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Context manager yielding the AsyncDb instance for one transaction, see AsyncDb.transaction().
+        Raises ServiceUnavailableException right away if the database circuit is open.
+        """
+        if self.dbBreaker is None:
+            async with self.dbInstance.transaction() as db:
+                yield db
+            return
+        try:
+            async with self.dbBreaker.guard():
+                async with self.dbInstance.transaction() as db:
+                    yield db
+        except CircuitOpenException as e:
+            raise ServiceUnavailableException(e)
+
+    def locked(self, user: Record):
+        """
+        Context manager holding the locks of the user's discord id and email (if set) in the user's server
+        for its block, register/validate/deregister of the same user or email in a server never interleave
+        """
+        keys = ["discordid:{}:{}".format(user.guildid, user.discordid)]
+        if user.email is not None:
+            keys.append("email:{}:{}".format(user.guildid, user.email.lower()))
+        return self.lockedKeys(*keys)
+
+    @asynccontextmanager
+    async def lockedKeys(self, *keys: str):
+        """
+        Holds the keys' locks in this process and, with a LockSession, across the processes.
+        Raises ServiceUnavailableException if the cross-process locks can't be taken.
+        """
+        async with self.locks.acquire(*keys):
+            if self.lockSession is None:
+                yield
+                return
+            try:
+                async with self.lockSession.acquire(*keys):
+                    yield
+            except LockUnavailableException as e:
+                raise ServiceUnavailableException(e)
+
+    def breakers(self) -> [CircuitBreaker]:
+        return [b for b in (self.dbBreaker, self.emailBreaker) if b is not None]
 
     async def userNameExists(self, user: Record) -> bool:
-        ret = await self.dbInstance.userNameExists(user)
-        await self.dbInstance.commit()
-        return ret
+        async with self.transaction() as db:
+            return await db.userNameExists(user)
 
     async def emailExists(self, user: Record) -> bool:
-        ret = await self.dbInstance.emailExists(user)
-        await self.dbInstance.commit()
-        return ret
+        async with self.transaction() as db:
+            return await db.emailExists(user)
 
-    async def isRegistered(self, user: Record) -> bool:
-        ret = await self.dbInstance.isRegistered(user)
-        await self.dbInstance.commit()
-        return ret
+    async def isRegistered(self, predicate: Where) -> bool:
+        async with self.transaction() as db:
+            return await db.isRegistered(predicate)
 
-    async def isPending(self, user: Record) -> bool:
-        ret = await self.dbInstance.isPending(user)
-        await self.dbInstance.commit()
-        return ret
+    async def isPending(self, predicate: Where) -> bool:
+        async with self.transaction() as db:
+            return await db.isPending(predicate)
 
-    async def setPending(self, user: Record):
-        ret = await self.dbInstance.setPending(user)
-        await self.dbInstance.commit()
-        return ret
+    async def setPending(self, predicate: Where):
+        async with self.transaction() as db:
+            return await db.setPending(predicate)
     
     async def getToken(self, user: Record) -> str:
-        ret = await self.dbInstance.getToken(user)
-        await self.dbInstance.commit()
-        return ret
+        async with self.transaction() as db:
+            return await db.getToken(user)
     
-    async def getRecords(self, record: Record):
-        #Discordid, Email, Token, Time, Type, Status
-        tmp = await self.dbInstance.getRecords(record)
+    async def getRecords(self, predicate: Where):
+        #Discordid, Email, Token, Time, Type, Status, Guildid
+        async with self.transaction() as db:
+            tmp = await db.getRecords(predicate)
         ret = []
         for x in tmp:
-            discordid, email, token, time, _type, status = x
-            r = Record(discordid=discordid, email=email, token=token, time=time, _type=_type, status=status)
+            discordid, email, token, time, _type, status, guildid = x
+            r = Record(discordid=discordid, email=email, token=token, time=time, _type=_type, status=status, guildid=guildid)
             ret.append(r)
-        await self.dbInstance.commit()
         return ret
 
-    async def helperInsertRecord(self, user: Record):
-        token = tokengenerator.getToken()
-        user.token = token
-        await self.dbInstance.insertRecord(user)
+    async def streamRecords(self, guildid: int, **filters):
+        """
+        Async generator of the server's records matching the filters, see AsyncDb.streamRecords().
+        The transaction stays open until the generator is exhausted.
+        """
+        async with self.transaction() as db:
+            async for record in db.streamRecords(guildid, **filters):
+                yield record
+
+    async def helperSendToken(self, user: Record):
         try:
-            await emailhandler.sendToken([user.email], token)
+            if self.emailBreaker is None:
+                await emailhandler.sendToken([user.email], user.token)
+            else:
+                async with self.emailBreaker.guard():
+                    await emailhandler.sendToken([user.email], user.token)
         except Exception as e:
             raise EmailException(e)
     
     async def getRoleForUser(self, user: Record):
-        ret = await self.dbInstance.getRoleForUser(user)
-        await self.dbInstance.commit()
-        return ret
+        async with self.transaction() as db:
+            return await db.getRoleForUser(user)
 
     async def register(self, user: Record):
-        if not (await self.isEmailValid(user.email)):
+        if not (await self.isEmailValid(user.guildid, user.email)):
             raise InvalidEmailException()
         
-        userExists = await self.userNameExists(Record(discordid=user.discordid))
-        emailExists = await self.emailExists(Record(email=user.email))
-        if userExists:
-            isPendingSenderUser = await self.isPending(Record(discordid=user.discordid))
-            strPendingSender = "pending" if isPendingSenderUser else "registered"
-            if emailExists:
-                isPendingEmailUser = await self.isPending(Record(email=user.email))
-                strPendingEmailUser = "pending" if isPendingEmailUser else "registered"
-                if isPendingSenderUser and isPendingEmailUser:
-                    #delete both the record which shares the discord id (and is pending) and the other record which shares the email (and is pending)
-                    await self.dbInstance.deleteRecord(Record(discordid=user.discordid))
-                    await self.dbInstance.deleteRecord(Record(email=user.email))
-                    try:
-                        await self.helperInsertRecord(user)
-                    except EmailException as e:
-                        await self.dbInstance.rollback()
-                        raise e
-                    await self.dbInstance.commit()
-                raise UsernameExistsException(f"Register error: Discord ID {user.discordid} exists, state '{strPendingSender}' | email {user.email} exists, state '{strPendingEmailUser}'",  True, isPendingSenderUser, isPendingEmailUser)
-
-            else: #user exists, but email record doesn't exist
-                if isPendingSenderUser:
-                    await self.dbInstance.deleteRecord(Record(discordid=user.discordid))
-                    try:
-                        await self.helperInsertRecord(user)
-                    except EmailException as e:
-                        await self.dbInstance.rollback()
-                        raise e
-                    await self.dbInstance.commit()
-                raise UsernameExistsException(f"Register error: Discord ID {user.discordid} exists, state '{strPendingSender}' | email {user.email} doesn't exist", False, isPendingSenderUser, None)
-        
-        else: #user doesn't exist
-            isPendingEmailUser = await self.isPending(Record(email=user.email))
-            strPendingEmailUser = "pending" if isPendingEmailUser else "registered"
-            if emailExists:
-                if isPendingEmailUser:
-                    await self.dbInstance.deleteRecord(Record(email=user.email))
-                    try:
-                        await self.helperInsertRecord(user)
-                    except EmailException as e:
-                        await self.dbInstance.rollback()
-                        raise e
-                    await self.dbInstance.commit()
-                raise UsernameNonExistentException(f"Register error: Discord ID {user.discordid} doesn't exists | email {user.email} exists", True, isPendingEmailUser)
-            
-            else: #user doesn't exist, email doesn't exist. Everything is fine
-                try:
-                    await self.helperInsertRecord(user)
-                except EmailException as e:
-                    await self.dbInstance.rollback()
-                    raise e
-                await self.dbInstance.commit()
-
-    async def validate(self, user: Record):
-        if await self.userNameExists(user) and await self.isPending(user):
-            if await self.getToken(user) == user.token:
-                await self.dbInstance.setRegistered(user)
-                return
+        user.token = tokengenerator.getToken()
+        async with self.locked(user):
+            async with self.transaction() as db:
+                attempt = await db.registerAttempt(user)
+                if attempt.inserted:
+                    if self.outbox is not None:
+                        await db.enqueueEmail(user.email, user.token)
+                    else:
+                        #an EmailException leaving the transaction block rolls back the eviction and the insert
+                        await self.helperSendToken(user)
+        if attempt.inserted and self.outbox is not None:
+            self.outbox.notify()
+
+        if attempt.senderExists:
+            strPendingSender = "pending" if attempt.senderPending else "registered"
+            if attempt.emailExists:
+                strPendingEmailUser = "pending" if attempt.emailPending else "registered"
+                raise UsernameExistsException(f"Register error: Discord ID {user.discordid} exists, state '{strPendingSender}' | email {user.email} exists, state '{strPendingEmailUser}'",  True, attempt.senderPending, attempt.emailPending)
+            raise UsernameExistsException(f"Register error: Discord ID {user.discordid} exists, state '{strPendingSender}' | email {user.email} doesn't exist", False, attempt.senderPending, None)
+
+        if attempt.emailExists:
+            raise UsernameNonExistentException(f"Register error: Discord ID {user.discordid} doesn't exists | email {user.email} exists", True, attempt.emailPending)
+
+    async def validate(self, db: asyncdb.AsyncDb, user: Record) -> str:
+        """
+        Runs inside the caller's transaction (see transaction()), the caller commits it
+        only after the role has been given to the user. The caller holds locked(user) around the transaction.
+        Returns the role type the user registered for.
+        """
+        roleName = await db.validateToken(user)
+        if roleName is not None:
+            return roleName
+        #slow path, only taken on failure, to tell the reason
+        if await db.isExpired(user):
+            raise TokenExpiredException("Error: expired token of user {}".format(user.discordid))
+        if await db.isPending(Where(guildid=user.guildid, discordid=user.discordid)):
             raise ValidationException("Error: wrong token by user {}".format(user.discordid))
         raise ValidationException("Error with validating ID {}. User doesn't exist in database or is already in 'registered' state.".format(user.discordid))
 
-    async def isEmailValid(self, email: str) -> bool:
-        check = await self.isInBlacklist(email)
+    async def isEmailValid(self, guildid: int, email: str) -> bool:
+        check = await self.isInBlacklist(guildid, email)
         if check:
-            getLogger(__name__).warning("A blacklisted email {} tried to register.".format(email))
+            getLogger(__name__).warning("A blacklisted email {} tried to register on server {}.".format(email, guildid))
         return re.search(EMAIL_REGEX, email) and not check
 
-    async def deregister(self, user: Record):
-        if await self.userNameExists(user) and await self.isRegistered(user):
-            cnt = await self.dbInstance.deleteRecord(user)
-            if cnt < 1:
-                raise Exception("deregister() error: deleteRecord() database call deleted nothing.")
-        else:
+    async def deregister(self, db: asyncdb.AsyncDb, user: Record) -> str:
+        """
+        Runs inside the caller's transaction (see transaction()), the caller commits it
+        only after the role has been removed from the user. The caller holds locked(user) around the transaction.
+        Returns the role type the user was registered with.
+        """
+        roleName = await db.deregisterRecord(user)
+        if roleName is None:
             raise DeregisterException("User with ID {} isn't registered.".format(user.discordid))
-        
+        return roleName
 
-    async def addToBlacklist(self, *emails: str) -> str:
-        try:
-            await self.dbInstance.insertIntoBlacklist(*emails)
-            await self.dbInstance.commit()
+    @staticmethod
+    def splitBlacklistEntries(entries: [str]) -> ([str], [BlacklistRule]):
+        """
+        Splits blacklist command arguments into plain email addresses and rules (see blacklistrules.py)
+        """
+        emails = []
+        rules = []
+        for entry in entries:
+            try:
+                rule = parseRule(entry)
+            except ValueError as e:
+                raise BlacklistException("Blacklist error: {}".format(e))
+            if rule is None:
+                emails.append(entry)
+            else:
+                rules.append(rule)
+        return emails, rules
+
+    async def addToBlacklist(self, guildid: int, *entries: str) -> str:
+        emails, rules = self.splitBlacklistEntries(entries)
+        async with self.lockedKeys("blacklist:{}".format(guildid)):
+            try:
+                async with self.transaction() as db:
+                    if len(emails) > 0:
+                        await db.insertIntoBlacklist(guildid, *emails)
+                    if len(rules) > 0:
+                        await db.insertBlacklistRules(guildid, *rules)
+
+            except IntegrityError:
+                raise BlacklistException("addToBlacklist() error: email already in blacklist.")
+            if self.blacklistCache is not None:
+                self.blacklistCache.add(guildid, *emails, rules=rules)
 
-        except IntegrityError:
-            raise BlacklistException("addToBlacklist() error: email already in blacklist.")
+    @staticmethod
+    def isBlacklistEmail(entry: str) -> bool:
+        #a plain address, the blacklist column holds up to 255 characters
+        local, at, domain = entry.rpartition("@")
+        return at != "" and local != "" and "." in domain and len(entry) <= 255 and not any(c.isspace() for c in entry)
 
-    async def removeFromBlacklist(self, *emails: str):
-        cnt = await self.dbInstance.deleteFromBlacklist(*emails)
-        await self.dbInstance.commit()
+    async def importBlacklist(self, guildid: int, lines: [str]) -> BlacklistImport:
+        """
+        Bulk blacklist add, one email or rule per line (empty lines and # comments are skipped).
+        The entries are normalized and deduplicated in memory, then inserted BLACKLIST_IMPORT_CHUNK at a time
+        with multi-row INSERT IGNORE, each chunk in its own transaction, so the entries already in the blacklist
+        are counted as duplicates instead of failing the import.
+        """
+        result = BlacklistImport()
+        emails = set()
+        rules = {}
+        for line in lines:
+            entry = line.strip().lower()
+            if entry == "" or entry.startswith("#"):
+                continue
+            try:
+                rule = parseRule(entry)
+                valid = self.isBlacklistEmail(entry) if rule is None else len(rule.rule) <= 255
+            except ValueError:
+                valid = False
+            if not valid:
+                result.invalid += 1
+                if len(result.invalidSamples) < 10:
+                    result.invalidSamples.append(line.strip())
+            elif rule is None:
+                if entry in emails:
+                    result.duplicates += 1
+                emails.add(entry)
+            else:
+                if rule.rule in rules:
+                    result.duplicates += 1
+                rules[rule.rule] = rule
+
+        emails = sorted(emails)
+        rules = list(rules.values())
+        chunk = constants.BLACKLIST_IMPORT_CHUNK
+        async with self.lockedKeys("blacklist:{}".format(guildid)):
+            for i in range(0, len(emails), chunk):
+                async with self.transaction() as db:
+                    result.added += await db.insertIgnoreBlacklist(guildid, emails[i:i + chunk])
+            for i in range(0, len(rules), chunk):
+                async with self.transaction() as db:
+                    result.added += await db.insertIgnoreBlacklistRules(guildid, rules[i:i + chunk])
+            if self.blacklistCache is not None:
+                #the skipped entries are in the blacklist already, so the cache gets all of them
+                self.blacklistCache.add(guildid, *emails, rules=rules)
+        result.duplicates += len(emails) + len(rules) - result.added
+        return result
+
+    async def removeFromBlacklist(self, guildid: int, *entries: str):
+        emails, rules = self.splitBlacklistEntries(entries)
+        cnt = 0
+        async with self.lockedKeys("blacklist:{}".format(guildid)):
+            async with self.transaction() as db:
+                if len(emails) > 0:
+                    cnt += await db.deleteFromBlacklist(guildid, *emails)
+                if len(rules) > 0:
+                    cnt += await db.deleteBlacklistRules(guildid, *rules)
+            if self.blacklistCache is not None:
+                self.blacklistCache.remove(guildid, *emails, rules=rules)
         if cnt < 1:
             raise BlacklistException("removeFromBlacklist() error: removeFromBlacklist() database call deleted nothing.")
 
-    async def getBlacklist(self):
-        ret = await self.dbInstance.getBlacklist()
-        await self.dbInstance.commit()
-        tmp = [e for e, in ret]
+    async def getBlacklist(self, guildid: int):
+        async with self.transaction() as db:
+            ret = await db.getBlacklist(guildid)
+            rules = await db.getBlacklistRules(guildid)
+        tmp = [e for g, e in ret]
+        tmp.extend(rule.rule for g, rule in rules)
         return tmp
 
-    async def isInBlacklist(self, email: str) -> bool:
-        ret = await self.dbInstance.isInBlacklist(email)
-        await self.dbInstance.commit()
-        return ret
+    async def exportBlacklist(self, guildid: int, out, prefix: str = None, domain: str = None) -> int:
+        """
+        Writes the server's blacklisted emails and rules matching the filters into the text file out, one per line,
+        streamed from the database (see AsyncDb.streamBlacklist()). Returns the number of entries written.
+        """
+        cnt = 0
+        async with self.transaction() as db:
+            async for email, in db.streamBlacklist(guildid, prefix, domain):
+                out.write(email + "\n")
+                cnt += 1
+            async for rule, in db.streamBlacklistRules(guildid, prefix, domain):
+                out.write(rule + "\n")
+                cnt += 1
+        return cnt
+
+    async def isInBlacklist(self, guildid: int, email: str) -> bool:
+        if self.blacklistCache is not None:
+            return self.blacklistCache.contains(guildid, email)
+        async with self.transaction() as db:
+            if await db.isInBlacklist(guildid, email):
+                return True
+            rules = await db.getBlacklistRulesFor(guildid, email)
+        trie = RuleTrie()
+        for rule in rules:
+            trie.add(rule)
+        return trie.match(email) is not None
 
 #driver test
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""
+Circuit breaker for the bot's external dependencies (MySQL, SMTP).
+After failureThreshold consecutive failures the breaker opens and every guarded call fails fast
+with CircuitOpenException, instead of waiting for the dependency's connect timeout.
+While open, a background task probes the dependency every resetTimeout seconds (the half-open state),
+the first successful probe closes the breaker again.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from log import getLogger
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, probe, failureTypes: tuple, failureThreshold: int, resetTimeout: float, isFailure=None):
+        """
+        probe is a coroutine function which raises if the dependency is still unavailable,
+        failureTypes are the exception types counted as failures of the dependency,
+        narrowed down by isFailure(exception) if given
+        """
+        self.name = name
+        self.probe = probe
+        self.failureTypes = failureTypes
+        self.isFailure = isFailure
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt: float = None
+        self.lastError: str = None
+        self.probeTask: asyncio.Task = None
+
+    @property
+    def isClosed(self) -> bool:
+        return self.state == CircuitBreaker.CLOSED
+
+    @asynccontextmanager
+    async def guard(self):
+        """
+        Guards the block, raises CircuitOpenException right away if the breaker isn't closed
+        """
+        if not self.isClosed:
+            raise CircuitOpenException("{} circuit is {}: {}".format(self.name, self.state, self.lastError))
+        try:
+            yield
+        except self.failureTypes as e:
+            if self.isFailure is None or self.isFailure(e):
+                self.recordFailure(e)
+            raise
+        self.failures = 0
+
+    def recordFailure(self, error: Exception):
+        self.failures += 1
+        self.lastError = str(error)
+        if self.isClosed and self.failures >= self.failureThreshold:
+            self.trip()
+
+    def trip(self):
+        self.state = CircuitBreaker.OPEN
+        self.openedAt = time.monotonic()
+        getLogger(__name__).error("{} circuit opened after {} failures: {}".format(self.name, self.failures, self.lastError))
+        if self.probeTask is None:
+            self.probeTask = asyncio.ensure_future(self.probeUntilClosed())
+
+    def close(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        getLogger(__name__).warning("{} circuit closed.".format(self.name))
+
+    async def probeUntilClosed(self):
+        try:
+            while not self.isClosed:
+                await asyncio.sleep(self.resetTimeout)
+                self.state = CircuitBreaker.HALF_OPEN
+                try:
+                    await self.probe()
+                except Exception as e:
+                    self.state = CircuitBreaker.OPEN
+                    self.lastError = str(e)
+                    getLogger(__name__).warning("{} circuit probe failed: {}".format(self.name, e))
+                    continue
+                self.close()
+        finally:
+            self.probeTask = None
+
+    def stop(self):
+        if self.probeTask is not None:
+            self.probeTask.cancel()
+
+    def status(self) -> str:
+        if self.isClosed:
+            return "{}: {} ({} recent failures)".format(self.name, self.state, self.failures)
+        return "{}: {} for {:.0f}s, last error: {}".format(self.name, self.state, time.monotonic() - self.openedAt, self.lastError)
@@ -1,5 +1,7 @@
 """COG Class
 Contains commands for the bot, intended to be used by everyone, over DM
+Every command works on one of the servers the user is in, the only one or the one named
+by the optional last argument (see GuildIndex.resolve()).
 """
 import discord
 from discord.ext import commands
@@ -9,18 +11,58 @@ from botcontroller import (
     UsernameExistsException,
     UsernameNonExistentException,
     ValidationException, 
+    TokenExpiredException,
     DeregisterException,
     BlacklistException,
-    EmailException
+    EmailException,
+    ServiceUnavailableException
     )
 from entities.record import Record
 import constants
+import guildconfig
+from guildindex import GuildResolutionException
 from log import getLogger
 from util import getFromListCaseIgnored
+from ratelimit import Admission, RateLimitedException, OverloadedException
+import metrics
+
+SERVICE_UNAVAILABLE_MSG = "The bot is temporarily unable to process commands.\nTry again later or contact {}."
+OVERLOADED_MSG = "The bot is busy right now, try again in a minute."
+SEVERAL_GUILDS_MSG = "You are a member of several servers, add the server name or id at the end of the command: {}"
+NO_GUILD_MSG = "You are not a member of a server where this command can be used."
 
 class BaseCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.admission = Admission()
+
+    async def admit(self, ctx: commands.Context, email: str = None) -> bool:
+        """
+        Charges the command to the rate limits, tells the user and returns False if over budget
+        """
+        try:
+            self.admission.check(ctx.author.id, email)
+            return True
+        except RateLimitedException as e:
+            metrics.COMMAND_REJECTIONS.inc(reason="ratelimit_" + e.scope)
+            getLogger(__name__).warning("{} | user {}".format(e, ctx.author.id))
+            await ctx.channel.send("You are sending commands too fast, try again in {:.0f} seconds.".format(e.retryAfter + 1))
+            return False
+
+    async def resolveGuild(self, ctx: commands.Context, server: str = None, accepts=None) -> (discord.Guild, Member):
+        """
+        The server the command is meant for with the user's member on it, tells the user and returns (None, None)
+        if there is no such server or it's ambiguous
+        """
+        try:
+            return await self.bot.guildIndex.resolve(ctx.author.id, server, accepts=accepts)
+        except GuildResolutionException as e:
+            getLogger(__name__).warning(str(e))
+            if len(e.candidates) > 1:
+                await ctx.channel.send(SEVERAL_GUILDS_MSG.format(", ".join(e.candidates)))
+            else:
+                await ctx.channel.send(NO_GUILD_MSG)
+            return None, None
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         ignored = (commands.errors.PrivateMessageOnly, commands.CommandNotFound, commands.UserInputError)
@@ -30,14 +72,20 @@ class BaseCog(commands.Cog):
     
     @commands.command()
     @commands.dm_only()
-    async def register(self, ctx: commands.Context, _type: str, email: str):
-        _type = getFromListCaseIgnored(_type, constants.REGISTERED_ROLE_NAMES)
-        if _type is None:
+    async def register(self, ctx: commands.Context, _type: str, email: str, *, server: str = None):
+        if getFromListCaseIgnored(_type, guildconfig.allRegisteredRoles()) is None:
             raise commands.errors.BadArgument("Bad register command argument: invalid role name.")
 
-        record = Record(discordid=ctx.author.id, email=email, _type=_type)
+        if not await self.admit(ctx, email):
+            return
+        guild, member = await self.resolveGuild(ctx, server, accepts=lambda g: getFromListCaseIgnored(_type, guildconfig.registeredRoles(g.id)) is not None)
+        if guild is None:
+            return
+        _type = getFromListCaseIgnored(_type, guildconfig.registeredRoles(guild.id))
+        record = Record(guildid=guild.id, discordid=ctx.author.id, email=email, _type=_type)
         try:
-            await self.bot.controller.register(record)
+            async with self.admission.gate.admit():
+                await self.bot.controller.register(record)
             await ctx.channel.send("Email sent!")
 
         except InvalidEmailException as e:
@@ -66,6 +114,15 @@ class BaseCog(commands.Cog):
             getLogger(__name__).warning(str(e))
             await ctx.channel.send("An error occurred while attempting to send the email.\nTry again later or contact {}.".format(constants.ADMIN_USER))
 
+        except ServiceUnavailableException as e:
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(SERVICE_UNAVAILABLE_MSG.format(constants.ADMIN_USER))
+
+        except OverloadedException as e:
+            metrics.COMMAND_REJECTIONS.inc(reason="overloaded")
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(OVERLOADED_MSG)
+
         except Exception as e:
             getLogger(__name__).error(str(e))
             await ctx.channel.send("There is an error with the bot. Contact admin: {}".format(constants.ADMIN_USER))
@@ -74,41 +131,57 @@ class BaseCog(commands.Cog):
     async def register_error_handler(self, ctx, error):
         desc = '''**Usage:**
 ```{style}
-{prefix}register <{roles}> <email>```
+{prefix}register <{roles}> <email> [server]```
 **Example:**
 ```{style}
-{prefix}register {roleeg} johndoe@gmail.com```'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX, roles="/".join(constants.REGISTERED_ROLE_NAMES), roleeg=constants.REGISTERED_ROLE_NAMES[0])
+{prefix}register {roleeg} johndoe@gmail.com```'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX, roles="/".join(guildconfig.allRegisteredRoles()), roleeg=guildconfig.allRegisteredRoles()[0])
         await ctx.send(desc)
 
 
     @commands.command()
     @commands.dm_only()
-    async def validate(self, ctx: commands.Context, token: str):
-        record = Record(discordid=ctx.author.id, token=token)
+    async def validate(self, ctx: commands.Context, token: str, *, server: str = None):
+        if not await self.admit(ctx):
+            return
+        guild, member = await self.resolveGuild(ctx, server)
+        if guild is None:
+            return
+        record = Record(guildid=guild.id, discordid=ctx.author.id, token=token)
         try:
-            guild = self.bot.get_guild(constants.SERVERID)
-            member = discord.utils.get(guild.members, id=ctx.author.id)
-            roleName = await self.bot.controller.getRoleForUser(Record(discordid=ctx.author.id))
-            role = discord.utils.get(guild.roles, name=roleName)
-
-            await self.bot.controller.validate(record)
-            try:
-                await member.add_roles(role)
-                await ctx.channel.send("Your account has been successfully validated.")
-                await self.bot.controller.dbInstance.commit()
-            except discord.errors.Forbidden:
-                await self.bot.controller.dbInstance.rollback()
-                await ctx.channel.send("Unable to validate because the bot doesn't have sufficient permissions to give roles. Contact: {}".format(constants.ADMIN_USER))
+            async with self.admission.gate.admit(), self.bot.controller.locked(record):
+                async with self.bot.controller.transaction() as db:
+                    roleName = await self.bot.controller.validate(db, record)
+                    role = self.bot.guildIndex.getRole(guild.id, roleName)
+                    try:
+                        async with metrics.timed(metrics.DISCORD_LATENCY, call="add_roles"):
+                            await member.add_roles(role)
+                        await ctx.channel.send("Your account has been successfully validated.")
+                    except discord.errors.Forbidden:
+                        await db.rollback()
+                        await ctx.channel.send("Unable to validate because the bot doesn't have sufficient permissions to give roles. Contact: {}".format(constants.ADMIN_USER))
+
+        except TokenExpiredException as e:
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send("Your token has expired, register again to get a new one.")
 
         except ValidationException as e:
             getLogger(__name__).error(str(e))
             await ctx.channel.send("Validation failed.")
 
+        except ServiceUnavailableException as e:
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(SERVICE_UNAVAILABLE_MSG.format(constants.ADMIN_USER))
+
+        except OverloadedException as e:
+            metrics.COMMAND_REJECTIONS.inc(reason="overloaded")
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(OVERLOADED_MSG)
+
     @validate.error
     async def validate_error_handler(self, ctx: commands.Context, error):
         desc = '''**Usage:**
 ```{style}
-{prefix}validate <TOKEN>```
+{prefix}validate <TOKEN> [server]```
 **Example:**
 ```{style}
 {prefix}validate 123456789abcdefgh```'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX)
@@ -117,27 +190,39 @@ class BaseCog(commands.Cog):
 
     @commands.command()
     @commands.dm_only()
-    async def deregister(self, ctx: commands.Context):
-        record = Record(discordid=ctx.author.id)
+    async def deregister(self, ctx: commands.Context, *, server: str = None):
+        if not await self.admit(ctx):
+            return
+        guild, member = await self.resolveGuild(ctx, server)
+        if guild is None:
+            return
+        record = Record(guildid=guild.id, discordid=ctx.author.id)
 
         try:
-            guild = self.bot.get_guild(constants.SERVERID)
-            member = discord.utils.get(guild.members, id=ctx.author.id)
-            roleName = await self.bot.controller.getRoleForUser(Record(discordid=ctx.author.id))
-            role = discord.utils.get(guild.roles, name=roleName.lower() if roleName is not None else None)
-
-            await self.bot.controller.deregister(record)
-            try:
-                await member.remove_roles(role)
-                await ctx.channel.send("Successfully deregistered.")
-                await self.bot.controller.dbInstance.commit()
-            except discord.errors.Forbidden:
-                await self.bot.controller.dbInstance.rollback()
-                await ctx.channel.send("Unable to deregister because the bot doesn't have sufficient permissions to give roles. Contact: {}".format(constants.ADMIN_USER))
+            async with self.admission.gate.admit(), self.bot.controller.locked(record):
+                async with self.bot.controller.transaction() as db:
+                    roleName = await self.bot.controller.deregister(db, record)
+                    role = self.bot.guildIndex.getRole(guild.id, roleName.lower())
+                    try:
+                        async with metrics.timed(metrics.DISCORD_LATENCY, call="remove_roles"):
+                            await member.remove_roles(role)
+                        await ctx.channel.send("Successfully deregistered.")
+                    except discord.errors.Forbidden:
+                        await db.rollback()
+                        await ctx.channel.send("Unable to deregister because the bot doesn't have sufficient permissions to give roles. Contact: {}".format(constants.ADMIN_USER))
 
         except DeregisterException as e:
             getLogger(__name__).warning(str(e))
             await ctx.channel.send("Your Discord ID has not been registered.")
+
+        except ServiceUnavailableException as e:
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(SERVICE_UNAVAILABLE_MSG.format(constants.ADMIN_USER))
+
+        except OverloadedException as e:
+            metrics.COMMAND_REJECTIONS.inc(reason="overloaded")
+            getLogger(__name__).warning(str(e))
+            await ctx.channel.send(OVERLOADED_MSG)
         
         except Exception as e:
             getLogger(__name__).error(str(e))
@@ -147,7 +232,7 @@ class BaseCog(commands.Cog):
     async def deregister_error_handler(self, ctx: commands.Context, error):
         desc = '''**Usage:**
 ```{style}
-{prefix}deregister```'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX)
+{prefix}deregister [server]```'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX)
         await ctx.send(desc)
 
 def setup(bot):
@@ -1,16 +1,47 @@
 """COG Class
 Contains commands for the bot, intended to be used by privileged users,
-defined in the list DEVELOPER_ROLE_NAMES in constants.py
+defined in the list DEVELOPER_ROLE_NAMES in constants.py (or the server's "developerRoles" in GUILDS).
+The commands working on one server (blacklist, records, postasbot, postasbotdesc) run on the only server
+the user is a developer of, or on the one picked with a guild=<server id> first argument.
 """
+import csv
+import gzip
+import io
+import time
+from datetime import datetime
 import discord
 from discord.ext import commands
 import constants
+import guildconfig
+from guildindex import GuildResolutionException
 from botcontroller import BlacklistException
 from log import getLogger
+import metrics
+import querystats
+from profiler import Profiler, ProfileBusyException
+
+GUILD_ARG = "guild="
 
 class DevCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.profiler = Profiler()
+
+    async def sendLines(self, ctx: commands.Context, lines: [str]):
+        """
+        Sends the lines in code blocks, split to fit the message length limit
+        """
+        data = []
+        lenSum = 0
+        for line in lines:
+            lenSum += len(line)
+            data.append(line)
+            if lenSum > 1600:
+                await ctx.channel.send("```{}\n{}```".format(constants.CODE_STYLE, "\n".join(data)))
+                data = []
+                lenSum = 0
+        if len(data) > 0:
+            await ctx.channel.send("```{}\n{}```".format(constants.CODE_STYLE, "\n".join(data)))
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         ignored = (commands.errors.PrivateMessageOnly, commands.CommandNotFound, commands.UserInputError)
@@ -19,20 +50,70 @@ class DevCog(commands.Cog):
             return
 
     async def cog_check(self, ctx: commands.Context):
-        guild = self.bot.get_guild(constants.SERVERID)
-        member = discord.utils.get(guild.members, id=ctx.author.id)
-        roles = []
-        for role in constants.DEVELOPER_ROLE_NAMES:
-            tmp = discord.utils.get(guild.roles, name=role)
-            if tmp is not None:
-                roles.append(tmp)
-        if member is None or len(roles) == 0:
+        return await self.bot.guildIndex.isDeveloper(ctx.author.id)
+
+    @staticmethod
+    def splitGuildArg(args: tuple) -> (str, tuple):
+        """
+        Splits off the optional guild=<server> first argument
+        """
+        if len(args) > 0 and args[0].startswith(GUILD_ARG):
+            return args[0][len(GUILD_ARG):], args[1:]
+        return None, args
+
+    @staticmethod
+    def parseOptions(args: tuple, names: [str]) -> dict:
+        """
+        Parses name=value arguments, returns None if an argument isn't one of names
+        """
+        options = {}
+        for arg in args:
+            name, sep, value = arg.partition("=")
+            if sep == "" or name not in names or value == "":
+                return None
+            options[name] = value
+        return options
+
+    async def sendFile(self, ctx: commands.Context, data: bytes, filename: str) -> bool:
+        """
+        Uploads data as an attachment, tells the user and returns False if it's over ATTACHMENT_MAX_BYTES
+        """
+        if len(data) > constants.ATTACHMENT_MAX_BYTES:
+            await ctx.channel.send("The file is {:.1f} MB, over the {:.0f} MB upload limit. Narrow it down with the filters.".format(
+                len(data) / 2 ** 20, constants.ATTACHMENT_MAX_BYTES / 2 ** 20))
             return False
-        for memberRole in member.roles:
-            for role in roles:
-                if memberRole == role:
-                    return True
-        return False
+        await ctx.channel.send(file=discord.File(io.BytesIO(data), filename=filename))
+        return True
+
+    @staticmethod
+    async def readAttachment(attachment: discord.Attachment, maxBytes: int) -> str:
+        """
+        The attachment's text, gunzipped if it's gzipped. Raises ValueError if it's larger than maxBytes.
+        """
+        if attachment.size > maxBytes:
+            raise ValueError("The file is larger than {:.0f} MB.".format(maxBytes / 2 ** 20))
+        data = await attachment.read()
+        if data[:2] == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+                data = f.read(maxBytes + 1)
+            if len(data) > maxBytes:
+                raise ValueError("The decompressed file is larger than {:.0f} MB.".format(maxBytes / 2 ** 20))
+        return data.decode("utf-8", errors="replace")
+
+    async def devGuild(self, ctx: commands.Context, hint: str = None) -> discord.Guild:
+        """
+        The server the command works on, tells the user and returns None if there is no such server or it's ambiguous
+        """
+        try:
+            guild, member = await self.bot.guildIndex.resolve(ctx.author.id, hint, developer=True)
+            return guild
+        except GuildResolutionException as e:
+            getLogger(__name__).warning(str(e))
+            if len(e.candidates) > 1:
+                await ctx.channel.send("You are a developer on several servers, start the command with {}<server id>: {}".format(GUILD_ARG, ", ".join(e.candidates)))
+            else:
+                await ctx.channel.send("No server {} found.".format(hint))
+            return None
 
 
     @commands.command(pass_context=True)
@@ -44,14 +125,24 @@ class DevCog(commands.Cog):
     @commands.command(pass_context=True)
     @commands.dm_only()
     async def postasbot(self, ctx: commands.Context, *, msg: str):
-        guild = self.bot.get_guild(constants.SERVERID)
-        botChannel = discord.utils.get(guild.channels, name=constants.BOT_CHANNEL)
+        hint = None
+        if msg.startswith(GUILD_ARG):
+            hint, _, msg = msg.partition(" ")
+            hint = hint[len(GUILD_ARG):]
+        guild = await self.devGuild(ctx, hint)
+        if guild is None:
+            return
+        botChannel = await self.bot.guildIndex.getChannel(guild.id, guildconfig.botChannel(guild.id))
         await botChannel.send(msg)
 
 
     @commands.command(pass_context=True)
     @commands.dm_only()
-    async def postasbotdesc(self, ctx: commands.Context):
+    async def postasbotdesc(self, ctx: commands.Context, *args):
+        hint, args = self.splitGuildArg(args)
+        guild = await self.devGuild(ctx, hint)
+        if guild is None:
+            return
         msg = '''**How to complete the registration:**
 Send commands to bot (right click on my name -> Message) over DM.
 Commands are:
@@ -70,62 +161,133 @@ Commands are:
 - PLACEHOLDER
 
 In case of any problems, contact:
-{contact0}'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX, contact0=constants.ADMIN_USER, roles="/".join(constants.REGISTERED_ROLE_NAMES))
-        guild = self.bot.get_guild(constants.SERVERID)
-        botChannel = discord.utils.get(guild.channels, name=constants.BOT_CHANNEL)
+{contact0}'''.format(style=constants.CODE_STYLE, prefix=constants.BOT_COMMAND_PREFIX, contact0=constants.ADMIN_USER, roles="/".join(guildconfig.registeredRoles(guild.id)))
+        botChannel = await self.bot.guildIndex.getChannel(guild.id, guildconfig.botChannel(guild.id))
         await botChannel.send(msg)
 
+    @commands.command(pass_context=True)
+    @commands.dm_only()
+    async def breakers(self, ctx: commands.Context):
+        breakers = self.bot.controller.breakers()
+        if len(breakers) == 0:
+            await ctx.channel.send("No circuit breakers configured.")
+            return
+        await ctx.channel.send("```{}\n{}```".format(constants.CODE_STYLE, "\n".join(b.status() for b in breakers)))
+
+    @commands.command(pass_context=True)
+    @commands.dm_only()
+    async def stats(self, ctx: commands.Context):
+        lines = metrics.summary()
+        if len(lines) == 0:
+            await ctx.channel.send("No metrics recorded yet.")
+            return
+        await self.sendLines(ctx, lines)
+
+    @commands.command(pass_context=True)
+    @commands.dm_only()
+    async def querystats(self, ctx: commands.Context, n: int = 10):
+        n = min(max(n, 1), constants.QUERYSTATS_MAX_TOP)
+        top = querystats.STATS.top(n)
+        if len(top) == 0:
+            await ctx.channel.send("No queries recorded yet.")
+            return
+        lines = []
+        for template, stats in top:
+            lines.append("calls={} total={:.1f}ms avg={:.1f}ms max={:.1f}ms rows returned={} affected={}".format(
+                stats.calls, 1000 * stats.time, 1000 * stats.time / stats.calls, 1000 * stats.maxTime,
+                stats.rowsReturned, stats.rowsAffected))
+            #short enough for a batch of sendLines() to stay under the message length limit
+            lines.append(template[:300])
+            lines.append("")
+        await self.sendLines(ctx, lines)
+
+    @commands.command(pass_context=True)
+    @commands.dm_only()
+    async def profile(self, ctx: commands.Context, seconds: float = 10):
+        seconds = min(max(seconds, 1), constants.PROFILE_MAX_SECONDS)
+        await ctx.channel.send("Profiling for {:.0f} seconds...".format(seconds))
+        try:
+            report = await self.profiler.profile(seconds)
+        except ProfileBusyException as e:
+            await ctx.channel.send(str(e))
+            return
+        getLogger(__name__).info("Profile of {:.1f} seconds taken by {}.".format(report.seconds, ctx.author.id))
+        await self.sendLines(ctx, report.lines(constants.PROFILE_TOP))
+        filename = "profile-{}.prof".format(time.strftime("%Y%m%d-%H%M%S"))
+        await self.sendFile(ctx, report.profileData(), filename)
+
     @commands.command(pass_context=True)
     @commands.dm_only()
     async def blacklist(self, ctx: commands.Context, *args):
         upute = '''**Usage:**
 ```fix
-{prefix}blacklist <cmd> <arg>
+{prefix}blacklist [guild=<server id>] <cmd> <arg>
+
+The server is needed only if you are a developer on more than one.
 
 <cmd>:
-get - print the blacklist
-add <...email(s)> - add one or more emails to the blacklist, separated by space character
-remove <...email(s)> - remove one or more emails from the blacklist, separated by space character
-check <email> - check if the email is in blacklist```'''.format(prefix=constants.BOT_COMMAND_PREFIX)
+get [prefix=<text>] [domain=<domain>] - upload the blacklist as a gzipped text file, one entry per line,
+    optionally only the entries starting with prefix or at domain
+add <...email(s)> - add one or more emails or rules to the blacklist, separated by space character
+add (with an attached file) - add the emails and rules of the file, one per line (a .gz file too),
+    entries already in the blacklist are skipped
+remove <...email(s)> - remove one or more emails or rules from the blacklist, separated by space character
+check <email> - check if the email is in blacklist
+
+Rules:
+@example.com - every email at example.com
+*.example.com - every email at a subdomain of example.com
+john*@example.com - emails at example.com whose name matches the pattern (* and ?)
+john*@* - emails at any domain whose name matches the pattern```'''.format(prefix=constants.BOT_COMMAND_PREFIX)
 
+        hint, args = self.splitGuildArg(args)
         if len(args) == 0:
             await ctx.channel.send(upute)
             return
+        guild = await self.devGuild(ctx, hint)
+        if guild is None:
+            return
 
         if args[0] == "get":
-            if len(args) != 1:
+            filters = self.parseOptions(args[1:], ("prefix", "domain"))
+            if filters is None:
                 await ctx.channel.send(upute)
                 return
-            blacklist = await self.bot.controller.getBlacklist()
-            if len(blacklist) == 0:
-                await ctx.channel.send("Blacklist empty.")
+            if "domain" in filters:
+                filters["domain"] = filters["domain"].lstrip("@").lower()
+            try:
+                #the rows are streamed into the compressed buffer, only the compressed file is held in memory
+                buffer = io.BytesIO()
+                with gzip.open(buffer, "wt", encoding="utf-8") as out:
+                    cnt = await self.bot.controller.exportBlacklist(guild.id, out, **filters)
+            except Exception as e:
+                getLogger(__name__).error(str(e))
+                await ctx.channel.send("There is an error with the bot. Contact admin: {}".format(constants.ADMIN_USER))
+                return
+            if cnt == 0:
+                await ctx.channel.send("Blacklist empty." if len(filters) == 0 else "No blacklist entries match.")
                 return
-            lenSum = 0
-            data = []
-            for row in blacklist:
-                lenSum += len(row)
-                data.append(row)
-                if lenSum > 1600:
-                    await ctx.channel.send("\n".join(data))
-                    data = []
-                    lenSum = 0
-            if len(data) > 0:
-                await ctx.channel.send("\n".join(data))
+            filename = "blacklist-{}-{}.txt.gz".format(guild.id, time.strftime("%Y%m%d-%H%M%S"))
+            if await self.sendFile(ctx, buffer.getvalue(), filename):
+                await ctx.channel.send("{} blacklist entries exported.".format(cnt))
             return
 
         elif args[0] == "add":
+            if len(args) == 1 and len(ctx.message.attachments) == 1:
+                await self.importBlacklist(ctx, guild, ctx.message.attachments[0])
+                return
             if len(args) < 2:
                 await ctx.channel.send(upute)
                 return
 
             newArgs = args[1:]
             try:
-                await self.bot.controller.addToBlacklist(*newArgs)
+                await self.bot.controller.addToBlacklist(guild.id, *newArgs)
                 await ctx.channel.send("Emails successfully added to blacklist.")
             
             except BlacklistException as e:
                 getLogger(__name__).error(str(e))
-                await ctx.channel.send("Error: email already in blacklist!")
+                await ctx.channel.send("Error: invalid rule or email already in blacklist!")
 
             except Exception as e:
                 getLogger(__name__).error(str(e))
@@ -139,7 +301,7 @@ check <email> - check if the email is in blacklist```'''.format(prefix=constants
 
             newArgs = args[1:]
             try:
-                await self.bot.controller.removeFromBlacklist(*newArgs)
+                await self.bot.controller.removeFromBlacklist(guild.id, *newArgs)
                 await ctx.channel.send("Emails successfully removed from blacklist.")
 
             except BlacklistException as e:
@@ -157,7 +319,7 @@ check <email> - check if the email is in blacklist```'''.format(prefix=constants
                 return
 
             try:
-                check = await self.bot.controller.isInBlacklist(args[1])
+                check = await self.bot.controller.isInBlacklist(guild.id, args[1])
                 await ctx.channel.send("Email {} {} in blacklist.".format(args[1], "is" if check else "is not"))
 
             except Exception as e:
@@ -165,5 +327,102 @@ check <email> - check if the email is in blacklist```'''.format(prefix=constants
                 await ctx.channel.send("There is an error with the bot. Contact admin: {}".format(constants.ADMIN_USER))
             return
 
+    @commands.command(pass_context=True)
+    @commands.dm_only()
+    async def records(self, ctx: commands.Context, *args):
+        upute = '''**Usage:**
+```fix
+{prefix}records [guild=<server id>] [status=<pending/registered>] [type=<role>] [from=<date>] [to=<date>] [domain=<domain>] [page=<n>] [csv]
+
+Lists the registration records matching the filters, oldest first, {size} per page.
+from and to are dates (2021-03-01) or times (2021-03-01T12:00), from inclusive, to exclusive.
+csv - upload all the matching records as a gzipped CSV file instead of a page```'''.format(prefix=constants.BOT_COMMAND_PREFIX, size=constants.RECORDS_PAGE_SIZE)
+
+        hint, args = self.splitGuildArg(args)
+        asCsv = "csv" in args
+        options = self.parseOptions([a for a in args if a != "csv"], ("status", "type", "from", "to", "domain", "page"))
+        try:
+            if options is None or options.get("status", "pending") not in ("pending", "registered"):
+                raise ValueError()
+            filters = {
+                "status": options.get("status"),
+                "_type": options.get("type"),
+                "since": datetime.fromisoformat(options["from"]) if "from" in options else None,
+                "until": datetime.fromisoformat(options["to"]) if "to" in options else None,
+                "domain": options["domain"].lstrip("@").lower() if "domain" in options else None
+            }
+            page = int(options.get("page", 1))
+            if page < 1:
+                raise ValueError()
+        except ValueError:
+            await ctx.channel.send(upute)
+            return
+        guild = await self.devGuild(ctx, hint)
+        if guild is None:
+            return
+
+        try:
+            if asCsv:
+                await self.sendRecordsCsv(ctx, guild, filters)
+            else:
+                await self.sendRecordsPage(ctx, guild, filters, page)
+        except Exception as e:
+            getLogger(__name__).error(str(e))
+            await ctx.channel.send("There is an error with the bot. Contact admin: {}".format(constants.ADMIN_USER))
+
+    async def sendRecordsPage(self, ctx: commands.Context, guild: discord.Guild, filters: dict, page: int):
+        size = constants.RECORDS_PAGE_SIZE
+        #one row past the page tells whether there is a next one
+        records = [r async for r in self.bot.controller.streamRecords(guild.id, limit=size + 1, offset=(page - 1) * size, **filters)]
+        if len(records) == 0:
+            await ctx.channel.send("No records match." if page == 1 else "No records on page {}.".format(page))
+            return
+        #Status and Type are nullable, None has no width format
+        lines = ["{:%Y-%m-%d %H:%M}  {:10}  {:12}  {:20}  {}".format(r.time, r.status or "", r._type or "", str(r.discordid), r.email) for r in records[:size]]
+        await self.sendLines(ctx, ["page {}".format(page)] + lines)
+        if len(records) > size:
+            await ctx.channel.send("More records on the next page, add page={} to the command.".format(page + 1))
+
+    async def sendRecordsCsv(self, ctx: commands.Context, guild: discord.Guild, filters: dict):
+        #the records are streamed into the compressed buffer, only the compressed file is held in memory
+        buffer = io.BytesIO()
+        cnt = 0
+        with gzip.open(buffer, "wt", encoding="utf-8", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(("time", "status", "type", "discordid", "email"))
+            async for r in self.bot.controller.streamRecords(guild.id, **filters):
+                writer.writerow((r.time.isoformat(sep=" "), r.status, r._type, r.discordid, r.email))
+                cnt += 1
+        if cnt == 0:
+            await ctx.channel.send("No records match.")
+            return
+        filename = "records-{}-{}.csv.gz".format(guild.id, time.strftime("%Y%m%d-%H%M%S"))
+        if await self.sendFile(ctx, buffer.getvalue(), filename):
+            await ctx.channel.send("{} records exported.".format(cnt))
+
+    async def importBlacklist(self, ctx: commands.Context, guild: discord.Guild, attachment: discord.Attachment):
+        try:
+            text = await self.readAttachment(attachment, constants.BLACKLIST_IMPORT_MAX_BYTES)
+        except ValueError as e:
+            await ctx.channel.send("Import failed: {}".format(e))
+            return
+        except discord.HTTPException as e:
+            getLogger(__name__).error(str(e))
+            await ctx.channel.send("Import failed: the file couldn't be downloaded.")
+            return
+        start = time.perf_counter()
+        try:
+            result = await self.bot.controller.importBlacklist(guild.id, text.splitlines())
+        except Exception as e:
+            getLogger(__name__).error(str(e))
+            await ctx.channel.send("There is an error with the bot. Contact admin: {}".format(constants.ADMIN_USER))
+            return
+        getLogger(__name__).info("Blacklist import of {} into server {} by {}: {}".format(attachment.filename, guild.id, ctx.author.id, result))
+        msg = "Blacklist import done in {:.1f} s: {} added, {} duplicates, {} invalid.".format(
+            time.perf_counter() - start, result.added, result.duplicates, result.invalid)
+        if len(result.invalidSamples) > 0:
+            msg += "\nInvalid entries (first {}):\n```{}\n{}```".format(len(result.invalidSamples), constants.CODE_STYLE, "\n".join(e[:100] for e in result.invalidSamples))
+        await ctx.channel.send(msg)
+
 def setup(bot):
     bot.add_cog(DevCog(bot))
\ No newline at end of file
@@ -33,6 +33,34 @@ REGISTERED_ROLE_NAMES = ["Registered1", "Registered2"]
 #Enables these users to use dev COG commands.
 DEVELOPER_ROLE_NAMES = ["Developer", "Admin"]
 
+#Servers served by the bot, of INT type keys: guild id -> dict of the settings of that server,
+#"roles" (instead of REGISTERED_ROLE_NAMES), "developerRoles" (instead of DEVELOPER_ROLE_NAMES)
+#and "botChannel" (instead of BOT_CHANNEL), e.g. {123: {"roles": ["Student"]}, 456: {}}.
+#Registrations and blacklists are kept per server. If empty, the bot serves only SERVERID.
+GUILDS = {}
+#Seconds for which the roles of a server handled by another shard process are cached (see guildindex.py)
+REMOTE_GUILD_TTL = 300
+
+#Sharding, the bot runs as an AutoShardedBot. SHARD_COUNT is the total number of shards (None lets Discord
+#recommend it) and SHARD_IDS the shards run by this process (None runs all of them). To split the shards
+#over several processes sharing one database, set SHARD_COUNT and give every process its own SHARD_IDS,
+#e.g. with the BOT_SHARD_COUNT and BOT_SHARD_IDS ("0,1") environment variables, which override these.
+#Discord delivers the DMs to shard 0, its process answers the DM commands of every server.
+SHARD_COUNT = None
+SHARD_IDS = None
+
+#Rate limits of the DM commands (see ratelimit.py), (count, seconds) means bursts of up to count commands
+#and count commands per seconds on average. RATE_LIMIT_USER applies to every command of one user,
+#RATE_LIMIT_DOMAIN (per email domain) and RATE_LIMIT_GLOBAL to the register commands, which send emails.
+#Buckets idle for RATE_LIMIT_IDLE seconds are evicted.
+RATE_LIMIT_USER = (5, 60)
+RATE_LIMIT_DOMAIN = (30, 60)
+RATE_LIMIT_GLOBAL = (120, 60)
+RATE_LIMIT_IDLE = 600
+#Max number of commands processed at once, and of commands waiting for their turn before new ones are rejected
+ADMISSION_CONCURRENCY = 50
+ADMISSION_QUEUE = 200
+
 #Bot description
 BOT_DESC = "Eliminator bot"
 
@@ -52,6 +80,56 @@ DB_NAME = ""
 TABLE_NAME = "token_table"
 #Blacklist table name
 BLACKLIST_TABLE_NAME = "blacklist_table"
+#Blacklist rule table name, domain, subdomain wildcard and local-part pattern rules (see blacklistrules.py)
+BLACKLIST_RULE_TABLE_NAME = "blacklist_rule_table"
+#Interval in seconds, of INT type, of reloading the in-memory blacklist copy from the database.
+#Edits of the blacklist table made outside the bot are picked up after at most this long.
+BLACKLIST_RESYNC_INTERVAL = 300
+#Seconds after which a pending registration token expires and can't be validated anymore, of INT type.
+#Expired records are deleted every SWEEP_INTERVAL seconds, SWEEP_BATCH_SIZE records per transaction.
+PENDING_TOKEN_TTL = 86400
+SWEEP_INTERVAL = 600
+SWEEP_BATCH_SIZE = 500
+#Outbound email queue table name (see outbox.py)
+OUTBOX_TABLE_NAME = "email_outbox_table"
+#Table where the applied schema migrations are recorded (see migrations.py)
+SCHEMA_VERSION_TABLE_NAME = "schema_version"
+#Apply pending schema migrations on startup instead of only warning about them
+DB_AUTO_MIGRATE = False
+#Connection pool, of INT type. Every controller operation borrows its own connection from the pool,
+#DB_POOL_MAXSIZE is the number of database operations which can run at once.
+#Set DB_POOLED to False to use a single shared connection instead.
+DB_POOLED = True
+DB_POOL_MINSIZE = 1
+DB_POOL_MAXSIZE = 10
+#Seconds to wait for a MySQL connection
+DB_CONNECT_TIMEOUT = 10
+#Rows fetched at a time by the exports streaming from a server-side cursor (blacklist get)
+DB_STREAM_BATCH = 1000
+#Largest attachment the bot uploads, in bytes (Discord's limit for bots is 8 MB)
+ATTACHMENT_MAX_BYTES = 8 * 1024 * 1024
+#blacklist add with an attached file: entries per multi-row INSERT (and transaction),
+#and the largest file accepted, in bytes after decompressing a gzipped one
+BLACKLIST_IMPORT_CHUNK = 5000
+BLACKLIST_IMPORT_MAX_BYTES = 64 * 1024 * 1024
+#Registration records shown per page by the records command
+RECORDS_PAGE_SIZE = 20
+#Coordination of several bot processes sharing the database through MySQL named locks (see coordination.py):
+#registrations and blacklist changes are serialized across the processes and only one process runs the expiry sweep.
+#A command waits at most DB_LOCK_TIMEOUT seconds for a lock, retrying every DB_LOCK_RETRY_DELAY seconds and backing off.
+#Set DB_LOCKS to True only when running several processes, the lock round trips of every command
+#go through one connection per process, which a single process doesn't need.
+DB_LOCKS = False
+DB_LOCK_TIMEOUT = 10
+DB_LOCK_RETRY_DELAY = 0.05
+#Seconds a starting process waits for another one applying the schema migrations
+DB_MIGRATION_LOCK_TIMEOUT = 600
+#Queries running for at least SLOW_QUERY_THRESHOLD seconds are logged, with the parameters redacted,
+#to the bot log and to SLOW_QUERY_LOG_FILE (leave empty to only use the bot log, see querystats.py)
+SLOW_QUERY_THRESHOLD = 0.2
+SLOW_QUERY_LOG_FILE = "slow_query.log"
+#Most query templates the querystats dev command lists
+QUERYSTATS_MAX_TOP = 25
 
 
 #SMTP SERVER VARIABLES
@@ -61,13 +139,71 @@ SMTP_HOST = ""
 SMTP_PORT = 0
 SMTP_USER = ""
 SMTP_PASS = ""
+#Pooled SMTP connections (see smtppool.py), set SMTP_POOLED to False to connect for every email.
+#SMTP_POOL_SIZE is the max number of open connections, of INT type. Connections idle for longer than
+#SMTP_IDLE_TIMEOUT seconds are reconnected, the ones idle for longer than SMTP_HEALTHCHECK_AFTER seconds
+#are checked with NOOP before reuse. A connection is closed after SMTP_MESSAGES_PER_SESSION messages.
+SMTP_POOLED = True
+SMTP_POOL_SIZE = 4
+SMTP_IDLE_TIMEOUT = 60
+SMTP_HEALTHCHECK_AFTER = 10
+SMTP_MESSAGES_PER_SESSION = 100
+#Seconds to wait for the SMTP server
+SMTP_TIMEOUT = 10
+#Implicit TLS (SMTPS), only turned off for local test servers (see benchmarks/)
+SMTP_USE_TLS = True
+#Durable email queue (see outbox.py), set EMAIL_OUTBOX to False to send the emails inside the register command.
+#OUTBOX_WORKERS workers claim OUTBOX_BATCH_SIZE emails at a time, for OUTBOX_LEASE seconds.
+#A failed email is retried after OUTBOX_RETRY_DELAY seconds, doubled with every attempt up to OUTBOX_RETRY_MAX_DELAY,
+#and dead-lettered after OUTBOX_MAX_ATTEMPTS attempts. OUTBOX_PROVIDER_RATE is the max number of emails
+#per second sent to one recipient domain. Idle workers poll the outbox every OUTBOX_POLL_INTERVAL seconds.
+EMAIL_OUTBOX = True
+OUTBOX_WORKERS = 2
+OUTBOX_BATCH_SIZE = 10
+OUTBOX_LEASE = 120
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_RETRY_MAX_DELAY = 600
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_PROVIDER_RATE = 5
+OUTBOX_POLL_INTERVAL = 5
 #Format of email message, SMTP_BODY must contain sequence {token} which is where
 #the token will be pasted
 SMTP_SENT_FROM = ""
 SMTP_SUBJECT = ""
 SMTP_BODY = "Your access token is:\r\n\r\n{token}"
 
+#CIRCUIT BREAKERS
+#
+#After *_FAILURE_THRESHOLD consecutive failures of MySQL or SMTP the commands fail fast,
+#the dependency is probed every *_RESET_TIMEOUT seconds until it recovers (see circuitbreaker.py)
+DB_FAILURE_THRESHOLD = 5
+DB_RESET_TIMEOUT = 30
+SMTP_FAILURE_THRESHOLD = 5
+SMTP_RESET_TIMEOUT = 60
+
+#METRICS
+#
+#Local HTTP endpoint serving the metrics in the Prometheus text format at /metrics (see metrics.py).
+#Several processes on one host (shards) need their own ports, set with the BOT_METRICS_PORT environment variable.
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+#profile dev command (see profiler.py): the longest allowed window in seconds, the number of hot functions,
+#task coroutines and slow callbacks reported, the task sampling interval and the duration in seconds
+#above which a callback counts as blocking the event loop
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP = 20
+PROFILE_TASK_SAMPLE_INTERVAL = 0.1
+PROFILE_SLOW_CALLBACK = 0.1
+
 #LOG FILE
 #
 #Custom log file in project's root directory
-LOG_FILE = "bot.log"
\ No newline at end of file
+LOG_FILE = "bot.log"
+#Level of the console and file logs
+LOG_LEVEL = "DEBUG"
+#The log file is rotated once it reaches LOG_MAX_BYTES, LOG_BACKUP_COUNT old files are kept
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+#Write the log file as JSON lines (with command name and latency fields where known) instead of plain text
+LOG_JSON = False
\ No newline at end of file
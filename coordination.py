@@ -0,0 +1,140 @@
+"""
+Coordination of several bot processes running against the same database, through MySQL named locks
+(GET_LOCK/RELEASE_LOCK).
+A named lock belongs to the connection which took it and the server releases it when the connection closes,
+so a process which died never leaves a lock behind. Every process keeps one dedicated connection for its locks,
+outside of the pool, so holding a lock never takes a connection away from the commands.
+A connection may take the same named lock several times, so the named locks only serialize different processes,
+the coroutines of one process are serialized by the controller's KeyedLock before they get here.
+Locks are requested with a zero timeout and retried with backoff, so one waiting coroutine never blocks
+the lock connection for the others.
+Leader election for singleton background jobs (see lead()) uses the same locks: the process holding
+the job's lock is its leader until the process, or its lock connection, goes away.
+"""
+import asyncio
+import hashlib
+import random
+import time
+from contextlib import asynccontextmanager
+import aiomysql
+import constants
+from querystats import TracedCursor
+from log import getLogger
+
+
+class LockUnavailableException(Exception):
+    pass
+
+
+class LockSession:
+    def __init__(self, loop, timeout: float = constants.DB_LOCK_TIMEOUT, retryDelay: float = constants.DB_LOCK_RETRY_DELAY):
+        self.loop = loop
+        self.timeout = timeout
+        self.retryDelay = retryDelay
+        self.connection: aiomysql.Connection = None
+        #the connection runs one query at a time
+        self.mutex = asyncio.Lock()
+        #named locks taken and not yet released by this process, lost if the connection drops
+        self.held = 0
+
+    async def connect(self):
+        self.connection = await aiomysql.connect(
+            host=constants.HOST,
+            port=constants.PORT,
+            user=constants.USER,
+            password=constants.PASS,
+            db=constants.DB_NAME,
+            connect_timeout=constants.DB_CONNECT_TIMEOUT,
+            autocommit=True,
+            loop=self.loop
+            )
+
+    async def close(self):
+        #releases every lock of the process, including the leaderships
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def lockName(key: str) -> str:
+        #named locks are server-wide and limited to 64 characters, the database name keeps
+        #two bots sharing a MySQL server apart
+        return "regbot:" + hashlib.sha1("{}/{}".format(constants.DB_NAME, key).encode()).hexdigest()
+
+    async def query(self, query: str, *args):
+        async with self.mutex:
+            if self.connection is None or self.connection.closed:
+                if self.held > 0:
+                    getLogger(__name__).error("Lock connection lost while holding {} named locks.".format(self.held))
+                    self.held = 0
+                await self.connect()
+            try:
+                async with self.connection.cursor() as cursor:
+                    cursor = TracedCursor(cursor)
+                    await cursor.execute(query, args)
+                    row = await cursor.fetchone()
+                    return row[0]
+            except Exception:
+                self.connection.close()
+                self.connection = None
+                raise
+
+    async def tryLock(self, name: str) -> bool:
+        #GET_LOCK returns 1 if taken, 0 if held by another connection
+        if await self.query("SELECT GET_LOCK(%s, 0)", name) == 1:
+            self.held += 1
+            return True
+        return False
+
+    async def release(self, name: str):
+        try:
+            await self.query("SELECT RELEASE_LOCK(%s)", name)
+            self.held = max(0, self.held - 1)
+        except Exception as e:
+            #the lock went away with the connection
+            getLogger(__name__).warning("Releasing named lock {} failed: {}".format(name, e))
+
+    @asynccontextmanager
+    async def acquire(self, *keys: str, timeout: float = None):
+        """
+        Holds the named locks of keys across all the processes for the block.
+        Several keys are taken in sorted order, like with KeyedLock.
+        Raises LockUnavailableException if the locks aren't taken in timeout seconds (default DB_LOCK_TIMEOUT)
+        or the lock connection fails.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        acquired = []
+        try:
+            for key in sorted(set(keys)):
+                name = self.lockName(key)
+                delay = self.retryDelay
+                try:
+                    while not await self.tryLock(name):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise LockUnavailableException("Timed out waiting for the named lock of {}.".format(key))
+                        #jitter, so processes waiting together don't retry together
+                        await asyncio.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+                        delay = min(2 * delay, 1)
+                except LockUnavailableException:
+                    raise
+                except Exception as e:
+                    raise LockUnavailableException("Named lock of {} failed: {}".format(key, e))
+                acquired.append(name)
+            yield
+        finally:
+            for name in reversed(acquired):
+                await self.release(name)
+
+    async def lead(self, job: str) -> bool:
+        """
+        Whether this process is the leader of the singleton job, taking the leadership if nobody holds it.
+        Called before every run of the job, a process whose lock connection dropped stops being the leader
+        and another one takes over on its next run.
+        """
+        name = self.lockName("leader:" + job)
+        try:
+            return await self.query("SELECT IF(IS_USED_LOCK(%s) = CONNECTION_ID(), 1, GET_LOCK(%s, 0))", name, name) == 1
+        except Exception as e:
+            getLogger(__name__).error("Leader election of {} failed: {}".format(job, e))
+            return False
@@ -1,10 +1,44 @@
 """
 Module which contains the function for connecting to SMTP server and sending an email message
+If initPool() has been called, the messages are sent over the pooled connections (see smtppool.py),
+otherwise every message opens its own connection.
 """
 import aiosmtplib
 import constants
 from email.message import EmailMessage
 import asyncio
+import metrics
+from smtppool import SmtpPool
+
+pool: SmtpPool = None
+
+def initPool(**kwargs) -> SmtpPool:
+    global pool
+    pool = SmtpPool(**kwargs)
+    return pool
+
+async def closePool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+async def ping():
+    """
+    Raises if the SMTP server can't be reached or refuses the login
+    """
+    if pool is not None:
+        conn = await pool.acquire()
+        await pool.release(conn)
+        return
+    client = aiosmtplib.SMTP(hostname=constants.SMTP_HOST, port=constants.SMTP_PORT, use_tls=constants.SMTP_USE_TLS, timeout=constants.SMTP_TIMEOUT)
+    await client.connect()
+    try:
+        await client.login(constants.SMTP_USER, constants.SMTP_PASS)
+        await client.noop()
+    finally:
+        await client.quit()
 
 
 async def sendToken(emails: [str], token: str):
@@ -14,16 +48,22 @@ async def sendToken(emails: [str], token: str):
     message["Subject"] = constants.SMTP_SUBJECT
     message.set_content(constants.SMTP_BODY.format(token=token))
 
-    await aiosmtplib.send(
-        message,
-        sender=constants.SMTP_SENT_FROM,
-        recipients=emails,
-        hostname=constants.SMTP_HOST,
-        port=constants.SMTP_PORT,
-        username=constants.SMTP_USER,
-        password=constants.SMTP_PASS,
-        use_tls=True
-    )
+    async with metrics.timed(metrics.SMTP_LATENCY):
+        if pool is not None:
+            await pool.send(message, sender=constants.SMTP_SENT_FROM, recipients=emails)
+            return
+
+        await aiosmtplib.send(
+            message,
+            sender=constants.SMTP_SENT_FROM,
+            recipients=emails,
+            hostname=constants.SMTP_HOST,
+            port=constants.SMTP_PORT,
+            username=constants.SMTP_USER,
+            password=constants.SMTP_PASS,
+            use_tls=constants.SMTP_USE_TLS,
+            timeout=constants.SMTP_TIMEOUT
+        )
     
 #driver test
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+class BlacklistImport:
+    """
+    Container class for the outcome of BotController.importBlacklist()
+    added counts the entries inserted into the blacklist, duplicates the entries repeated in the file
+    or already in the blacklist, invalid the lines which are neither an email address nor a rule.
+    invalidSamples holds the first few invalid lines, to show to the user.
+    """
+    def __init__(self):
+        self.added = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.invalidSamples = []
+
+    def __str__(self):
+        return "added " + str(self.added) + " | duplicates " + str(self.duplicates) + " | invalid " + str(self.invalid)
@@ -4,7 +4,11 @@ class Record:
     """
     Container class used for database entity
     """
-    def __init__(self, discordid: str = None, email: str = None, token: str = None, time: datetime = None, _type: str = None, status: str = None):
+    #no per-instance dict, exports stream many of them
+    __slots__ = ("guildid", "discordid", "email", "token", "time", "_type", "status")
+
+    def __init__(self, discordid: str = None, email: str = None, token: str = None, time: datetime = None, _type: str = None, status: str = None, guildid: int = None):
+        self.guildid = guildid
         self.discordid = discordid
         self.email = email
         self.token = token
@@ -18,4 +22,4 @@ class Record:
         return s
 
     def __str__(self):
-        return self.xstr(self.discordid) + " " + self.xstr(self.email) + " " + self.xstr(self.token) + " " + self.xstr(str(self.time)) + " " + self.xstr(self.status)
\ No newline at end of file
+        return self.xstr(str(self.guildid)) + " " + self.xstr(self.discordid) + " " + self.xstr(self.email) + " " + self.xstr(self.token) + " " + self.xstr(str(self.time)) + " " + self.xstr(self.status)
\ No newline at end of file
@@ -0,0 +1,30 @@
+class RegisterAttempt:
+    """
+    Container class for the outcome of AsyncDb.registerAttempt()
+    senderStatus and emailStatus hold the status of the record sharing the discord id,
+    respectively the email, with the attempted registration (None if there is no such record).
+    inserted tells whether the pending records were evicted and the new record inserted.
+    """
+    def __init__(self, senderStatus: str = None, emailStatus: str = None, inserted: bool = False):
+        self.senderStatus = senderStatus
+        self.emailStatus = emailStatus
+        self.inserted = inserted
+
+    @property
+    def senderExists(self) -> bool:
+        return self.senderStatus is not None
+
+    @property
+    def emailExists(self) -> bool:
+        return self.emailStatus is not None
+
+    @property
+    def senderPending(self) -> bool:
+        return self.senderStatus == "pending"
+
+    @property
+    def emailPending(self) -> bool:
+        return self.emailStatus == "pending"
+
+    def __str__(self):
+        return "sender " + str(self.senderStatus) + " | email " + str(self.emailStatus) + " | inserted " + str(self.inserted)
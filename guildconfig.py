@@ -0,0 +1,35 @@
+"""
+Per-server settings, read from constants.GUILDS with the global settings as defaults
+(see GUILDS in constants.py). Without GUILDS, the only server is SERVERID.
+"""
+import constants
+
+
+def guildIds() -> [int]:
+    if len(constants.GUILDS) == 0:
+        return [constants.SERVERID]
+    return list(constants.GUILDS)
+
+def isServed(guildId: int) -> bool:
+    return guildId in guildIds()
+
+def setting(guildId: int, key: str, default):
+    return constants.GUILDS.get(guildId, {}).get(key, default)
+
+def registeredRoles(guildId: int) -> [str]:
+    return setting(guildId, "roles", constants.REGISTERED_ROLE_NAMES)
+
+def developerRoles(guildId: int) -> [str]:
+    return setting(guildId, "developerRoles", constants.DEVELOPER_ROLE_NAMES)
+
+def botChannel(guildId: int) -> str:
+    return setting(guildId, "botChannel", constants.BOT_CHANNEL)
+
+def allRegisteredRoles() -> [str]:
+    """
+    Role names which can be registered for in at least one server
+    """
+    roles = []
+    for guildId in guildIds():
+        roles.extend(r for r in registeredRoles(guildId) if r not in roles)
+    return roles
@@ -0,0 +1,152 @@
+"""
+Index of the members and roles of the servers served by the bot (see guildconfig.py), so the commands
+find a member by id, a role by name and check the developer roles with dict and set lookups
+instead of scanning guild.members and guild.roles.
+The servers of the shards running in this process are built in Bot.on_ready() and kept current
+by the bot's member, role and guild events. The servers of the shards run by other processes
+(DMs all arrive at shard 0) are fetched over the REST API: their roles are cached for REMOTE_GUILD_TTL
+seconds and their members are fetched when needed.
+resolve() finds the server a DM command is meant for.
+"""
+import time
+import discord
+import constants
+import guildconfig
+
+
+class GuildResolutionException(Exception):
+    def __init__(self, message, candidates: [str]):
+        super().__init__(message)
+        #names of the servers the command could be meant for, empty if none
+        self.candidates = candidates
+
+
+class GuildEntry:
+    def __init__(self, guild: discord.Guild, remote: bool = False):
+        self.guild = guild
+        #remote servers have no member cache, their members are fetched one by one
+        self.remote = remote
+        self.fetched = time.monotonic()
+        #member id -> member
+        self.members = {} if remote else {member.id: member for member in guild.members}
+        self.indexRoles()
+
+    def indexRoles(self):
+        #role name -> role, the first role in guild.roles order wins, like with discord.utils.get
+        roles = {}
+        for role in self.guild.roles:
+            roles.setdefault(role.name, role)
+        self.roles = roles
+        developerRoles = guildconfig.developerRoles(self.guild.id)
+        self.developerRoleIds = {role.id for role in self.guild.roles if role.name in developerRoles}
+
+    def isDeveloper(self, member: discord.Member) -> bool:
+        return any(role.id in self.developerRoleIds for role in member.roles)
+
+
+class GuildIndex:
+    def __init__(self, client: discord.Client, guildIds: [int] = None):
+        self.client = client
+        self.guildIds = guildIds if guildIds is not None else guildconfig.guildIds()
+        #guild id -> GuildEntry
+        self.entries = {}
+
+    def build(self, guild: discord.Guild):
+        if guild.id in self.guildIds:
+            self.entries[guild.id] = GuildEntry(guild)
+
+    def remove(self, guild: discord.Guild):
+        entry = self.entries.get(guild.id)
+        if entry is not None and not entry.remote:
+            del self.entries[guild.id]
+
+    def isIndexed(self, guild: discord.Guild) -> bool:
+        entry = self.entries.get(guild.id)
+        return entry is not None and not entry.remote
+
+    async def entry(self, guildId: int) -> GuildEntry:
+        """
+        The entry of a served server, fetched over REST if no shard of this process has it,
+        None if the server is unavailable
+        """
+        entry = self.entries.get(guildId)
+        if entry is not None and (not entry.remote or time.monotonic() - entry.fetched < constants.REMOTE_GUILD_TTL):
+            return entry
+        guild = self.client.get_guild(guildId)
+        if guild is not None:
+            self.build(guild)
+            return self.entries[guildId]
+        try:
+            guild = await self.client.fetch_guild(guildId)
+        except discord.HTTPException:
+            return entry
+        entry = self.entries[guildId] = GuildEntry(guild, remote=True)
+        return entry
+
+    async def getMember(self, entry: GuildEntry, memberId: int) -> discord.Member:
+        if not entry.remote:
+            return entry.members.get(memberId)
+        try:
+            return await entry.guild.fetch_member(memberId)
+        except discord.HTTPException:
+            return None
+
+    def getRole(self, guildId: int, name: str) -> discord.Role:
+        entry = self.entries.get(guildId)
+        if entry is None:
+            return None
+        return entry.roles.get(name)
+
+    async def getChannel(self, guildId: int, name: str) -> discord.abc.GuildChannel:
+        entry = await self.entry(guildId)
+        if entry is None:
+            return None
+        channels = await entry.guild.fetch_channels() if entry.remote else entry.guild.channels
+        return discord.utils.get(channels, name=name)
+
+    async def resolve(self, memberId: int, hint: str = None, developer: bool = False, accepts=None) -> (discord.Guild, discord.Member):
+        """
+        Finds the server a DM command of the member is meant for, among the served servers
+        the member is in (and is a developer of, if developer is set) which accepts(guild) allows.
+        hint, the server's id or name, picks one of them. Returns the server with the member,
+        raises GuildResolutionException if no server or more than one server matches.
+        """
+        candidates = []
+        for guildId in self.guildIds:
+            entry = await self.entry(guildId)
+            if entry is None or (accepts is not None and not accepts(entry.guild)):
+                continue
+            member = await self.getMember(entry, memberId)
+            if member is None or (developer and not entry.isDeveloper(member)):
+                continue
+            candidates.append((entry.guild, member))
+        if hint is not None:
+            candidates = [c for c in candidates if str(c[0].id) == hint or c[0].name.lower() == hint.lower()]
+        if len(candidates) == 1:
+            return candidates[0]
+        names = [guild.name for guild, member in candidates]
+        if len(candidates) == 0:
+            raise GuildResolutionException("No server of user {} matches{}.".format(memberId, "" if hint is None else " '{}'".format(hint)), names)
+        raise GuildResolutionException("User {} is in several matching servers: {}.".format(memberId, ", ".join(names)), names)
+
+    async def isDeveloper(self, memberId: int) -> bool:
+        try:
+            await self.resolve(memberId, developer=True)
+            return True
+        except GuildResolutionException as e:
+            return len(e.candidates) > 0
+
+    #event handlers, called by the bot
+    def memberUpdated(self, member: discord.Member):
+        if self.isIndexed(member.guild):
+            self.entries[member.guild.id].members[member.id] = member
+
+    def memberRemoved(self, member: discord.Member):
+        if self.isIndexed(member.guild):
+            self.entries[member.guild.id].members.pop(member.id, None)
+
+    def rolesChanged(self, guild: discord.Guild):
+        if self.isIndexed(guild):
+            entry = self.entries[guild.id]
+            entry.guild = guild
+            entry.indexRoles()
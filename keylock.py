@@ -0,0 +1,53 @@
+"""
+Keyed lock manager, serializes the coroutines working on the same key (discord id, email)
+while the ones working on different keys keep running in parallel.
+Several keys are always acquired in sorted order, so two commands touching the same pair of keys
+can't deadlock. A key's lock exists only while some coroutine holds or waits for it.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class LockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        #coroutines holding or waiting for the lock
+        self.users = 0
+
+
+class KeyedLock:
+    def __init__(self):
+        self.locks = {}
+
+    def release(self, key: str, entry: LockEntry, locked: bool):
+        if locked:
+            entry.lock.release()
+        entry.users -= 1
+        if entry.users == 0:
+            del self.locks[key]
+
+    @asynccontextmanager
+    async def acquire(self, *keys: str):
+        acquired = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self.locks.get(key)
+                if entry is None:
+                    entry = self.locks[key] = LockEntry()
+                entry.users += 1
+                try:
+                    await entry.lock.acquire()
+                except BaseException:
+                    #cancelled while waiting
+                    self.release(key, entry, False)
+                    raise
+                acquired.append((key, entry))
+            yield
+        finally:
+            for key, entry in reversed(acquired):
+                self.release(key, entry, True)
+
+    def __len__(self):
+        return len(self.locks)
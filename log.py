@@ -1,27 +1,86 @@
 """
 Module which contains the function for setting up the instance for logging then returning it
+Logging is configured only once, on the first getLogger() call. The records are put into a queue
+by a QueueHandler and a background QueueListener thread writes them to the console and to LOG_FILE
+(rotated by size), so logging never blocks the event loop on disk I/O.
+With LOG_JSON set, the file gets one JSON object per record, including the command and latency
+fields of records logged with extra={"command": ..., "latency": ...}.
+The records of the "slowquery" logger (see querystats.py) are also written to SLOW_QUERY_LOG_FILE.
 """
+import atexit
+import json
 import logging
-from constants import LOG_FILE
+import logging.handlers
+import queue
+from constants import LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_JSON, SLOW_QUERY_LOG_FILE
 
+listener: logging.handlers.QueueListener = None
 
-def getLogger(name: str) -> logging.Logger:
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger(name)
+
+class JsonFormatter(logging.Formatter):
+    #optional fields, set through the extra argument of the logging calls
+    FIELDS = ("command", "latency")
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage()
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        return json.dumps(data)
+
+
+def configure():
+    global listener
+    if listener is not None:
+        return
 
     c_handler = logging.StreamHandler()
-    f_handler = logging.FileHandler(LOG_FILE)
-    c_handler.setLevel(logging.DEBUG)
-    f_handler.setLevel(logging.DEBUG)
+    f_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    c_handler.setLevel(LOG_LEVEL)
+    f_handler.setLevel(LOG_LEVEL)
 
     c_format = logging.Formatter('[ %(name)s | %(levelname)s ]: %(message)s')
-    f_format = logging.Formatter('[ %(asctime)s | %(name)s | %(levelname)s ]: %(message)s', "%d-%m-%Y %H:%M:%S")
+    if LOG_JSON:
+        f_format = JsonFormatter(datefmt="%d-%m-%Y %H:%M:%S")
+    else:
+        f_format = logging.Formatter('[ %(asctime)s | %(name)s | %(levelname)s ]: %(message)s', "%d-%m-%Y %H:%M:%S")
     c_handler.setFormatter(c_format)
     f_handler.setFormatter(f_format)
+    handlers = [c_handler, f_handler]
+
+    if SLOW_QUERY_LOG_FILE:
+        s_handler = logging.handlers.RotatingFileHandler(SLOW_QUERY_LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        s_handler.addFilter(logging.Filter("slowquery"))
+        s_handler.setFormatter(f_format)
+        handlers.append(s_handler)
 
-    logger.addHandler(c_handler)
-    logger.addHandler(f_handler)
-    return logger
+    records = queue.Queue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(shutdown)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+def shutdown():
+    """
+    Flushes the queued records, called at exit
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def getLogger(name: str) -> logging.Logger:
+    configure()
+    return logging.getLogger(name)
 
 if __name__ == "__main__":
     getLogger("testlogger").error("Testni error")
\ No newline at end of file
@@ -0,0 +1,204 @@
+"""
+Metrics module
+Latency histograms and counters of the cog commands, the AsyncDb query methods, the SMTP sends
+and the Discord role calls, kept in memory and exposed in the Prometheus text format by MetricsServer,
+a minimal HTTP server meant to listen on localhost. summary() gives the short version for the stats command.
+"""
+import asyncio
+import functools
+import inspect
+import time
+from contextlib import asynccontextmanager
+from log import getLogger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def formatLabels(names: tuple, values: tuple) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelNames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        #label values -> count
+        self.series = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labelNames)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> [str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for key, value in sorted(self.series.items()):
+            lines.append("{}{} {}".format(self.name, formatLabels(self.labelNames, key), value))
+        return lines
+
+
+class HistogramSeries:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelNames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        #label values -> HistogramSeries
+        self.series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labelNames)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = HistogramSeries(len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series.counts[i] += 1
+                break
+        series.sum += value
+        series.count += 1
+        series.max = max(series.max, value)
+
+    def quantile(self, series: HistogramSeries, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile, the max if it's above the last bucket
+        """
+        rank = q * series.count
+        seen = 0
+        for bound, count in zip(self.buckets, series.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, series.max)
+        return series.max
+
+    def render(self) -> [str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, formatLabels(self.labelNames + ("le",), key + (bound,)), cumulative))
+            lines.append("{}_bucket{} {}".format(self.name, formatLabels(self.labelNames + ("le",), key + ("+Inf",)), series.count))
+            lines.append("{}_sum{} {}".format(self.name, formatLabels(self.labelNames, key), series.sum))
+            lines.append("{}_count{} {}".format(self.name, formatLabels(self.labelNames, key), series.count))
+        return lines
+
+
+REGISTRY = []
+
+COMMAND_LATENCY = Histogram("bot_command_duration_seconds", "Duration of the cog commands.", ("command", "outcome"))
+COMMAND_REJECTIONS = Counter("bot_command_rejections_total", "Commands rejected by the admission control.", ("reason",))
+DB_LATENCY = Histogram("bot_db_query_duration_seconds", "Duration of the AsyncDb query methods.", ("method", "outcome"))
+SMTP_LATENCY = Histogram("bot_smtp_send_duration_seconds", "Duration of the SMTP sends.", ("outcome",))
+DISCORD_LATENCY = Histogram("bot_discord_role_call_duration_seconds", "Duration of the Discord role API calls.", ("call", "outcome"))
+
+
+@asynccontextmanager
+async def timed(histogram: Histogram, **labels):
+    """
+    Observes the duration of the block, with outcome="ok" or "error"
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, outcome=outcome, **labels)
+
+def instrument(cls, histogram: Histogram):
+    """
+    Wraps every public coroutine method of the class with timed(histogram, method=<name>)
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        def wrap(method, name=name):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                async with timed(histogram, method=name):
+                    return await method(*args, **kwargs)
+            return wrapper
+        setattr(cls, name, wrap(method))
+    return cls
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def summary() -> [str]:
+    """
+    One line per histogram series with its count and the mean, p50, p99 and max latency in ms,
+    then one line per counter series
+    """
+    lines = []
+    for metric in REGISTRY:
+        if not isinstance(metric, Histogram):
+            continue
+        for key, series in sorted(metric.series.items()):
+            labels = "/".join(str(v) for v in key)
+            lines.append("{} {}: n={} avg={:.1f} p50<={:.1f} p99<={:.1f} max={:.1f}".format(
+                metric.name.replace("bot_", "").replace("_duration_seconds", ""), labels, series.count,
+                1000 * series.sum / series.count, 1000 * metric.quantile(series, 0.5),
+                1000 * metric.quantile(series, 0.99), 1000 * series.max))
+    for metric in REGISTRY:
+        if isinstance(metric, Counter):
+            for key, value in sorted(metric.series.items()):
+                lines.append("{} {}: {}".format(metric.name.replace("bot_", ""), "/".join(str(v) for v in key), value))
+    return lines
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics in the Prometheus text format, everything else gets 404
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        getLogger(__name__).info("Metrics endpoint listening on http://{}:{}/metrics".format(self.host, self.port))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), 5)
+            #skip the headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = requestLine.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write("HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,208 @@
+"""Schema migration module
+
+Module contains the versioned list of schema migrations which upgrade existing tables in place.
+Every applied migration is recorded inside the schema version table, so on startup the bot
+only has to read the highest applied version and compare it with LATEST_VERSION.
+Every migration step checks the current state of the schema before altering it, so a migration
+interrupted in the middle (MySQL DDL statements commit implicitly) can simply be ran again.
+
+Run this module individually to apply the pending migrations.
+"""
+import asyncio
+import constants
+from pymysql.err import IntegrityError, ProgrammingError
+from asyncdb import AsyncDb
+from log import getLogger
+
+#MySQL error code for a missing table
+ER_NO_SUCH_TABLE = 1146
+
+
+async def indexExists(cursor, table: str, index: str) -> bool:
+    query = "SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s LIMIT 1"
+    await cursor.execute(query, (table, index))
+    return (await cursor.fetchone()) is not None
+
+async def indexHasColumn(cursor, table: str, index: str, column: str) -> bool:
+    query = "SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s AND COLUMN_NAME=%s LIMIT 1"
+    await cursor.execute(query, (table, index, column))
+    return (await cursor.fetchone()) is not None
+
+async def columnExists(cursor, table: str, column: str) -> bool:
+    query = "SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s LIMIT 1"
+    await cursor.execute(query, (table, column))
+    return (await cursor.fetchone()) is not None
+
+async def dropIndex(cursor, table: str, index: str):
+    if await indexExists(cursor, table, index):
+        await cursor.execute("ALTER TABLE {} DROP INDEX {}".format(table, index))
+
+async def addIndex(cursor, table: str, index: str, definition: str):
+    if not await indexExists(cursor, table, index):
+        try:
+            await cursor.execute("ALTER TABLE {} ADD {}".format(table, definition))
+        except IntegrityError:
+            getLogger(__name__).error("Unable to add index {} on {}, the table contains duplicate rows. Remove them and run the migration again.".format(index, table))
+            raise
+
+
+async def migration1(cursor):
+    #Base tables, as created by AsyncDb.rebuildTable() and AsyncDb.rebuildBlacklistTable() before versioning
+    queryToken = '''CREATE TABLE IF NOT EXISTS {table_name} (
+        Tokenid int NOT NULL AUTO_INCREMENT,
+        Discordid varchar(127) NOT NULL,
+        Email varchar(127) NOT NULL,
+        Token varchar(64) NOT NULL,
+        Time datetime NOT NULL,
+        Type enum({vars}),
+        Status enum('pending', 'registered'),
+        PRIMARY KEY (Tokenid)
+    )'''.format(table_name=constants.TABLE_NAME, vars=", ".join(["%s" for x in range(len(constants.REGISTERED_ROLE_NAMES))]))
+    queryBlacklist = '''CREATE TABLE IF NOT EXISTS {} (
+        Email varchar(255) NOT NULL,
+        PRIMARY KEY (Email)
+    )'''.format(constants.BLACKLIST_TABLE_NAME)
+    await cursor.execute(queryToken, tuple(constants.REGISTERED_ROLE_NAMES))
+    await cursor.execute(queryBlacklist)
+
+async def migration2(cursor):
+    #Secondary indexes for the lookups by Discordid, Email and Token, and for the pending expiry by (Status, Time).
+    #Tokens are tokengenerator.getToken() values, 43 url-safe characters, compared case-sensitively.
+    await cursor.execute("ALTER TABLE {} MODIFY Token char(43) CHARACTER SET ascii COLLATE ascii_bin NOT NULL".format(constants.TABLE_NAME))
+    await addIndex(cursor, constants.TABLE_NAME, "Discordid", "UNIQUE INDEX Discordid (Discordid)")
+    await addIndex(cursor, constants.TABLE_NAME, "Email", "UNIQUE INDEX Email (Email)")
+    await addIndex(cursor, constants.TABLE_NAME, "Token", "INDEX Token (Token)")
+    await addIndex(cursor, constants.TABLE_NAME, "Status_Time", "INDEX Status_Time (Status, Time)")
+
+async def migration3(cursor):
+    #Domain, subdomain wildcard and local-part pattern rules of the blacklist
+    query = '''CREATE TABLE IF NOT EXISTS {} (
+        Rule varchar(255) NOT NULL,
+        Kind enum('domain', 'subdomain', 'localpart') NOT NULL,
+        Domain varchar(255) NOT NULL,
+        Pattern varchar(255),
+        PRIMARY KEY (Rule),
+        INDEX Domain (Domain)
+    )'''.format(constants.BLACKLIST_RULE_TABLE_NAME)
+    await cursor.execute(query)
+
+async def migration4(cursor):
+    #Durable outbound email queue, drained by outbox.Outbox
+    query = '''CREATE TABLE IF NOT EXISTS {} (
+        Outboxid int NOT NULL AUTO_INCREMENT,
+        Recipient varchar(255) NOT NULL,
+        Token char(43) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+        Status enum('queued', 'dead') NOT NULL,
+        Attempts int NOT NULL,
+        NextAttempt datetime NOT NULL,
+        LastError varchar(255),
+        Created datetime NOT NULL,
+        PRIMARY KEY (Outboxid),
+        INDEX Status_NextAttempt (Status, NextAttempt)
+    )'''.format(constants.OUTBOX_TABLE_NAME)
+    await cursor.execute(query)
+
+
+async def addGuildColumn(cursor, table: str):
+    #the rows from before the multi-server support belong to SERVERID
+    if not await columnExists(cursor, table, "Guildid"):
+        await cursor.execute("ALTER TABLE {} ADD Guildid bigint unsigned NOT NULL DEFAULT {:d} FIRST".format(table, constants.SERVERID))
+        await cursor.execute("ALTER TABLE {} ALTER Guildid DROP DEFAULT".format(table))
+
+async def migration5(cursor):
+    #Registrations and blacklists per server. The role names differ between servers, so Type is no longer an enum.
+    await addGuildColumn(cursor, constants.TABLE_NAME)
+    await cursor.execute("ALTER TABLE {} MODIFY Type varchar(127)".format(constants.TABLE_NAME))
+    await addIndex(cursor, constants.TABLE_NAME, "Guild_Discordid", "UNIQUE INDEX Guild_Discordid (Guildid, Discordid)")
+    await addIndex(cursor, constants.TABLE_NAME, "Guild_Email", "UNIQUE INDEX Guild_Email (Guildid, Email)")
+    await dropIndex(cursor, constants.TABLE_NAME, "Discordid")
+    await dropIndex(cursor, constants.TABLE_NAME, "Email")
+
+    await addGuildColumn(cursor, constants.BLACKLIST_TABLE_NAME)
+    if not await indexHasColumn(cursor, constants.BLACKLIST_TABLE_NAME, "PRIMARY", "Guildid"):
+        await cursor.execute("ALTER TABLE {} DROP PRIMARY KEY, ADD PRIMARY KEY (Guildid, Email)".format(constants.BLACKLIST_TABLE_NAME))
+
+    await addGuildColumn(cursor, constants.BLACKLIST_RULE_TABLE_NAME)
+    if not await indexHasColumn(cursor, constants.BLACKLIST_RULE_TABLE_NAME, "PRIMARY", "Guildid"):
+        await cursor.execute("ALTER TABLE {} DROP PRIMARY KEY, ADD PRIMARY KEY (Guildid, Rule)".format(constants.BLACKLIST_RULE_TABLE_NAME))
+    await addIndex(cursor, constants.BLACKLIST_RULE_TABLE_NAME, "Guild_Domain", "INDEX Guild_Domain (Guildid, Domain)")
+    await dropIndex(cursor, constants.BLACKLIST_RULE_TABLE_NAME, "Domain")
+
+
+#(version, description, coroutine) in the order of application
+MIGRATIONS = [
+    (1, "base tables", migration1),
+    (2, "token table indexes and fixed-width token column", migration2),
+    (3, "blacklist rule table", migration3),
+    (4, "email outbox table", migration4),
+    (5, "server column of the token, blacklist and blacklist rule tables", migration5),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def getVersion(db: AsyncDb) -> int:
+    """
+    Returns the highest applied schema version, 0 if no migration has ever been applied
+    """
+    query = "SELECT MAX(Version) FROM {}".format(constants.SCHEMA_VERSION_TABLE_NAME)
+    async with db.cursor() as cursor:
+        try:
+            await cursor.execute(query)
+        except ProgrammingError as e:
+            if e.args[0] == ER_NO_SUCH_TABLE:
+                return 0
+            raise
+        row = await cursor.fetchone()
+    return row[0] or 0
+
+async def migrate(db: AsyncDb) -> int:
+    """
+    Applies all the migrations newer than the current schema version, returns the new version
+    """
+    queryCreate = '''CREATE TABLE IF NOT EXISTS {} (
+        Version int NOT NULL,
+        Description varchar(255) NOT NULL,
+        Applied datetime NOT NULL,
+        PRIMARY KEY (Version)
+    )'''.format(constants.SCHEMA_VERSION_TABLE_NAME)
+    queryInsert = "INSERT INTO {} (Version, Description, Applied) VALUES (%s, %s, now())".format(constants.SCHEMA_VERSION_TABLE_NAME)
+    async with db.cursor() as cursor:
+        await cursor.execute(queryCreate)
+    version = await getVersion(db)
+    for migrationVersion, description, migration in MIGRATIONS:
+        if migrationVersion <= version:
+            continue
+        getLogger(__name__).info("Applying schema migration {}: {}".format(migrationVersion, description))
+        async with db.cursor() as cursor:
+            await migration(cursor)
+            await cursor.execute(queryInsert, (migrationVersion, description))
+        await db.commit()
+        version = migrationVersion
+    return version
+
+async def checkVersion(db: AsyncDb) -> bool:
+    """
+    Startup check, a single query. Applies the pending migrations if DB_AUTO_MIGRATE is set.
+    Returns whether the schema is up to date.
+    """
+    version = await getVersion(db)
+    if version >= LATEST_VERSION:
+        return True
+    if constants.DB_AUTO_MIGRATE:
+        version = await migrate(db)
+        return version >= LATEST_VERSION
+    getLogger(__name__).warning("Database schema version {} is older than {}. Run migrations.py to upgrade it.".format(version, LATEST_VERSION))
+    return False
+
+
+#Driver
+async def run(loop):
+    db = AsyncDb(loop)
+    await db.initConnection()
+    version = await migrate(db)
+    print("Schema version: {}".format(version))
+    await db.close()
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop))
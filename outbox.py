@@ -0,0 +1,127 @@
+"""
+Durable outbound email queue.
+The controller writes the token email into the outbox table in the same transaction as the registration
+record, so the transaction never waits for the SMTP server. A pool of async workers drains the table:
+every worker claims a batch of due emails by leasing them (moving NextAttempt past the lease time),
+sends them with a per-provider (recipient domain) rate limit, deletes the sent ones and reschedules
+the failed ones with exponential backoff. After OUTBOX_MAX_ATTEMPTS attempts an email is dead-lettered.
+While the SMTP circuit breaker is open, the workers don't claim anything.
+Emails claimed by a worker which died are picked up again once their lease expires.
+"""
+import asyncio
+import random
+import time
+import constants
+import emailhandler
+from asyncdb import AsyncDb
+from circuitbreaker import CircuitBreaker
+from log import getLogger
+
+
+class Outbox:
+    def __init__(self, db: AsyncDb,
+        workers: int = constants.OUTBOX_WORKERS,
+        batchSize: int = constants.OUTBOX_BATCH_SIZE,
+        maxAttempts: int = constants.OUTBOX_MAX_ATTEMPTS,
+        retryDelay: float = constants.OUTBOX_RETRY_DELAY,
+        retryMaxDelay: float = constants.OUTBOX_RETRY_MAX_DELAY,
+        lease: int = constants.OUTBOX_LEASE,
+        pollInterval: float = constants.OUTBOX_POLL_INTERVAL,
+        providerRate: float = constants.OUTBOX_PROVIDER_RATE,
+        breaker: CircuitBreaker = None
+        ):
+        self.db = db
+        self.breaker = breaker
+        self.workers = workers
+        self.batchSize = batchSize
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.retryMaxDelay = retryMaxDelay
+        self.lease = lease
+        self.pollInterval = pollInterval
+        self.providerInterval = 1 / providerRate
+        #recipient domain -> earliest time.monotonic() of the next send to it
+        self.providerNext = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        if len(self.tasks) == 0:
+            self.tasks = [asyncio.ensure_future(self.worker()) for x in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def notify(self):
+        """
+        Wakes up the workers, called after an email was committed into the outbox
+        """
+        self.wakeup.set()
+
+    def backoff(self, attempts: int) -> int:
+        delay = min(self.retryDelay * 2 ** (attempts - 1), self.retryMaxDelay)
+        #jitter, so emails failing together don't retry together
+        return int(delay * random.uniform(0.5, 1.0)) + 1
+
+    async def throttle(self, recipient: str):
+        provider = recipient.rpartition("@")[2].lower()
+        now = time.monotonic()
+        at = max(now, self.providerNext.get(provider, now))
+        self.providerNext[provider] = at + self.providerInterval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def worker(self):
+        while True:
+            batch = []
+            #cleared before the claim, so a notify() arriving during the claim keeps the event set
+            #and the wait below returns right away
+            self.wakeup.clear()
+            if self.breaker is None or self.breaker.isClosed:
+                try:
+                    async with self.db.transaction() as db:
+                        batch = await db.claimOutbox(self.batchSize, self.lease)
+                except Exception as e:
+                    getLogger(__name__).error("Outbox claim failed: {}".format(e))
+            if len(batch) == 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.pollInterval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for outboxid, recipient, token, attempts in batch:
+                await self.deliver(outboxid, recipient, token, attempts)
+
+    async def deliver(self, outboxid: int, recipient: str, token: str, attempts: int):
+        """
+        attempts already counts this attempt (see AsyncDb.claimOutbox())
+        """
+        await self.throttle(recipient)
+        try:
+            if self.breaker is None:
+                await emailhandler.sendToken([recipient], token)
+            else:
+                async with self.breaker.guard():
+                    await emailhandler.sendToken([recipient], token)
+        except Exception as e:
+            error = str(e)[:255]
+            try:
+                async with self.db.transaction() as db:
+                    if attempts >= self.maxAttempts:
+                        await db.deadLetterOutbox(outboxid, error)
+                        getLogger(__name__).error("Outbox email {} to {} dead-lettered after {} attempts: {}".format(outboxid, recipient, attempts, error))
+                    else:
+                        await db.retryOutbox(outboxid, self.backoff(attempts), error)
+                        getLogger(__name__).warning("Outbox email {} to {} failed (attempt {}): {}".format(outboxid, recipient, attempts, error))
+            except Exception as e:
+                #the lease expires and the email is retried anyway
+                getLogger(__name__).error("Outbox update of email {} failed: {}".format(outboxid, e))
+            return
+        try:
+            async with self.db.transaction() as db:
+                await db.deleteOutbox(outboxid)
+        except Exception as e:
+            #the email is sent again once the lease expires
+            getLogger(__name__).error("Outbox delete of sent email {} failed: {}".format(outboxid, e))
@@ -0,0 +1,132 @@
+"""
+On-demand profiling of the running bot, used by the profile dev command.
+For a bounded window, Profiler enables cProfile on the event loop's thread, samples the running asyncio tasks
+and switches the loop to debug mode to catch the callbacks blocking it for longer than PROFILE_SLOW_CALLBACK seconds.
+Nothing is installed outside of the window, so the profiler costs nothing while it's off.
+"""
+import asyncio
+import cProfile
+import logging
+import marshal
+import os
+import time
+import constants
+
+
+class ProfileBusyException(Exception):
+    pass
+
+
+class SlowCallbackHandler(logging.Handler):
+    """
+    Collects the "Executing <handle> took X seconds" warnings the event loop logs in debug mode
+    """
+    def __init__(self):
+        super().__init__()
+        #(seconds, handle)
+        self.callbacks = []
+
+    def emit(self, record: logging.LogRecord):
+        if isinstance(record.msg, str) and record.msg.startswith("Executing") and isinstance(record.args, tuple) and len(record.args) == 2:
+            self.callbacks.append((record.args[1], str(record.args[0])))
+
+
+class ProfileReport:
+    def __init__(self, seconds: float, stats: dict, taskSamples: [dict], slowCallbacks: [(float, str)]):
+        self.seconds = seconds
+        #cProfile stats, (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers)
+        self.stats = stats
+        #coroutine name -> number of tasks running it, one dict per sample
+        self.taskSamples = taskSamples
+        self.slowCallbacks = slowCallbacks
+
+    @staticmethod
+    def functionName(key: tuple) -> str:
+        filename, line, name = key
+        if filename == "~":
+            #builtins
+            return name
+        return "{} ({}:{})".format(name, os.path.basename(filename), line)
+
+    def hotFunctions(self, n: int) -> [str]:
+        top = sorted(self.stats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+        lines = ["own ms   cum ms     calls  function"]
+        for key, (cc, nc, tt, ct, callers) in top:
+            lines.append("{:7.1f} {:8.1f} {:9d}  {}".format(1000 * tt, 1000 * ct, nc, self.functionName(key)))
+        return lines
+
+    def taskSummary(self, n: int) -> [str]:
+        if len(self.taskSamples) == 0:
+            return []
+        totals = [sum(sample.values()) for sample in self.taskSamples]
+        byCoroutine = {}
+        for sample in self.taskSamples:
+            for name, count in sample.items():
+                byCoroutine[name] = byCoroutine.get(name, 0) + count
+        lines = ["tasks: avg {:.1f} max {} over {} samples".format(sum(totals) / len(totals), max(totals), len(totals))]
+        for name, count in sorted(byCoroutine.items(), key=lambda item: item[1], reverse=True)[:n]:
+            lines.append("{:7.1f}  {}".format(count / len(self.taskSamples), name))
+        return lines
+
+    def slowCallbackSummary(self, n: int) -> [str]:
+        lines = ["slow callbacks (>= {} s): {}".format(constants.PROFILE_SLOW_CALLBACK, len(self.slowCallbacks))]
+        for seconds, handle in sorted(self.slowCallbacks, reverse=True)[:n]:
+            lines.append("{:7.1f} ms  {}".format(1000 * seconds, handle[:200]))
+        return lines
+
+    def lines(self, n: int) -> [str]:
+        return ["profiled {:.1f} s".format(self.seconds)] + self.hotFunctions(n) + [""] + self.taskSummary(n) + [""] + self.slowCallbackSummary(n)
+
+    def profileData(self) -> bytes:
+        """
+        The stats in the .prof format of cProfile's dump_stats(), readable with pstats or snakeviz
+        """
+        return marshal.dumps(self.stats)
+
+
+class Profiler:
+    def __init__(self, sampleInterval: float = constants.PROFILE_TASK_SAMPLE_INTERVAL, slowCallback: float = constants.PROFILE_SLOW_CALLBACK):
+        self.sampleInterval = sampleInterval
+        self.slowCallback = slowCallback
+        self.running = False
+
+    @staticmethod
+    def sampleTasks() -> dict:
+        sample = {}
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            name = getattr(coro, "__qualname__", None) or repr(coro)
+            sample[name] = sample.get(name, 0) + 1
+        return sample
+
+    async def profile(self, seconds: float) -> ProfileReport:
+        """
+        Profiles the event loop for seconds seconds, raises ProfileBusyException if a profile is already running
+        """
+        if self.running:
+            raise ProfileBusyException("A profile is already running.")
+        self.running = True
+        loop = asyncio.get_event_loop()
+        debug, slowCallbackDuration = loop.get_debug(), loop.slow_callback_duration
+        handler = SlowCallbackHandler()
+        asyncioLogger = logging.getLogger("asyncio")
+        profile = cProfile.Profile()
+        taskSamples = []
+        start = time.perf_counter()
+        try:
+            asyncioLogger.addHandler(handler)
+            loop.slow_callback_duration = self.slowCallback
+            loop.set_debug(True)
+            profile.enable()
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                taskSamples.append(self.sampleTasks())
+                await asyncio.sleep(min(self.sampleInterval, max(0, end - time.monotonic())))
+        finally:
+            profile.disable()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slowCallbackDuration
+            asyncioLogger.removeHandler(handler)
+            self.running = False
+        profile.create_stats()
+        return ProfileReport(time.perf_counter() - start, profile.stats, taskSamples, handler.callbacks)
@@ -0,0 +1,93 @@
+"""Query builder module
+
+Module contains the typed predicate class Where and the compiler of the SQL templates used by AsyncDb
+for querying the token table by any combination of its columns.
+Every (operation, field set) combination is compiled into a template only once and cached,
+the template is then executed with the parameters of the predicate.
+"""
+from datetime import datetime
+from functools import lru_cache
+import constants
+from entities.record import Record
+
+#Record attribute -> token table column, in the canonical order of the WHERE clause
+COLUMNS = {
+    "guildid": "Guildid",
+    "discordid": "Discordid",
+    "email": "Email",
+    "token": "Token",
+    "time": "Time",
+    "_type": "Type",
+    "status": "Status",
+}
+
+#Operation -> statement, {where} is replaced with the WHERE condition and {column} with the probed column
+OPERATIONS = {
+    "select": "SELECT Discordid, Email, Token, Time, Type, Status, Guildid FROM {table} WHERE {where}",
+    #yes/no answer computed by the server, stops at the first matching row
+    "exists": "SELECT EXISTS(SELECT 1 FROM {table} WHERE {where})",
+    #a single column, LIMIT 2 is enough to tell one matching row apart from more of them
+    "probe": "SELECT {column} FROM {table} WHERE {where} LIMIT 2",
+    "setStatus": "UPDATE {table} SET Status=%(newStatus)s WHERE {where}",
+    "delete": "DELETE FROM {table} WHERE {where}",
+}
+
+class Where:
+    """
+    Typed predicate over the token table, every given argument is an equality condition on its column
+    and the conditions are joined with AND, e.g. Where(guildid=guild.id, discordid=ctx.author.id, status="pending")
+    """
+    __slots__ = ("fields", "params")
+
+    def __init__(self, *, guildid: int = None, discordid: str = None, email: str = None, token: str = None, time: datetime = None, _type: str = None, status: str = None):
+        values = (guildid, discordid, email, token, time, _type, status)
+        fields = []
+        params = {}
+        for field, value in zip(COLUMNS, values):
+            if value is None:
+                continue
+            fields.append(field)
+            params[field] = str(value) if field == "time" else value
+        self.fields = tuple(fields)
+        self.params = params
+
+    @classmethod
+    def fromRecord(cls, record: Record) -> "Where":
+        """
+        Predicate matching all the fields of the record which are set
+        """
+        return cls(guildid=record.guildid, discordid=record.discordid, email=record.email, token=record.token, time=record.time, _type=record._type, status=record.status)
+
+    @staticmethod
+    def of(predicate) -> "Where":
+        """
+        Accepts a Where or a Record (the form used by the older AsyncDb callers)
+        """
+        if isinstance(predicate, Where):
+            return predicate
+        return Where.fromRecord(predicate)
+
+    def __str__(self):
+        return " AND ".join("{}={}".format(COLUMNS[field], self.params[field]) for field in self.fields)
+
+
+@lru_cache(maxsize=None)
+def compileQuery(operation: str, fields: tuple, column: str = None) -> str:
+    if len(fields) == 0:
+        raise ValueError("compileQuery() error: empty predicate for operation '{}'.".format(operation))
+    if column is not None and column not in COLUMNS.values():
+        raise ValueError("compileQuery() error: unknown column '{}'.".format(column))
+    where = " AND ".join("{}=%({})s".format(COLUMNS[field], field) for field in fields)
+    return OPERATIONS[operation].format(table=constants.TABLE_NAME, where=where, column=column)
+
+def build(operation: str, predicate, column: str = None, **extra) -> (str, dict):
+    """
+    Returns the cached template for the operation and the predicate's fields, with the parameters
+    to execute it with. column is the column of the "probe" operation, extra holds the parameters
+    of the operation itself (e.g. newStatus).
+    """
+    where = Where.of(predicate)
+    params = where.params
+    if extra:
+        params = dict(params, **extra)
+    return compileQuery(operation, where.fields, column), params
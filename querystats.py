@@ -0,0 +1,112 @@
+"""
+Per-template statistics of the queries executed by AsyncDb, and the slow-query log.
+AsyncDb.cursor() hands out TracedCursor instances, which time every execute/executemany and record
+the calls, time, rows returned and rows affected under the normalized query template
+(whitespace collapsed, IN lists and multi-row VALUES folded, so all the variants count as one template).
+Queries slower than SLOW_QUERY_THRESHOLD seconds are logged by the "slowquery" logger,
+with the parameters redacted to their types.
+"""
+import re
+import time
+import constants
+from log import getLogger
+
+WHITESPACE = re.compile(r"\s+")
+#IN (%s, %s, ...) and repeated VALUES (...), (...) groups
+PLACEHOLDER_LIST = re.compile(r"\(\s*%s(\s*,\s*%s)+\s*\)")
+VALUES_LIST = re.compile(r"(VALUES\s*\([^()]*\))(\s*,\s*\([^()]*\))+", re.IGNORECASE)
+#rowcounts from this one up are the unsigned -1 of an unknown count
+UNKNOWN_ROWCOUNT = 2 ** 63
+
+
+def normalize(query: str) -> str:
+    query = WHITESPACE.sub(" ", query).strip()
+    query = PLACEHOLDER_LIST.sub("(%s, ...)", query)
+    return VALUES_LIST.sub(r"\1, ...", query)
+
+def redact(params) -> str:
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join("{}: {}".format(k, type(v).__name__) for k, v in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        return "(" + ", ".join(type(v).__name__ for v in params) + ")"
+    return type(params).__name__
+
+
+class TemplateStats:
+    __slots__ = ("calls", "time", "maxTime", "rowsReturned", "rowsAffected")
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.maxTime = 0.0
+        self.rowsReturned = 0
+        self.rowsAffected = 0
+
+
+class QueryStats:
+    def __init__(self, slowThreshold: float = constants.SLOW_QUERY_THRESHOLD):
+        self.slowThreshold = slowThreshold
+        #normalized template -> TemplateStats
+        self.templates = {}
+
+    def record(self, query: str, params, elapsed: float, returned: int, affected: int):
+        template = normalize(query)
+        stats = self.templates.get(template)
+        if stats is None:
+            stats = self.templates[template] = TemplateStats()
+        stats.calls += 1
+        stats.time += elapsed
+        stats.maxTime = max(stats.maxTime, elapsed)
+        stats.rowsReturned += returned
+        stats.rowsAffected += affected
+        if elapsed >= self.slowThreshold:
+            getLogger("slowquery").warning("{:.3f}s rows returned {} affected {}: {} params {}".format(elapsed, returned, affected, template, redact(params)))
+
+    def top(self, n: int) -> [(str, TemplateStats)]:
+        return sorted(self.templates.items(), key=lambda item: item[1].time, reverse=True)[:n]
+
+    def reset(self):
+        self.templates = {}
+
+
+STATS = QueryStats()
+
+
+class TracedCursor:
+    """
+    Wraps an aiomysql cursor, execute() and executemany() are recorded into STATS,
+    everything else is passed through
+    """
+    def __init__(self, cursor, stats: QueryStats = STATS):
+        self.cursor = cursor
+        self.stats = stats
+
+    async def execute(self, query: str, args=None):
+        start = time.perf_counter()
+        try:
+            return await self.cursor.execute(query, args)
+        finally:
+            self.recordCall(query, args, time.perf_counter() - start)
+
+    async def executemany(self, query: str, args):
+        start = time.perf_counter()
+        try:
+            return await self.cursor.executemany(query, args)
+        finally:
+            self.recordCall(query, args[0] if args else None, time.perf_counter() - start)
+
+    def recordCall(self, query: str, args, elapsed: float):
+        #rowcount counts the buffered result rows after a SELECT and the affected rows otherwise,
+        #unbuffered cursors (SSCursor) don't know it upfront and report 2**64 - 1 (-1 as unsigned)
+        rowcount = self.cursor.rowcount or 0
+        if rowcount < 0 or rowcount >= UNKNOWN_ROWCOUNT:
+            rowcount = 0
+        if self.cursor.description is not None:
+            self.stats.record(query, args, elapsed, rowcount, 0)
+        else:
+            self.stats.record(query, args, elapsed, 0, rowcount)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
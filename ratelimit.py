@@ -0,0 +1,118 @@
+"""
+In-memory rate limiting and admission control for the DM commands.
+Admission.check() takes a token from the sender's bucket, and for commands which send an email
+also from the email domain's bucket and the global one; a command is only charged if all of them
+have a token left. Buckets which refilled and stayed idle are evicted, so memory stays bounded.
+AdmissionGate bounds the number of commands running in the controller at once, commands over the
+limit wait, and once too many are waiting the new ones are rejected right away.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+import constants
+
+
+class RateLimitedException(Exception):
+    def __init__(self, message, scope: str, retryAfter: float):
+        super().__init__(message)
+        self.scope = scope
+        self.retryAfter = retryAfter
+
+class OverloadedException(Exception):
+    pass
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, count: int, seconds: float, now: float):
+        #count tokens per seconds, bursts of up to count
+        self.rate = count / seconds
+        self.capacity = count
+        self.tokens = count
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retryAfter(self) -> float:
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets by key, created on first use
+    """
+    def __init__(self, limit: (int, float), idleTimeout: float = constants.RATE_LIMIT_IDLE):
+        self.count, self.seconds = limit
+        self.idleTimeout = idleTimeout
+        self.buckets = {}
+        self.lastEviction = time.monotonic()
+
+    def bucket(self, key, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.count, self.seconds, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def evict(self, now: float):
+        if now - self.lastEviction < self.idleTimeout:
+            return
+        self.lastEviction = now
+        #an idle bucket which would be full again is the same as a new one
+        self.buckets = {k: b for k, b in self.buckets.items() if now - b.updated < max(self.idleTimeout, self.seconds)}
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class AdmissionGate:
+    def __init__(self, concurrency: int = constants.ADMISSION_CONCURRENCY, queue: int = constants.ADMISSION_QUEUE):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = queue
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            raise OverloadedException("Admission rejected, {} commands already waiting.".format(self.waiting))
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+class Admission:
+    def __init__(self):
+        self.users = RateLimiter(constants.RATE_LIMIT_USER)
+        self.domains = RateLimiter(constants.RATE_LIMIT_DOMAIN)
+        self.globalLimit = RateLimiter(constants.RATE_LIMIT_GLOBAL)
+        self.gate = AdmissionGate()
+
+    def check(self, userId: int, email: str = None):
+        """
+        Charges one token to the user, and if email is given, to its domain and the global bucket.
+        Raises RateLimitedException (and charges nothing) if one of them is empty.
+        """
+        now = time.monotonic()
+        buckets = [("user", self.users, userId)]
+        if email is not None:
+            buckets.append(("domain", self.domains, email.rpartition("@")[2].lower()))
+            buckets.append(("global", self.globalLimit, None))
+        taken = []
+        for scope, limiter, key in buckets:
+            limiter.evict(now)
+            bucket = limiter.bucket(key, now)
+            if bucket.tokens < 1:
+                raise RateLimitedException("Rate limited: {} {} over budget.".format(scope, key if key is not None else ""), scope, bucket.retryAfter())
+            taken.append(bucket)
+        for bucket in taken:
+            bucket.tokens -= 1
@@ -0,0 +1,107 @@
+"""
+Pool of authenticated SMTP connections, so sending an email doesn't pay the TCP connect,
+TLS handshake and SMTP AUTH every time.
+A connection which was idle for a while is health-checked with NOOP before it is reused,
+connections idle for longer than the idle timeout (most servers drop them) are reconnected,
+and every connection is closed after sending a number of messages.
+"""
+import asyncio
+import time
+import aiosmtplib
+import constants
+from email.message import EmailMessage
+from log import getLogger
+
+
+class PooledClient:
+    def __init__(self, client: aiosmtplib.SMTP):
+        self.client = client
+        self.lastUsed = time.monotonic()
+        self.sent = 0
+
+
+class SmtpPool:
+    def __init__(self,
+        size: int = constants.SMTP_POOL_SIZE,
+        idleTimeout: float = constants.SMTP_IDLE_TIMEOUT,
+        healthcheckAfter: float = constants.SMTP_HEALTHCHECK_AFTER,
+        messagesPerSession: int = constants.SMTP_MESSAGES_PER_SESSION
+        ):
+        self.idleTimeout = idleTimeout
+        self.healthcheckAfter = healthcheckAfter
+        self.messagesPerSession = messagesPerSession
+        #limits the number of open connections, idle ones included
+        self.semaphore = asyncio.Semaphore(size)
+        #most recently used last
+        self.idle = []
+
+    async def connect(self) -> PooledClient:
+        client = aiosmtplib.SMTP(hostname=constants.SMTP_HOST, port=constants.SMTP_PORT, use_tls=constants.SMTP_USE_TLS, timeout=constants.SMTP_TIMEOUT)
+        await client.connect()
+        await client.login(constants.SMTP_USER, constants.SMTP_PASS)
+        return PooledClient(client)
+
+    @staticmethod
+    async def discard(conn: PooledClient):
+        try:
+            if conn.client.is_connected:
+                await conn.client.quit()
+        except Exception:
+            conn.client.close()
+
+    async def isHealthy(self, conn: PooledClient) -> bool:
+        idleFor = time.monotonic() - conn.lastUsed
+        if not conn.client.is_connected or idleFor > self.idleTimeout:
+            return False
+        if idleFor < self.healthcheckAfter:
+            return True
+        try:
+            await conn.client.noop()
+            return True
+        except aiosmtplib.SMTPException:
+            return False
+
+    async def acquire(self) -> PooledClient:
+        await self.semaphore.acquire()
+        try:
+            while len(self.idle) > 0:
+                conn = self.idle.pop()
+                if await self.isHealthy(conn):
+                    return conn
+                await self.discard(conn)
+            return await self.connect()
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    async def release(self, conn: PooledClient, reuse: bool = True):
+        conn.lastUsed = time.monotonic()
+        if reuse and conn.sent < self.messagesPerSession:
+            self.idle.append(conn)
+        else:
+            await self.discard(conn)
+        self.semaphore.release()
+
+    async def send(self, message: EmailMessage, sender: str, recipients: [str]):
+        conn = await self.acquire()
+        try:
+            await conn.client.send_message(message, sender=sender, recipients=recipients)
+        except aiosmtplib.SMTPServerDisconnected:
+            #the server dropped the session since the health check, retry once on a fresh connection
+            getLogger(__name__).info("SMTP connection dropped by the server, reconnecting.")
+            await self.release(conn, reuse=False)
+            conn = await self.acquire()
+            try:
+                await conn.client.send_message(message, sender=sender, recipients=recipients)
+            except BaseException:
+                await self.release(conn, reuse=False)
+                raise
+        except BaseException:
+            await self.release(conn, reuse=False)
+            raise
+        conn.sent += 1
+        await self.release(conn)
+
+    async def close(self):
+        while len(self.idle) > 0:
+            await self.discard(self.idle.pop())
@@ -0,0 +1,59 @@
+"""
+Background task which deletes the pending registrations older than PENDING_TOKEN_TTL.
+Every run deletes the expired records in small batches, each one in its own short transaction
+and found through the (Status, Time) index, so no run holds locks on a large part of the table.
+With a LockSession, only the leader among the processes sharing the database sweeps (see LockSession.lead()).
+"""
+import asyncio
+import constants
+from asyncdb import AsyncDb
+from coordination import LockSession
+from log import getLogger
+
+
+class ExpirySweeper:
+    def __init__(self, db: AsyncDb,
+        ttl: int = constants.PENDING_TOKEN_TTL,
+        interval: int = constants.SWEEP_INTERVAL,
+        batchSize: int = constants.SWEEP_BATCH_SIZE,
+        lockSession: LockSession = None
+        ):
+        self.db = db
+        self.lockSession = lockSession
+        self.ttl = ttl
+        self.interval = interval
+        self.batchSize = batchSize
+        self.task: asyncio.Task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.lockSession is not None and not await self.lockSession.lead("sweeper"):
+                getLogger(__name__).debug("Expiry sweep skipped, another process is the leader.")
+                continue
+            try:
+                await self.sweep()
+            except Exception as e:
+                getLogger(__name__).error("Expiry sweep failed: {}".format(e))
+
+    async def sweep(self) -> int:
+        total = 0
+        while True:
+            async with self.db.transaction() as db:
+                cnt = await db.deleteExpired(self.ttl, self.batchSize)
+            total += cnt
+            if cnt < self.batchSize:
+                break
+            #let the commands waiting for the table in between the batches
+            await asyncio.sleep(0)
+        getLogger(__name__).info("Expiry sweep purged {} pending records older than {} seconds.".format(total, self.ttl))
+        return total
@@ -3,3 +3,9 @@ def getFromListCaseIgnored(s: str, lst: [str]) -> str:
         if e.lower() == s.lower():
             return e
     return None
+
+def likeEscape(s: str) -> str:
+    """
+    Escapes the LIKE wildcards in s, for matching it literally as a part of a LIKE pattern
+    """
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")